@@ -1,18 +1,23 @@
-import tempfile
-from flask import Flask, request, jsonify, make_response
+import json
+import time
+from flask import Flask, Response, g, request, jsonify, make_response, stream_with_context
 from flask_cors import CORS
-from openai import OpenAI
-from azure.ai.inference import ChatCompletionsClient
-from azure.core.credentials import AzureKeyCredential
+from werkzeug.exceptions import HTTPException
 from dotenv import load_dotenv
-import os
 import logging
-import anthropic
-from utils.extract_json import extract_json_from_response
-from utils.token_utils import estimate_token_count
-from utils.pdf_extraction import extract_text_from_pdf
-from utils.prompts import system_prompts, user_prompts, get_prompts
-from collections import OrderedDict
+from utils.prompts import system_prompts
+from utils.uploads import MAX_UPLOAD_BYTES, read_upload, discard_upload
+from utils.pipeline import extraction_cache, extract_document_pages, extract_rule_fields, iter_model_events, iter_model_results, route_models, rules_report
+from utils.batch import BatchScheduler
+from utils.jobs import JOB_EVENTS_POLL_SECONDS, get_job_queue, get_job_workers, job_options
+from utils.results_store import results_store
+from utils.normalize import normalize_pages
+from utils.web import (
+    collect_cache_metrics, debug_requested, parse_extraction_options, parse_result_filters, provider_metrics_collector,
+    provider_stats, sse_event
+)
+from utils.providers import PROVIDERS, PROVIDER_SCHEDULERS
+from utils.metrics import REGISTRY, HTTP_REQUESTS, HTTP_SECONDS, RequestTrace
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
@@ -21,20 +26,37 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 app = Flask(__name__)
+# Werkzeug enforces this while the request body streams in, so oversized uploads are never fully read
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
 CORS(app)
 
-# Initialize OpenAI client
-client = OpenAI()  # It will automatically use OPENAI_API_KEY from environment
 
-# Initialize Clients
-openai_client = OpenAI(base_url="https://models.inference.ai.azure.com", api_key=os.environ["GITHUB_TOKEN"])
-openai_model = "gpt-4o"
+def preflight_response():
+    response = make_response()
+    response.headers.add("Access-Control-Allow-Origin", "*")
+    response.headers.add("Access-Control-Allow-Headers", "*")
+    response.headers.add("Access-Control-Allow-Methods", "*")
+    return response
 
-deepseek_client = ChatCompletionsClient(endpoint="https://models.github.ai/inference", credential=AzureKeyCredential(os.environ["GITHUB_TOKEN"]))
-deepseek_model = "deepseek/DeepSeek-V3-0324"
 
-anthropic_client = anthropic.Anthropic(api_key=os.environ["ANTHROPIC_API_KEY"])
-anthropic_model = "claude-3-5-sonnet-20240620"
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    if "request_started" in g:
+        HTTP_SECONDS.observe(time.perf_counter() - g.request_started, endpoint=endpoint, method=request.method)
+    return response
+
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({"error": f"File is larger than the {MAX_UPLOAD_BYTES} byte upload limit"}), 413
+
 
 @app.route("/api/process-pdf", methods=["POST", "OPTIONS"])
 def process_pdf():
@@ -44,13 +66,10 @@ def process_pdf():
 
     # Handle preflight request
     if request.method == "OPTIONS":
-        response = make_response()
-        response.headers.add("Access-Control-Allow-Origin", "*")
-        response.headers.add("Access-Control-Allow-Headers", "*")
-        response.headers.add("Access-Control-Allow-Methods", "*")
-        return response
+        return preflight_response()
 
     try:
+        trace = RequestTrace()
         # logger.debug(f"Files in request: {request.files}")
         if "file" not in request.files:
             # logger.error("No file in request")
@@ -60,95 +79,371 @@ def process_pdf():
         if not pdf_file.filename:
             # logger.error("File has no filename")
             return jsonify({"error": "File has no filename"}), 400
-        temp_file_path = os.path.join(tempfile.gettempdir(), pdf_file.filename)
-        
 
-        # Temporary file storage & extraction
-        pdf_file.save(temp_file_path)
-        pdf_text = extract_text_from_pdf(temp_file_path)
-        os.remove(temp_file_path)
+        # Set prompts based on selected document type, plus the chunking, normalization and rule options
+        try:
+            options = parse_extraction_options(request.form, PROVIDERS)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        document_type, chunk_mode, rule_mode = options["document_type"], options["chunk_mode"], options["rule_mode"]
+
+        # Extraction works from the uploaded bytes; only very large PDFs are spooled to a temp file
+        with trace.span("upload") as span:
+            pdf_source, file_hash = read_upload(pdf_file.stream)
+            span["spooled"] = isinstance(pdf_source, str)
+        try:
+            pages = extract_document_pages(pdf_source, file_hash, trace=trace)
+        finally:
+            discard_upload(pdf_source)
 
         # logger.debug("Successfully extracted text from PDF")
 
-        # Set prompts based on selected document type
-        document_type = request.form.get('type', 'invoice')  # Default to 'invoice' if not specified
-        system_prompt, prompt = get_prompts(document_type, pdf_text)
+        # Strip repeated headers/footers and whitespace noise before it's billed as prompt tokens
+        with trace.span("normalize"):
+            pages, normalization = normalize_pages(pages, options["normalizers"])
+        pdf_text = "".join(pages)
+        rules = extract_rule_fields(document_type, pdf_text, rule_mode, trace=trace)
 
         # ------------- CLIENT CALLS -------------
-        # Call OpenAI client
-        openai_response = client.chat.completions.create(
-            model=openai_model,
-            temperature=0.1,
-            timeout=90,  # 90 second timeout for OpenAI API call
-            messages=[
-                {
-                    "role": "system",
-                    "content": system_prompt
-                },
-                {"role": "user", "content": prompt}
-            ]
-        )
-        openai_response_content = str(openai_response.choices[0].message.content)
-
-        # Call DeepSeek client
-        deepseek_response = deepseek_client.complete(
-            model=deepseek_model,
-            temperature=0.1,
-            timeout=90,  # 90 second timeout for OpenAI API call
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are an invoice data extraction assistant. IMPORTANT: Return ONLY valid JSON with no preamble, no explanations, and no additional text. The response must start with '{' and end with '}'."
-                },
-                {"role": "user", "content": prompt}
-            ]
-        )
-        deepseek_response_content = str(deepseek_response.choices[0].message.content)
-
-        # Call Anthropic client
-        response = anthropic_client.messages.create(
-            model=anthropic_model,
-            max_tokens=4000,
-            temperature=0.1,
-            system="You are an invoice data extraction assistant. IMPORTANT: Return ONLY valid JSON with no preamble, no explanations, and no additional text. The response must start with '{' and end with '}'",
-            messages=[
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ]
-        )
-        # Anthropic returns a list of textblocks, so we need to convert the first one to a string
-        anthropic_response_content = str(response.content[0].text)  # Convert to string if it's a textblock
-
-        # Extract the JSON response
-        # extracted_data = extract_json_from_response(response_content)
+        # With the default "consensus" routing all providers run concurrently; a failing or slow provider
+        # only loses its own result. "fastest" and "hedged" return the first valid result instead.
+        # Each value is the model's parsed JSON, or {"error": ...} if that provider failed.
+        model_responses, usage, routing = route_models(document_type, pdf_text, file_hash, providers=options["providers"], pages=pages,
+                                                       chunk_mode=chunk_mode, trace=trace, rules=rules, rule_mode=rule_mode,
+                                                       policy=options["policy"])
+        results_store.write(file_hash, pdf_file.filename, document_type, model_responses, "process-pdf")
+
         # To Do : update token counts for different models
         # token_counts = estimate_token_count(prompt, extracted_data)
 
-        logger.debug(f"DeepSeek response: {extract_json_from_response(deepseek_response_content)}")
-
-        # List of model names and their corresponding response contents
-        model_responses = {
-            "deepseek": extract_json_from_response(deepseek_response_content),
-            "openai": extract_json_from_response(openai_response_content),
-            "anthropic": extract_json_from_response(anthropic_response_content)
-        }
-
-
         # Construct the final response object
         response_data = {
             "success": True,
             "data": model_responses,
-            "tokens": 1
+            "tokens": 1,
+            # Per-model token usage as reported by each provider, including prompt cache reads/writes
+            "usage": usage,
+            "normalization": normalization,
+            # The winner and cancelled providers, or how well the models agree for "consensus"
+            "routing": routing
         }
+        if rules is not None:
+            response_data["rules"] = rules_report(rules, rule_mode)
+        # Per-stage spans (upload, text extraction/OCR, prompts, each provider call, parsing)
+        if debug_requested(request.form, request.args):
+            response_data["timing"] = trace.summary()
 
         return response_data
 
+    except HTTPException:
+        # e.g. 413 from the upload size limit, handled by its error handler
+        raise
     except Exception as e:
         logger.error(f"Error processing request: {str(e)}", exc_info=True)
         return jsonify({"error": str(e)}), 500
 
+# ------------- STREAMING EXTRACTION -------------
+@app.route("/api/process-pdf/stream", methods=["POST", "OPTIONS"])
+def process_pdf_stream():
+    """
+    Same as /api/process-pdf, but streams Server-Sent Events as each stage finishes:
+    "text_extracted" with the page count, "rules" with the rule-based fields if rules are on, one
+    "model_result" per model as soon as it returns, then a "summary". A failure after the stream has started is sent as an "error" event.
+    With partial=true the model responses are streamed too, and "model_partial" events carry each
+    model's fields (and invoice_items elements) as soon as the model has written them.
+    """
+    if request.method == "OPTIONS":
+        return preflight_response()
+
+    if "file" not in request.files:
+        return jsonify({"error": "No file provided"}), 400
+
+    pdf_file = request.files["file"]
+    if not pdf_file.filename:
+        return jsonify({"error": "File has no filename"}), 400
+
+    try:
+        options = parse_extraction_options(request.form, PROVIDERS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    document_type, chunk_mode, rule_mode = options["document_type"], options["chunk_mode"], options["rule_mode"]
+
+    debug = debug_requested(request.form, request.args)
+    stream_partial = request.form.get('partial', 'false').lower() == 'true'
+    trace = RequestTrace()
+    # The upload has to be read while the request is still being handled, before streaming starts
+    with trace.span("upload") as span:
+        pdf_source, file_hash = read_upload(pdf_file.stream)
+        span["spooled"] = isinstance(pdf_source, str)
+
+    def generate():
+        start = time.monotonic()
+        try:
+            try:
+                pages = extract_document_pages(pdf_source, file_hash, trace=trace)
+            finally:
+                discard_upload(pdf_source)
+            with trace.span("normalize"):
+                pages, normalization = normalize_pages(pages, options["normalizers"])
+            pdf_text = "".join(pages)
+            yield sse_event("text_extracted", {
+                "pages": len(pages),
+                "characters": len(pdf_text),
+                "normalization": normalization,
+                "elapsed_seconds": round(time.monotonic() - start, 3)
+            })
+
+            rules = extract_rule_fields(document_type, pdf_text, rule_mode, trace=trace)
+            if rules is not None:
+                yield sse_event("rules", rules_report(rules, rule_mode))
+
+            errors = {}
+            results = {}
+            model_args = (document_type, pdf_text, file_hash, options["providers"], pages, chunk_mode, trace, rules, rule_mode)
+            if stream_partial:
+                events = iter_model_events(*model_args)
+            else:
+                events = (("result", *result) for result in iter_model_results(*model_args))
+            for event in events:
+                if event[0] == "partial":
+                    _, model_name, update = event
+                    yield sse_event("model_partial", {"model": model_name, **update, "elapsed_seconds": round(time.monotonic() - start, 3)})
+                    continue
+                _, model_name, data, usage = event
+                results[model_name] = data
+                if isinstance(data, dict) and set(data) == {"error"}:
+                    errors[model_name] = data["error"]
+                yield sse_event("model_result", {
+                    "model": model_name,
+                    "data": data,
+                    "usage": usage,
+                    "elapsed_seconds": round(time.monotonic() - start, 3)
+                })
+
+            results_store.write(file_hash, pdf_file.filename, document_type, results, "process-pdf-stream")
+            summary = {
+                "success": True,
+                "models": list(results),
+                "errors": errors,
+                "elapsed_seconds": round(time.monotonic() - start, 3)
+            }
+            if debug:
+                summary["timing"] = trace.summary()
+            yield sse_event("summary", summary)
+        except Exception as e:
+            logger.error(f"Error processing streaming request: {str(e)}", exc_info=True)
+            yield sse_event("error", {"error": str(e)})
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    # Covers a client that disconnects before extraction starts
+    response.call_on_close(lambda: discard_upload(pdf_source))
+    # Stop proxies from buffering the stream, which would defeat the point of it
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+# ------------- BATCH EXTRACTION -------------
+@app.route("/api/process-batch", methods=["POST", "OPTIONS"])
+def process_batch():
+    """
+    Extract many PDFs uploaded under the "files" field. Each document's result is streamed back as
+    one line of NDJSON as soon as it finishes, and written to outputs/json/.
+    """
+    if request.method == "OPTIONS":
+        return preflight_response()
+
+    pdf_files = [f for f in request.files.getlist("files") if f.filename]
+    if not pdf_files:
+        return jsonify({"error": "No files provided"}), 400
+    # Each file's output is named after it, so two files of the same name would overwrite each other
+    names = [f.filename for f in pdf_files]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        return jsonify({"error": f"Duplicate file names: {', '.join(duplicates)}"}), 400
+
+    try:
+        options = parse_extraction_options(request.form, PROVIDERS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    scheduler = BatchScheduler(
+        document_type=options["document_type"],
+        chunk_mode=options["chunk_mode"],
+        overwrite=request.form.get('overwrite', 'false').lower() == 'true',
+        rule_mode=options["rule_mode"],
+        providers=options["providers"],
+        normalizers=options["normalizers"]
+    )
+
+    # The uploads have to be read while the request is still being handled, before streaming starts
+    documents = []
+    try:
+        for pdf_file in pdf_files:
+            pdf_source, _ = read_upload(pdf_file.stream)
+            documents.append((pdf_file.filename, pdf_source))
+    except Exception:
+        for _, pdf_source in documents:
+            discard_upload(pdf_source)
+        raise
+
+    def generate():
+        for result in scheduler.run(documents):
+            yield json.dumps(result) + "\n"
+
+    response = Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+    response.headers["X-Accel-Buffering"] = "no"
+    response.call_on_close(lambda: [discard_upload(pdf_source) for _, pdf_source in documents])
+    return response
+
+# ------------- BACKGROUND JOBS -------------
+# Jobs run on worker threads of this process (JOB_WORKERS) and are kept in a SQLite queue, so a
+# long extraction doesn't depend on the request, or the process, that submitted it
+@app.before_request
+def start_job_workers():
+    # Flask has no startup hook, so the workers start with the first request this process serves.
+    # Importing the app, e.g. in a script or the reloader's parent process, doesn't start them.
+    get_job_workers().start()
+
+
+@app.route("/api/jobs", methods=["POST", "OPTIONS"])
+def submit_job():
+    """
+    Queue a PDF for extraction and return its job id straight away. Takes the same form fields as
+    /api/process-pdf, except routing. Submitting a file that already has a queued, running or
+    finished job with the same options returns that job instead.
+    """
+    if request.method == "OPTIONS":
+        return preflight_response()
+
+    if "file" not in request.files:
+        return jsonify({"error": "No file provided"}), 400
+
+    pdf_file = request.files["file"]
+    if not pdf_file.filename:
+        return jsonify({"error": "File has no filename"}), 400
+
+    try:
+        options = parse_extraction_options(request.form, PROVIDERS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    pdf_source, file_hash = read_upload(pdf_file.stream)
+    try:
+        job, created = get_job_queue().submit(pdf_source, file_hash, pdf_file.filename, job_options(options))
+    finally:
+        discard_upload(pdf_source)
+    if created:
+        get_job_workers().notify()
+    return jsonify({"success": True, "job": job, "deduplicated": not created}), 202 if created else 200
+
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = get_job_queue().get(job_id)
+    if job is None:
+        return jsonify({"error": "No such job"}), 404
+    return jsonify({"success": True, "job": job})
+
+
+@app.route("/api/jobs/<job_id>/events", methods=["GET"])
+def get_job_events(job_id):
+    """
+    Stream a job's progress as Server-Sent Events: a "status" event whenever its stage changes, then
+    "done" with the result or "error", after which the stream ends.
+    """
+    job_queue = get_job_queue()
+    if job_queue.get(job_id) is None:
+        return jsonify({"error": "No such job"}), 404
+
+    def generate():
+        last_state = None
+        while True:
+            job = job_queue.get(job_id)
+            state = (job["status"], job["stage"], len(job["completed_stages"]))
+            if state != last_state:
+                last_state = state
+                yield sse_event(job["status"] if job["status"] in ("done", "error") else "status", job)
+            if job["status"] in ("done", "error"):
+                return
+            time.sleep(JOB_EVENTS_POLL_SECONDS)
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+# ------------- STORED RESULTS -------------
+@app.route("/api/results", methods=["GET"])
+def get_results():
+    """
+    Look up stored extraction results by vendor_name, invoice_number, invoice_date, po_number,
+    file_hash, model or document_type (query parameters), newest first, with limit and offset.
+    """
+    try:
+        params = parse_result_filters(request.args)
+        results = results_store.query(params["filters"], limit=params["limit"], offset=params["offset"])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"success": True, "results": results})
+
+
+@app.route("/api/results/duplicates", methods=["GET"])
+def get_duplicate_results():
+    """
+    Invoices extracted from more than one document, or only those of the file_hash query parameter.
+    """
+    try:
+        limit = int(request.args.get('limit', '100'))
+    except ValueError:
+        return jsonify({"error": "limit must be a whole number"}), 400
+    return jsonify({"success": True, "duplicates": results_store.duplicates(request.args.get('file_hash'), limit=limit)})
+
+
+@app.route("/api/results/export", methods=["GET"])
+def export_results():
+    """
+    Stream every stored result matching the same filters as /api/results, as NDJSON (format=ndjson,
+    the default) or CSV (format=csv).
+    """
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ("ndjson", "csv"):
+        return jsonify({"error": "format must be ndjson or csv"}), 400
+    try:
+        filters = parse_result_filters(request.args)["filters"]
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    lines = results_store.export_ndjson(filters) if export_format == "ndjson" else results_store.export_csv(filters)
+    mimetype = "application/x-ndjson" if export_format == "ndjson" else "text/csv"
+    response = Response(lines, mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename=results.{export_format}"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+# ------------- CACHE STATS -------------
+@app.route("/api/cache-stats", methods=["GET"])
+def get_cache_stats():
+    return jsonify({"success": True, "cache": extraction_cache.stats()})
+
+# ------------- PROVIDER STATS -------------
+@app.route("/api/provider-stats", methods=["GET"])
+def get_provider_stats():
+    return jsonify({"success": True, "providers": provider_stats(PROVIDER_SCHEDULERS)})
+
+# ------------- METRICS -------------
+REGISTRY.add_collector(collect_cache_metrics)
+REGISTRY.add_collector(provider_metrics_collector(PROVIDER_SCHEDULERS))
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+# ------------- MODEL SELECTION -------------
+@app.route("/api/models", methods=["GET"])
+def get_models():
+    # The enabled providers, which a request's "models" field can choose from
+    return jsonify({"success": True, "models": list(PROVIDERS)})
+
 # ------------- DOCUMENT TYPE SELECTION -------------
 @app.route("/api/document-types", methods=["GET"])
 def get_document_types():
@@ -0,0 +1,396 @@
+import time
+import asyncio
+import logging
+from itertools import islice
+from quart import Quart, Response, g, request, jsonify
+from werkzeug.exceptions import HTTPException
+from dotenv import load_dotenv
+import os
+from utils.prompts import system_prompts
+from utils.uploads import MAX_UPLOAD_BYTES, read_upload, discard_upload
+from utils.pipeline import extraction_cache, rules_report
+from utils.async_pipeline import aextract_document_pages, aextract_rule_fields, aiter_model_events, aiter_model_results, aroute_models, run_cpu_bound, shutdown_cpu_executor
+from utils.async_providers import ASYNC_PROVIDERS, ASYNC_PROVIDER_SCHEDULERS, close_async_clients
+from utils.jobs import JOB_EVENTS_POLL_SECONDS, get_job_queue, get_job_workers, job_options
+from utils.results_store import EXPORT_BATCH_ROWS, results_store
+from utils.normalize import normalize_pages
+from utils.web import (
+    collect_cache_metrics, debug_requested, parse_extraction_options, parse_result_filters, provider_metrics_collector,
+    provider_stats, sse_event
+)
+from utils.metrics import REGISTRY, HTTP_REQUESTS, HTTP_SECONDS, RequestTrace
+
+# Async server for the extraction endpoints: provider calls are awaited on one event loop and
+# PDF/OCR work runs on a process pool, so a single worker can hold hundreds of uploads in flight.
+# Batch extraction stays in the Flask app (app.py). Run with gunicorn -c gunicorn.conf.py asgi:app
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+app = Quart(__name__)
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES
+# Quart cancels responses after 60s by default, but each provider is allowed PROVIDER_TIMEOUTS (90s)
+app.config["RESPONSE_TIMEOUT"] = float(os.environ.get("RESPONSE_TIMEOUT_SECONDS", "300"))
+
+
+def preflight_response():
+    response = Response("")
+    response.headers["Access-Control-Allow-Headers"] = "*"
+    response.headers["Access-Control-Allow-Methods"] = "*"
+    return response
+
+
+@app.before_request
+async def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+async def record_request_metrics(response):
+    # Same as flask_cors' defaults in app.py: every origin is allowed
+    response.headers.setdefault("Access-Control-Allow-Origin", "*")
+    endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    HTTP_REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    if "request_started" in g:
+        HTTP_SECONDS.observe(time.perf_counter() - g.request_started, endpoint=endpoint, method=request.method)
+    return response
+
+
+@app.before_serving
+async def start_job_workers():
+    # Creates the job queue, which opens its SQLite database, off the event loop
+    workers = await asyncio.to_thread(get_job_workers)
+    workers.start()
+
+
+@app.after_serving
+async def close_pools():
+    await close_async_clients()
+    shutdown_cpu_executor()
+    # Jobs still running are picked up again once their lease expires
+    get_job_workers().stop(timeout=0)
+
+
+@app.errorhandler(413)
+async def upload_too_large(e):
+    return jsonify({"error": f"File is larger than the {MAX_UPLOAD_BYTES} byte upload limit"}), 413
+
+
+async def extract_and_normalize(pdf_source, file_hash: str, normalizers: list[str], trace: RequestTrace) -> tuple[list[str], dict]:
+    try:
+        pages = await aextract_document_pages(pdf_source, file_hash, trace=trace)
+    finally:
+        discard_upload(pdf_source)
+    with trace.span("normalize"):
+        return await run_cpu_bound(normalize_pages, pages, normalizers)
+
+
+@app.route("/api/process-pdf", methods=["POST", "OPTIONS"])
+async def process_pdf():
+    """
+    Same request and response as /api/process-pdf in app.py.
+    """
+    if request.method == "OPTIONS":
+        return preflight_response()
+
+    try:
+        trace = RequestTrace()
+        files = await request.files
+        form = await request.form
+        if "file" not in files:
+            return jsonify({"error": "No file provided"}), 400
+
+        pdf_file = files["file"]
+        if not pdf_file.filename:
+            return jsonify({"error": "File has no filename"}), 400
+
+        try:
+            options = parse_extraction_options(form, ASYNC_PROVIDERS)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        document_type, chunk_mode, rule_mode = options["document_type"], options["chunk_mode"], options["rule_mode"]
+
+        with trace.span("upload") as span:
+            pdf_source, file_hash = await asyncio.to_thread(read_upload, pdf_file.stream)
+            span["spooled"] = isinstance(pdf_source, str)
+        pages, normalization = await extract_and_normalize(pdf_source, file_hash, options["normalizers"], trace)
+        pdf_text = "".join(pages)
+        rules = await aextract_rule_fields(document_type, pdf_text, rule_mode, trace=trace)
+
+        model_responses, usage, routing = await aroute_models(document_type, pdf_text, file_hash, providers=options["providers"],
+                                                              pages=pages, chunk_mode=chunk_mode, trace=trace, rules=rules,
+                                                              rule_mode=rule_mode, policy=options["policy"])
+        await asyncio.to_thread(results_store.write, file_hash, pdf_file.filename, document_type, model_responses, "process-pdf")
+
+        response_data = {
+            "success": True,
+            "data": model_responses,
+            "tokens": 1,
+            "usage": usage,
+            "normalization": normalization,
+            "routing": routing
+        }
+        if rules is not None:
+            response_data["rules"] = rules_report(rules, rule_mode)
+        if debug_requested(form, request.args):
+            response_data["timing"] = trace.summary()
+
+        return response_data
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error processing request: {str(e)}", exc_info=True)
+        return jsonify({"error": str(e)}), 500
+
+# ------------- STREAMING EXTRACTION -------------
+@app.route("/api/process-pdf/stream", methods=["POST", "OPTIONS"])
+async def process_pdf_stream():
+    """
+    Same Server-Sent Events as /api/process-pdf/stream in app.py. If the client disconnects, the
+    provider calls still in flight are cancelled.
+    """
+    if request.method == "OPTIONS":
+        return preflight_response()
+
+    files = await request.files
+    form = await request.form
+    if "file" not in files:
+        return jsonify({"error": "No file provided"}), 400
+
+    pdf_file = files["file"]
+    if not pdf_file.filename:
+        return jsonify({"error": "File has no filename"}), 400
+
+    try:
+        options = parse_extraction_options(form, ASYNC_PROVIDERS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    document_type, chunk_mode, rule_mode = options["document_type"], options["chunk_mode"], options["rule_mode"]
+
+    debug = debug_requested(form, request.args)
+    stream_partial = form.get('partial', 'false').lower() == 'true'
+    trace = RequestTrace()
+    with trace.span("upload") as span:
+        pdf_source, file_hash = await asyncio.to_thread(read_upload, pdf_file.stream)
+        span["spooled"] = isinstance(pdf_source, str)
+
+    async def generate():
+        start = time.monotonic()
+        try:
+            pages, normalization = await extract_and_normalize(pdf_source, file_hash, options["normalizers"], trace)
+            pdf_text = "".join(pages)
+            yield sse_event("text_extracted", {
+                "pages": len(pages),
+                "characters": len(pdf_text),
+                "normalization": normalization,
+                "elapsed_seconds": round(time.monotonic() - start, 3)
+            })
+
+            rules = await aextract_rule_fields(document_type, pdf_text, rule_mode, trace=trace)
+            if rules is not None:
+                yield sse_event("rules", rules_report(rules, rule_mode))
+
+            errors = {}
+            results = {}
+            model_args = (document_type, pdf_text, file_hash, options["providers"], pages, chunk_mode, trace, rules, rule_mode)
+            if stream_partial:
+                events = aiter_model_events(*model_args)
+            else:
+                events = (("result", *result) async for result in aiter_model_results(*model_args))
+            async for event in events:
+                if event[0] == "partial":
+                    _, model_name, update = event
+                    yield sse_event("model_partial", {"model": model_name, **update, "elapsed_seconds": round(time.monotonic() - start, 3)})
+                    continue
+                _, model_name, data, usage = event
+                results[model_name] = data
+                if isinstance(data, dict) and set(data) == {"error"}:
+                    errors[model_name] = data["error"]
+                yield sse_event("model_result", {
+                    "model": model_name,
+                    "data": data,
+                    "usage": usage,
+                    "elapsed_seconds": round(time.monotonic() - start, 3)
+                })
+
+            await asyncio.to_thread(results_store.write, file_hash, pdf_file.filename, document_type, results, "process-pdf-stream")
+            summary = {
+                "success": True,
+                "models": list(results),
+                "errors": errors,
+                "elapsed_seconds": round(time.monotonic() - start, 3)
+            }
+            if debug:
+                summary["timing"] = trace.summary()
+            yield sse_event("summary", summary)
+        except Exception as e:
+            logger.error(f"Error processing streaming request: {str(e)}", exc_info=True)
+            yield sse_event("error", {"error": str(e)})
+        finally:
+            # Covers a client that disconnects before extraction finishes
+            discard_upload(pdf_source)
+
+    response = Response(generate(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+# ------------- BACKGROUND JOBS -------------
+@app.route("/api/jobs", methods=["POST", "OPTIONS"])
+async def submit_job():
+    """
+    Same as /api/jobs in app.py. The jobs run on worker threads with the blocking provider clients.
+    """
+    if request.method == "OPTIONS":
+        return preflight_response()
+
+    files = await request.files
+    form = await request.form
+    if "file" not in files:
+        return jsonify({"error": "No file provided"}), 400
+
+    pdf_file = files["file"]
+    if not pdf_file.filename:
+        return jsonify({"error": "File has no filename"}), 400
+
+    try:
+        options = parse_extraction_options(form, ASYNC_PROVIDERS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    pdf_source, file_hash = await asyncio.to_thread(read_upload, pdf_file.stream)
+    try:
+        # Writes the PDF and waits on the SQLite lock, so it runs off the event loop
+        job, created = await asyncio.to_thread(get_job_queue().submit, pdf_source, file_hash, pdf_file.filename,
+                                               job_options(options))
+    finally:
+        discard_upload(pdf_source)
+    if created:
+        get_job_workers().notify()
+    return jsonify({"success": True, "job": job, "deduplicated": not created}), 202 if created else 200
+
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+async def get_job(job_id):
+    job = await asyncio.to_thread(get_job_queue().get, job_id)
+    if job is None:
+        return jsonify({"error": "No such job"}), 404
+    return jsonify({"success": True, "job": job})
+
+
+@app.route("/api/jobs/<job_id>/events", methods=["GET"])
+async def get_job_events(job_id):
+    """
+    Same Server-Sent Events as /api/jobs/<job_id>/events in app.py.
+    """
+    job_queue = get_job_queue()
+    if await asyncio.to_thread(job_queue.get, job_id) is None:
+        return jsonify({"error": "No such job"}), 404
+
+    async def generate():
+        last_state = None
+        while True:
+            job = await asyncio.to_thread(job_queue.get, job_id)
+            state = (job["status"], job["stage"], len(job["completed_stages"]))
+            if state != last_state:
+                last_state = state
+                yield sse_event(job["status"] if job["status"] in ("done", "error") else "status", job)
+            if job["status"] in ("done", "error"):
+                return
+            await asyncio.sleep(JOB_EVENTS_POLL_SECONDS)
+
+    response = Response(generate(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+# ------------- STORED RESULTS -------------
+@app.route("/api/results", methods=["GET"])
+async def get_results():
+    """
+    Same as /api/results in app.py.
+    """
+    try:
+        params = parse_result_filters(request.args)
+        results = await asyncio.to_thread(results_store.query, params["filters"], limit=params["limit"], offset=params["offset"])
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"success": True, "results": results})
+
+
+@app.route("/api/results/duplicates", methods=["GET"])
+async def get_duplicate_results():
+    try:
+        limit = int(request.args.get('limit', '100'))
+    except ValueError:
+        return jsonify({"error": "limit must be a whole number"}), 400
+    duplicates = await asyncio.to_thread(results_store.duplicates, request.args.get('file_hash'), limit=limit)
+    return jsonify({"success": True, "duplicates": duplicates})
+
+
+@app.route("/api/results/export", methods=["GET"])
+async def export_results():
+    """
+    Same as /api/results/export in app.py. Each batch of rows is read on a thread, off the event loop.
+    """
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ("ndjson", "csv"):
+        return jsonify({"error": "format must be ndjson or csv"}), 400
+    try:
+        filters = parse_result_filters(request.args)["filters"]
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    lines = results_store.export_ndjson(filters) if export_format == "ndjson" else results_store.export_csv(filters)
+
+    async def generate():
+        try:
+            while True:
+                batch = await asyncio.to_thread(list, islice(lines, EXPORT_BATCH_ROWS))
+                if not batch:
+                    break
+                yield "".join(batch)
+        finally:
+            lines.close()
+
+    mimetype = "application/x-ndjson" if export_format == "ndjson" else "text/csv"
+    response = Response(generate(), mimetype=mimetype)
+    response.headers["Content-Disposition"] = f"attachment; filename=results.{export_format}"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+# ------------- CACHE STATS -------------
+@app.route("/api/cache-stats", methods=["GET"])
+async def get_cache_stats():
+    return jsonify({"success": True, "cache": extraction_cache.stats()})
+
+# ------------- PROVIDER STATS -------------
+@app.route("/api/provider-stats", methods=["GET"])
+async def get_provider_stats():
+    return jsonify({"success": True, "providers": provider_stats(ASYNC_PROVIDER_SCHEDULERS)})
+
+# ------------- METRICS -------------
+REGISTRY.add_collector(collect_cache_metrics)
+REGISTRY.add_collector(provider_metrics_collector(ASYNC_PROVIDER_SCHEDULERS))
+
+
+@app.route("/metrics", methods=["GET"])
+async def get_metrics():
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+# ------------- MODEL SELECTION -------------
+@app.route("/api/models", methods=["GET"])
+async def get_models():
+    return jsonify({"success": True, "models": list(ASYNC_PROVIDERS)})
+
+# ------------- DOCUMENT TYPE SELECTION -------------
+@app.route("/api/document-types", methods=["GET"])
+async def get_document_types():
+    return jsonify({"success": True, "document_types": list(system_prompts.keys())})
+
+if __name__ == "__main__":
+    app.run(port=3000, host="0.0.0.0")
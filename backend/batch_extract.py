@@ -0,0 +1,78 @@
+"""
+Extract every PDF in a directory, e.g.
+
+    python batch_extract.py inputs/invoices --type invoice --extract-workers 4 --llm-workers 8
+
+Results are written to outputs/json/ as each document finishes. Documents that already have an
+output for the same file are skipped, so an interrupted run can simply be started again.
+"""
+import os
+import sys
+import argparse
+from utils.chunking import CHUNK_MODES
+from utils.normalize import parse_normalizers
+from utils.batch import BatchScheduler, DEFAULT_OUTPUT_DIR, BATCH_EXTRACT_WORKERS, BATCH_LLM_WORKERS, find_pdfs
+from utils.providers import select_providers
+from utils.rule_extraction import DEFAULT_RULE_MODE, RULE_MODES
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Extract data from every PDF in a directory.")
+    parser.add_argument("directory", help="Directory containing the PDF files")
+    parser.add_argument("--type", default="invoice", help="Document type (default: invoice)")
+    parser.add_argument("--output-dir", default=DEFAULT_OUTPUT_DIR, help="Where to write the JSON results")
+    parser.add_argument("--extract-workers", type=int, default=BATCH_EXTRACT_WORKERS,
+                        help="Documents in the extraction stage at the same time; their parsing and OCR run on OCR_WORKERS processes")
+    parser.add_argument("--llm-workers", type=int, default=BATCH_LLM_WORKERS,
+                        help="Documents sent to the models at the same time")
+    parser.add_argument("--chunk-mode", default="auto", choices=CHUNK_MODES,
+                        help="Extract long invoices in chunks (default: auto)")
+    parser.add_argument("--rules", default=DEFAULT_RULE_MODE, choices=RULE_MODES,
+                        help="Rule-based extraction: skip the models when it finds every required field, "
+                             "or fill only the missing fields with them (default: %(default)s)")
+    parser.add_argument("--normalize", default=None,
+                        help="Comma-separated normalization steps, \"default\" or \"none\" (default: the default steps)")
+    parser.add_argument("--models", default=None,
+                        help="Comma-separated providers to run, e.g. openai,anthropic (default: every enabled provider)")
+    parser.add_argument("--recursive", action="store_true", help="Also process PDFs in subdirectories")
+    parser.add_argument("--overwrite", action="store_true", help="Re-process documents that already have results")
+    args = parser.parse_args(argv)
+    try:
+        providers = select_providers(args.models)
+        normalizers = parse_normalizers(args.normalize)
+    except ValueError as e:
+        parser.error(str(e))
+
+    paths = find_pdfs(args.directory, recursive=args.recursive)
+    if not paths:
+        print(f"No PDF files found in {args.directory}", file=sys.stderr)
+        return 1
+
+    scheduler = BatchScheduler(
+        document_type=args.type,
+        output_dir=args.output_dir,
+        extract_workers=args.extract_workers,
+        llm_workers=args.llm_workers,
+        overwrite=args.overwrite,
+        chunk_mode=args.chunk_mode,
+        rule_mode=args.rules,
+        providers=providers,
+        normalizers=normalizers
+    )
+
+    failed = 0
+    # Named by their path under the directory, so a.pdf in two subdirectories gets two outputs
+    documents = ((os.path.relpath(path, args.directory), path) for path in paths)
+    for finished, result in enumerate(scheduler.run(documents), start=1):
+        if result["status"] == "error":
+            failed += 1
+            print(f"[{finished}/{len(paths)}] error   {result['source']}: {result['error']}")
+        else:
+            failed_note = f" (failed, retried next run: {', '.join(result['failed_models'])})" if result.get("failed_models") else ""
+            print(f"[{finished}/{len(paths)}] {result['status']:<7} {result['source']} -> {result['output']}{failed_note}")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
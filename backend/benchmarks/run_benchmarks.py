@@ -0,0 +1,396 @@
+"""
+Offline benchmarks for the extraction pipeline. From backend/:
+
+    python -m benchmarks.run_benchmarks --clients 1,4,16 --requests 5
+    python -m benchmarks.run_benchmarks --compare benchmarks/results/<previous run>.json
+
+The model providers are replaced by a local stub server (see stub_llm_server.py) with configurable
+latency, jitter and error rate, so runs need no API keys or network and are repeatable. The
+extraction cache is turned off so every request does the full work, and the results store and job
+queue are kept in a temp directory, so a run leaves no state behind.
+
+Three sets of numbers are reported:
+- stages: time for each pipeline step on its own (text extraction, OCR, normalization, prompt
+  building, chunking, JSON parsing) over synthetic invoices
+- invoices: text extraction, normalization and prompt building for each real invoice in
+  inputs/invoices/
+- end_to_end: /api/process-pdf through the Flask test client at each concurrency level, with
+  p50/p95/p99 latency, throughput and error counts, for the synthetic invoice and for the real ones
+
+A run in which any request failed, or any model returned an error, exits with status 1, since its
+latencies don't measure the full pipeline; pass --allow-errors when injecting errors on purpose.
+
+Results are written as JSON to benchmarks/results/. With --compare, each latency and throughput
+figure is checked against an earlier result file and regressions beyond --threshold are flagged
+(the exit status is 1 if there are any).
+"""
+import os
+import io
+import sys
+import json
+import math
+import time
+import shutil
+import logging
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timezone
+from itertools import cycle
+
+# The repo's modules log at DEBUG; configure the root logger first so benchmark output stays readable
+logging.basicConfig(level=logging.WARNING)
+
+from benchmarks.stub_llm_server import StubConfig, start_stub_server, stub_environment
+from benchmarks.synthetic_pdfs import make_text_invoice, make_scanned_invoice
+from utils.chunking import CHUNK_MODES
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+INVOICES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "inputs", "invoices")
+
+
+def percentile(values: list[float], pct: float) -> float:
+    """
+    Nearest-rank percentile of a list of numbers.
+    """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies: list[float]) -> dict:
+    return {
+        "count": len(latencies),
+        "mean_ms": round(1000 * sum(latencies) / len(latencies), 2) if latencies else 0.0,
+        "p50_ms": round(1000 * percentile(latencies, 50), 2),
+        "p95_ms": round(1000 * percentile(latencies, 95), 2),
+        "p99_ms": round(1000 * percentile(latencies, 99), 2),
+    }
+
+
+def time_stage(fn, iterations: int) -> dict:
+    fn()  # warm-up, so one-off imports and pool start-up aren't measured
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies)
+
+
+def peak_rss_mb() -> dict:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1),
+    }
+
+
+def ocr_available() -> bool:
+    return bool(shutil.which("tesseract") and shutil.which("pdftoppm"))
+
+
+def run_stage_benchmarks(args) -> dict:
+    from utils.pdf_extraction import extract_pages_from_pdf
+    from utils.normalize import normalize_pages
+    from utils.prompts import get_prompts
+    from utils.chunking import split_into_chunks
+    from utils.extract_json import IncrementalJSONParser, extract_json_from_response
+    from benchmarks.stub_llm_server import SAMPLE_INVOICE, STREAM_CHUNK_CHARS
+
+    text_pdf = make_text_invoice(pages=args.pages, items_per_page=args.items_per_page, seed=args.seed)
+    pages = extract_pages_from_pdf(text_pdf)
+    normalized, _ = normalize_pages(pages)
+    pdf_text = "".join(normalized)
+    response = json.dumps(SAMPLE_INVOICE, indent=2)
+    # The response as a provider streams it, for the incremental parser
+    response_pieces = [response[index:index + STREAM_CHUNK_CHARS] for index in range(0, len(response), STREAM_CHUNK_CHARS)]
+
+    def parse_streamed():
+        parser = IncrementalJSONParser()
+        for piece in response_pieces:
+            parser.feed(piece)
+        return parser.fields
+
+    stages = {
+        "extract_text": time_stage(lambda: extract_pages_from_pdf(text_pdf), args.stage_iterations),
+        "normalize": time_stage(lambda: normalize_pages(pages), args.stage_iterations),
+        "build_prompts": time_stage(lambda: get_prompts(args.type, pdf_text), args.stage_iterations),
+        "split_chunks": time_stage(lambda: split_into_chunks(normalized), args.stage_iterations),
+        "parse_json": time_stage(lambda: extract_json_from_response(response), args.stage_iterations),
+        "parse_json_streamed": time_stage(parse_streamed, args.stage_iterations),
+    }
+
+    if not args.skip_ocr and ocr_available():
+        scanned_pdf = make_scanned_invoice(pages=args.scanned_pages, seed=args.seed)
+        stages["ocr"] = time_stage(lambda: extract_pages_from_pdf(scanned_pdf), max(1, args.stage_iterations // 10))
+    elif not args.skip_ocr:
+        print("Skipping OCR benchmark: tesseract or pdftoppm is not installed", file=sys.stderr)
+    return stages
+
+
+def load_invoices(directory: str, allow_ocr: bool) -> list[tuple[str, bytes]]:
+    """
+    The (file name, PDF bytes) of every PDF in directory, sorted by name. PDFs with pages that need
+    OCR are left out unless allow_ocr is set.
+    """
+    from utils.pdf_extraction import extract_text_layer, pages_needing_ocr
+
+    if not os.path.isdir(directory):
+        return []
+    invoices = []
+    for name in sorted(name for name in os.listdir(directory) if name.lower().endswith(".pdf")):
+        with open(os.path.join(directory, name), "rb") as f:
+            pdf_bytes = f.read()
+        if not allow_ocr and pages_needing_ocr(extract_text_layer(pdf_bytes)):
+            print(f"Skipping {name}: it needs OCR", file=sys.stderr)
+            continue
+        invoices.append((name, pdf_bytes))
+    return invoices
+
+
+def run_invoice_benchmarks(args, invoices: list[tuple[str, bytes]]) -> dict:
+    """
+    Time text extraction (with OCR for pages that need it), normalization and prompt building for
+    each real invoice.
+    """
+    from utils.pdf_extraction import extract_pages_from_pdf
+    from utils.normalize import normalize_pages
+    from utils.prompts import get_prompts
+
+    results = {}
+    for name, pdf_bytes in invoices:
+        stats = {}
+        pages = extract_pages_from_pdf(pdf_bytes, stats)
+        normalized, _ = normalize_pages(pages)
+        pdf_text = "".join(normalized)
+        stem = os.path.splitext(name)[0]
+        results[f"{stem}.extract_text"] = {**time_stage(lambda: extract_pages_from_pdf(pdf_bytes), args.stage_iterations),
+                                           "pages": len(pages), "ocr_pages": stats["ocr_pages"]}
+        results[f"{stem}.normalize"] = time_stage(lambda: normalize_pages(pages), args.stage_iterations)
+        results[f"{stem}.build_prompts"] = time_stage(lambda: get_prompts(args.type, pdf_text), args.stage_iterations)
+    return results
+
+
+def run_load(test_client_factory, documents: list[tuple[str, bytes]], clients: int, requests_per_client: int, form: dict) -> dict:
+    """
+    POST PDFs to /api/process-pdf from `clients` threads at once, each sending requests_per_client
+    requests and cycling through the (file name, PDF bytes) documents.
+    """
+    latencies, errors = [], []
+    cache = {"input_tokens": 0, "cache_read_input_tokens": 0, "cache_creation_input_tokens": 0}
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(clients)
+
+    def worker():
+        client = test_client_factory()
+        start_barrier.wait()
+        for _, (name, pdf_bytes) in zip(range(requests_per_client), cycle(documents)):
+            start = time.perf_counter()
+            response = client.post(
+                "/api/process-pdf",
+                data={**form, "file": (io.BytesIO(pdf_bytes), name)},
+                content_type="multipart/form-data"
+            )
+            elapsed = time.perf_counter() - start
+            body = response.get_json(silent=True) or {}
+            model_errors = [name for name, data in (body.get("data") or {}).items()
+                            if isinstance(data, dict) and "error" in data]
+            with lock:
+                latencies.append(elapsed)
+                for usage in (body.get("usage") or {}).values():
+                    for kind in cache:
+                        cache[kind] += usage.get(kind, 0)
+                if response.status_code != 200:
+                    errors.append(f"HTTP {response.status_code}")
+                errors.extend(f"model {name}" for name in model_errors)
+
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    wall_start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - wall_start
+
+    return {
+        **summarize(latencies),
+        "clients": clients,
+        "throughput_rps": round(len(latencies) / wall, 3) if wall else 0.0,
+        "errors": len(errors),
+        "error_kinds": sorted(set(errors)),
+        # Prompt tokens the stub reported as uncached, read from its prompt cache, and written to it
+        "usage": cache,
+    }
+
+
+def run_end_to_end_benchmarks(args, invoices: list[tuple[str, bytes]]) -> dict:
+    from app import app
+
+    pdf_bytes = make_text_invoice(pages=args.pages, items_per_page=args.items_per_page, seed=args.seed)
+    form = {"type": args.type, "chunk_mode": args.chunk_mode}
+    workloads = {"clients": [("benchmark.pdf", pdf_bytes)]}
+    if invoices:
+        workloads["invoices_clients"] = invoices
+    results = {}
+    for prefix, documents in workloads.items():
+        for clients in args.clients:
+            result = run_load(app.test_client, documents, clients, args.requests, form)
+            results[f"{prefix}_{clients}"] = result
+            print(f"  {prefix} {clients:>3}: p50 {result['p50_ms']}ms, {result['throughput_rps']} req/s, "
+                  f"{result['errors']} errors", file=sys.stderr)
+    return results
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Metrics compared between runs, and whether higher is better
+COMPARED_METRICS = {"p50_ms": False, "p95_ms": False, "p99_ms": False, "throughput_rps": True}
+
+
+def compare_results(previous: dict, current: dict, threshold: float) -> list[str]:
+    """
+    Print the change in every compared metric and return the ones that regressed by more than threshold.
+    """
+    regressions = []
+    for section in ("stages", "invoices", "end_to_end"):
+        for name, metrics in current.get(section, {}).items():
+            before = previous.get(section, {}).get(name)
+            if not before:
+                continue
+            for metric, higher_is_better in COMPARED_METRICS.items():
+                if metric not in metrics or not before.get(metric):
+                    continue
+                change = (metrics[metric] - before[metric]) / before[metric]
+                regressed = (-change if higher_is_better else change) > threshold
+                flag = "  REGRESSION" if regressed else ""
+                print(f"{section}.{name}.{metric}: {before[metric]} -> {metrics[metric]} ({change:+.1%}){flag}")
+                if regressed:
+                    regressions.append(f"{section}.{name}.{metric}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the extraction pipeline against stub providers.")
+    parser.add_argument("--clients", default="1,4,16", help="Comma-separated concurrency levels (default: 1,4,16)")
+    parser.add_argument("--requests", type=int, default=5, help="Requests sent by each client (default: 5)")
+    parser.add_argument("--stage-iterations", type=int, default=20, help="Timed runs of each stage (default: 20)")
+    parser.add_argument("--pages", type=int, default=5, help="Pages in the synthetic invoice (default: 5)")
+    parser.add_argument("--items-per-page", type=int, default=40)
+    parser.add_argument("--scanned-pages", type=int, default=2, help="Pages in the synthetic scanned invoice")
+    parser.add_argument("--skip-ocr", action="store_true", help="Don't benchmark OCR")
+    parser.add_argument("--invoices-dir", default=INVOICES_DIR,
+                        help="Real invoices to benchmark, besides the synthetic ones (default: inputs/invoices)")
+    parser.add_argument("--allow-errors", action="store_true",
+                        help="Exit with status 0 even if requests failed, e.g. with --error-rate beyond what retries absorb")
+    parser.add_argument("--type", default="invoice", help="Document type (default: invoice)")
+    parser.add_argument("--chunk-mode", default="auto", choices=CHUNK_MODES)
+    parser.add_argument("--latency-ms", type=float, default=500, help="Stub provider latency (default: 500)")
+    parser.add_argument("--jitter-ms", type=float, default=100, help="Stub provider latency jitter (default: 100)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of stub calls failing with 429/500")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Where to write the results (default: benchmarks/results/<timestamp>.json)")
+    parser.add_argument("--compare", help="Earlier result file to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Relative change flagged as a regression (default: 0.10)")
+    args = parser.parse_args(argv)
+    args.clients = [int(value) for value in args.clients.split(",") if value.strip()]
+    return args
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+
+    stub_config = StubConfig(args.latency_ms, args.jitter_ms, args.error_rate, args.seed)
+    stub = start_stub_server(stub_config)
+    run_dir = tempfile.mkdtemp(prefix="benchmark-")
+    # Must be set before the app and providers are imported, since they read it at import time
+    os.environ.update(stub_environment(stub))
+    os.environ.update({
+        "EXTRACTION_CACHE_ENABLED": "false",
+        "EXTRACTION_CACHE_PATH": os.path.join(run_dir, "cache", "cache.sqlite3"),
+        # Keep the run's stored results and jobs out of outputs/, and don't run job workers
+        "RESULTS_DB_PATH": os.path.join(run_dir, "results", "results.sqlite3"),
+        "JOBS_DIR": os.path.join(run_dir, "jobs"),
+        "JOB_WORKERS": "0",
+    })
+    # Provider quotas would measure the rate limiter rather than the pipeline
+    for provider in ("deepseek", "openai", "anthropic"):
+        os.environ.setdefault(f"{provider.upper()}_RPM", "none")
+        os.environ.setdefault(f"{provider.upper()}_TPM", "none")
+
+    try:
+        started_at = datetime.now(timezone.utc)
+        print("Timing pipeline stages...", file=sys.stderr)
+        stages = run_stage_benchmarks(args)
+        invoices = load_invoices(args.invoices_dir, allow_ocr=not args.skip_ocr and ocr_available())
+        if invoices:
+            print(f"Timing {len(invoices)} invoices from {args.invoices_dir}...", file=sys.stderr)
+        else:
+            print(f"No invoices found in {args.invoices_dir}", file=sys.stderr)
+        invoice_stages = run_invoice_benchmarks(args, invoices)
+        print("Running end-to-end load...", file=sys.stderr)
+        end_to_end = run_end_to_end_benchmarks(args, invoices)
+    finally:
+        stub.shutdown()
+        shutil.rmtree(run_dir, ignore_errors=True)
+    errors = sum(result["errors"] for result in end_to_end.values())
+
+    results = {
+        "metadata": {
+            "started_at": started_at.isoformat(),
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "config": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+            "stub_requests": stub_config.requests,
+            "stub_errors": stub_config.errors,
+            "request_errors": errors,
+        },
+        "stages": stages,
+        "invoices": invoice_stages,
+        "end_to_end": end_to_end,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+    output = args.output or os.path.join(RESULTS_DIR, started_at.strftime("%Y%m%dT%H%M%SZ") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps({"stages": stages, "invoices": invoice_stages, "end_to_end": end_to_end,
+                      "peak_rss_mb": results["peak_rss_mb"]}, indent=2))
+    print(f"Results written to {output}", file=sys.stderr)
+
+    failed = False
+    if errors:
+        kinds = sorted({kind for result in end_to_end.values() for kind in result["error_kinds"]})
+        print(f"ERRORS: {errors} request(s) failed or had a model error ({', '.join(kinds)}); their latencies "
+              "don't measure the full pipeline", file=sys.stderr)
+        failed = not args.allow_errors
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        regressions = compare_results(previous, results, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.threshold:.0%}: {', '.join(regressions)}", file=sys.stderr)
+            return 1
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
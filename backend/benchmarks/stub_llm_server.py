@@ -0,0 +1,287 @@
+"""
+A local HTTP server that stands in for the model providers during benchmarks.
+
+It answers the three APIs the backend calls, with the same response shapes:
+    POST /v1/chat/completions   OpenAI (set OPENAI_BASE_URL=http://host:port/v1)
+    POST /chat/completions      Azure AI inference / DeepSeek (set DEEPSEEK_ENDPOINT=http://host:port)
+    POST /v1/messages           Anthropic (set ANTHROPIC_BASE_URL=http://host:port)
+
+Every response returns a canned invoice JSON after a configurable latency with jitter, and a
+configurable share of requests fail with 429 or 500. Requests with "stream": true get the invoice
+as Server-Sent Events in the provider's streaming format, a few characters per event. Prompt
+caching is emulated for Anthropic and OpenAI: a cacheable prefix (the system blocks up to the last
+cache_control for Anthropic, the system message for OpenAI) of at least PROMPT_CACHE_MIN_TOKENS
+tokens is reported as written to the cache the first time it is seen and as read from it afterwards,
+the way the real APIs report it. Shorter prefixes are never cached. Run it on its own with
+    python -m benchmarks.stub_llm_server --port 8089 --latency-ms 800 --jitter-ms 200 --error-rate 0.05
+"""
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from utils.prompts import PROMPT_CACHE_MIN_TOKENS
+from utils.token_utils import count_tokens
+
+# Characters of the response sent in each streamed event
+STREAM_CHUNK_CHARS = 16
+
+SAMPLE_INVOICE = {
+    "vendor_name": "Benchmark Supply Co",
+    "invoice_date": "3/3/2025",
+    "due_date": "4/2/2025",
+    "ship_date": None,
+    "invoice_number": "INV-10042",
+    "vendor_order_number": "SO4237",
+    "account_number": "836",
+    "po_number": "24-DPA3-023",
+    "terms": "Net 30",
+    "banking_info": None,
+    "currency": "USD",
+    "bill_to_address": {
+        "company_name": "Source",
+        "address_line_1": "921 SW Washington St",
+        "address_line_2": "Suite 518",
+        "city": "Portland",
+        "state": "OR",
+        "zip": "97205"
+    },
+    "ship_to_address": None,
+    "invoice_items": [
+        {
+            "spec_tag": f"FB-{800 + index}",
+            "description": f"Dining chair cushion set {index}",
+            "quantity": 2,
+            "units": "EA",
+            "overage": None,
+            "unit_price": 288.64,
+            "discount": None,
+            "extended_price": 577.28,
+            "fob": "Hickory, NC"
+        }
+        for index in range(10)
+    ],
+    "subtotal": 5772.80,
+    "packing_fee": None,
+    "freight": 150.00,
+    "sales_tax": 0.00,
+    "sales_tax_rate": None,
+    "total": 5922.80,
+    "prepayment": 2961.40,
+    "balance_due": 2961.40
+}
+
+
+class StubConfig:
+    def __init__(self, latency_ms: float = 500, jitter_ms: float = 100, error_rate: float = 0.0, seed: int | None = None):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.cached_prefixes = set()
+
+    def next_outcome(self) -> tuple[float, int | None]:
+        # A seeded generator shared under a lock keeps runs with the same seed reproducible
+        with self.lock:
+            self.requests += 1
+            delay = max(0.0, self.latency_ms + self.random.uniform(-self.jitter_ms, self.jitter_ms)) / 1000
+            status = None
+            if self.random.random() < self.error_rate:
+                status = self.random.choice([429, 500])
+                self.errors += 1
+            return delay, status
+
+    def prompt_cache(self, path: str, prefix: str) -> tuple[int, int]:
+        """
+        Tokens of a cacheable prompt prefix read from and written to the emulated cache of the API at
+        path: (read, written). Each API has a cache of its own.
+        """
+        tokens = count_tokens(prefix) if prefix else 0
+        if tokens < PROMPT_CACHE_MIN_TOKENS:
+            return 0, 0
+        with self.lock:
+            if (path, prefix) in self.cached_prefixes:
+                return tokens, 0
+            self.cached_prefixes.add((path, prefix))
+            return 0, tokens
+
+
+def cacheable_prefix(path: str, body: dict) -> str:
+    """
+    The part of a request's prompt the provider would cache: for Anthropic the system blocks up to
+    the last one marked with cache_control, for OpenAI the system message. DeepSeek isn't cached.
+    """
+    if path.endswith("/messages"):
+        system = body.get("system")
+        if not isinstance(system, list):
+            return ""
+        marked = [index for index, block in enumerate(system) if block.get("cache_control")]
+        return "".join(block.get("text", "") for block in system[:marked[-1] + 1]) if marked else ""
+    if path.startswith("/v1/"):
+        messages = body.get("messages") or []
+        if messages and messages[0].get("role") == "system" and isinstance(messages[0].get("content"), str):
+            return messages[0]["content"]
+    return ""
+
+
+def make_handler(config: StubConfig):
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+            delay, status = config.next_outcome()
+            time.sleep(delay)
+
+            if status is not None:
+                self._send(status, {"error": {"type": "stub_error", "message": f"Stub returned {status}"}}, {"retry-after": "0"})
+                return
+
+            path = self.path.split("?")[0]
+            content = json.dumps(SAMPLE_INVOICE)
+            prompt_chars = len(json.dumps(body.get("messages", []))) + len(json.dumps(body.get("system", "")))
+            input_tokens, output_tokens = prompt_chars // 4, len(content) // 4
+            cache_read, cache_written = config.prompt_cache(path, cacheable_prefix(path, body))
+            if path.endswith("/messages"):
+                # Anthropic's input_tokens only counts the prompt tokens that weren't cached
+                input_tokens = max(0, input_tokens - cache_read - cache_written)
+                usage = {"input_tokens": input_tokens, "output_tokens": output_tokens,
+                         "cache_read_input_tokens": cache_read, "cache_creation_input_tokens": cache_written}
+            else:
+                # OpenAI counts cached tokens in 128-token steps, as part of prompt_tokens
+                usage = {"prompt_tokens": input_tokens, "completion_tokens": output_tokens,
+                         "total_tokens": input_tokens + output_tokens,
+                         "prompt_tokens_details": {"cached_tokens": cache_read // 128 * 128}}
+
+            if body.get("stream"):
+                self._stream(path, body, content, usage)
+            elif path.endswith("/messages"):
+                self._send(200, {
+                    "id": "msg_stub",
+                    "type": "message",
+                    "role": "assistant",
+                    "model": body.get("model", "stub"),
+                    "content": [{"type": "text", "text": content}],
+                    "stop_reason": "end_turn",
+                    "stop_sequence": None,
+                    "usage": usage
+                })
+            elif path.endswith("/chat/completions"):
+                self._send(200, {
+                    "id": "chatcmpl-stub",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": body.get("model", "stub"),
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop"
+                    }],
+                    "usage": usage
+                })
+            else:
+                self._send(404, {"error": {"message": f"Unknown path {path}"}})
+
+        def _stream(self, path: str, body: dict, content: str, usage: dict):
+            pieces = [content[index:index + STREAM_CHUNK_CHARS] for index in range(0, len(content), STREAM_CHUNK_CHARS)]
+            if path.endswith("/messages"):
+                events = [("message_start", {"type": "message_start", "message": {
+                    "id": "msg_stub", "type": "message", "role": "assistant", "model": body.get("model", "stub"),
+                    "content": [], "stop_reason": None, "stop_sequence": None,
+                    "usage": {**usage, "output_tokens": 1}}}),
+                    ("content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})]
+                events += [("content_block_delta", {"type": "content_block_delta", "index": 0,
+                                                    "delta": {"type": "text_delta", "text": piece}}) for piece in pieces]
+                events += [("content_block_stop", {"type": "content_block_stop", "index": 0}),
+                           ("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                                              "usage": {"output_tokens": usage["output_tokens"]}}),
+                           ("message_stop", {"type": "message_stop"})]
+            elif path.endswith("/chat/completions"):
+                def chunk(delta, finish_reason=None, usage=None):
+                    return None, {"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                                  "model": body.get("model", "stub"),
+                                  "choices": [] if delta is None else [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                                  "usage": usage}
+                events = [chunk({"role": "assistant", "content": ""})]
+                events += [chunk({"content": piece}) for piece in pieces]
+                events.append(chunk({}, "stop"))
+                events.append(chunk(None, usage=usage))
+                events.append((None, "[DONE]"))
+            else:
+                self._send(404, {"error": {"message": f"Unknown path {path}"}})
+                return
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+            for event, data in events:
+                payload = data if isinstance(data, str) else json.dumps(data)
+                self.wfile.write(((f"event: {event}\n" if event else "") + f"data: {payload}\n\n").encode("utf-8"))
+                self.wfile.flush()
+
+        def _send(self, status: int, payload: dict, headers: dict | None = None):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubHandler
+
+
+def start_stub_server(config: StubConfig, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """
+    Start the stub server on a background thread and return it; port 0 picks a free port.
+    """
+    server = ThreadingHTTPServer((host, port), make_handler(config))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name="stub-llm-server").start()
+    return server
+
+
+def stub_environment(server: ThreadingHTTPServer) -> dict:
+    """
+    Environment variables that point every provider client at the stub server.
+    """
+    host, port = server.server_address[:2]
+    base_url = f"http://{host}:{port}"
+    return {
+        "OPENAI_BASE_URL": base_url + "/v1",
+        "OPENAI_API_KEY": "stub",
+        "ANTHROPIC_BASE_URL": base_url,
+        "ANTHROPIC_API_KEY": "stub",
+        "DEEPSEEK_ENDPOINT": base_url,
+        "GITHUB_TOKEN": "stub",
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the stub LLM provider server.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--latency-ms", type=float, default=500)
+    parser.add_argument("--jitter-ms", type=float, default=100)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server = start_stub_server(StubConfig(args.latency_ms, args.jitter_ms, args.error_rate, args.seed), args.host, args.port)
+    for key, value in stub_environment(server).items():
+        print(f"export {key}={value}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,105 @@
+"""
+Generate synthetic invoice PDFs for benchmarking, without any PDF-writing dependency.
+
+make_text_invoice() writes a multi-page invoice with a real text layer, so PyPDF2 can read it.
+make_scanned_invoice() renders the same text to images with Pillow, so every page needs OCR.
+"""
+import io
+import random
+
+
+def invoice_lines(pages: int, items_per_page: int = 40, seed: int = 0) -> list[list[str]]:
+    """
+    Return the text lines of each page of a synthetic invoice.
+    """
+    rng = random.Random(seed)
+    result = []
+    item = 0
+    for page in range(pages):
+        lines = ["Benchmark Supply Co", f"Invoice INV-10042    Page {page + 1} of {pages}"]
+        if page == 0:
+            lines += [
+                "Invoice Date: 3/3/2025    Due Date: 4/2/2025    Terms: Net 30",
+                "Bill To: Source, 921 SW Washington St, Suite 518, Portland, OR 97205",
+                "PO: 24-DPA3-023    Sales Order: SO4237    Account: 836",
+                "Spec Tag   Description                         Qty  Unit  Unit Price  Extended",
+            ]
+        for _ in range(items_per_page):
+            item += 1
+            quantity = rng.randint(1, 12)
+            price = rng.randint(1000, 90000) / 100
+            lines.append(
+                f"FB-{800 + item:<6} Dining chair cushion set {item:<10} {quantity:>3}  EA  "
+                f"${price:,.2f}  ${quantity * price:,.2f}"
+            )
+        if page == pages - 1:
+            lines += ["Subtotal: $5,772.80", "Freight: $150.00", "Total: $5,922.80", "Balance Due: $2,961.40"]
+        result.append(lines)
+    return result
+
+
+def _escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def _write_pdf(objects: list[bytes]) -> bytes:
+    """
+    Serialize numbered PDF objects (object 1 must be the catalog) with a valid xref table.
+    """
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(f"{number} 0 obj\n".encode() + body + b"\nendobj\n")
+    xref = out.tell()
+    out.write(f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode())
+    for offset in offsets:
+        out.write(f"{offset:010d} 00000 n \n".encode())
+    out.write(f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode())
+    return out.getvalue()
+
+
+def _stream(data: bytes, extra: str = "") -> bytes:
+    return f"<< /Length {len(data)}{extra} >>\nstream\n".encode() + data + b"\nendstream"
+
+
+def make_text_invoice(pages: int = 5, items_per_page: int = 40, seed: int = 0) -> bytes:
+    """
+    Build a multi-page invoice PDF with a text layer.
+
+    Objects: 1 catalog, 2 page tree, 3 font, then a (page, content stream) pair per page.
+    """
+    page_ids = [4 + 2 * index for index in range(pages)]
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        f"<< /Type /Pages /Kids [{' '.join(f'{pid} 0 R' for pid in page_ids)}] /Count {pages} >>".encode(),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier >>",
+    ]
+    for page_id, lines in zip(page_ids, invoice_lines(pages, items_per_page, seed)):
+        content = "BT /F1 8 Tf 10 TL 36 756 Td " + " ".join(f"({_escape(line)}) Tj T*" for line in lines) + " ET"
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            f"/Resources << /Font << /F1 3 0 R >> >> /Contents {page_id + 1} 0 R >>".encode()
+        )
+        objects.append(_stream(content.encode("latin-1")))
+    return _write_pdf(objects)
+
+
+def make_scanned_invoice(pages: int = 2, items_per_page: int = 30, seed: int = 0) -> bytes:
+    """
+    Build an image-only invoice PDF, like the output of a scanner, so text extraction falls back to OCR.
+    """
+    from PIL import Image, ImageDraw
+
+    images = []
+    for lines in invoice_lines(pages, items_per_page, seed):
+        image = Image.new("L", (1275, 1650), 255)
+        draw = ImageDraw.Draw(image)
+        for index, line in enumerate(lines):
+            draw.text((60, 60 + index * 22), line, fill=0)
+        images.append(image.convert("RGB"))
+
+    out = io.BytesIO()
+    images[0].save(out, format="PDF", save_all=True, append_images=images[1:], resolution=150)
+    return out.getvalue()
@@ -0,0 +1,20 @@
+import os
+
+# Production config for the async server: gunicorn -c gunicorn.conf.py asgi:app
+# Each worker is one event loop that holds many uploads in flight; add workers to use more cores
+# for the loops themselves, while PDF parsing and OCR use the CPU_WORKERS process pool of each worker.
+
+bind = os.environ.get("BIND", "0.0.0.0:3000")
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# A request can wait on the slowest provider (90s) and retries after rate limiting
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "180"))
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers now and then so a slow leak in a native library (poppler, tesseract) can't build up
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "5000"))
+max_requests_jitter = 500
+
+accesslog = "-"
@@ -0,0 +1,11 @@
+import os
+import tempfile
+
+# The stores and caches are opened when their modules are imported, so point them at a scratch
+# directory before any test imports them, and never start job workers
+_state_dir = tempfile.mkdtemp(prefix="extraction-tests-")
+os.environ.setdefault("EXTRACTION_CACHE_ENABLED", "false")
+os.environ.setdefault("EXTRACTION_CACHE_PATH", os.path.join(_state_dir, "cache", "extraction.sqlite3"))
+os.environ.setdefault("RESULTS_DB_PATH", os.path.join(_state_dir, "results", "results.sqlite3"))
+os.environ.setdefault("JOBS_DIR", os.path.join(_state_dir, "jobs"))
+os.environ.setdefault("JOB_WORKERS", "0")
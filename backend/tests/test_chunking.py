@@ -0,0 +1,43 @@
+from utils.chunking import chunk_overlaps, merge_chunk_results, split_into_chunks
+
+
+def item(description: str, quantity: int = 1) -> dict:
+    return {"description": description, "quantity": quantity, "unit_price": 2.0, "extended_price": 2.0 * quantity}
+
+
+def test_overlap_copies_are_dropped_once():
+    merged = merge_chunk_results({"invoice_number": "7"}, [[item("a"), item("b")], [item("b"), item("c")]], [0, 1])
+    assert merged == {"invoice_number": "7", "invoice_items": [item("a"), item("b"), item("c")]}
+
+
+def test_a_row_repeated_across_a_chunk_boundary_is_kept():
+    # "a" is billed again in the second chunk's own lines, not in its overlap with the first
+    merged = merge_chunk_results(None, [[item("a"), item("b")], [item("b"), item("c"), item("a")]], [0, 1])
+    assert merged["invoice_items"] == [item("a"), item("b"), item("c"), item("a")]
+
+
+def test_the_overlap_copy_and_a_real_repeat_in_one_chunk():
+    merged = merge_chunk_results(None, [[item("a"), item("b")], [item("b"), item("b"), item("c")]], [0, 1])
+    assert merged["invoice_items"] == [item("a"), item("b"), item("b"), item("c")]
+
+
+def test_nothing_is_dropped_without_an_overlap():
+    merged = merge_chunk_results(None, [[item("a"), item("b")], [item("b"), item("c")]], [0, 0])
+    assert merged["invoice_items"] == [item("a"), item("b"), item("b"), item("c")]
+
+
+def test_an_item_cut_off_at_the_end_of_a_chunk():
+    # The first chunk only caught part of "c"; its overlap item "b" is still recognized
+    merged = merge_chunk_results(None, [[item("a"), item("b"), item("c", 0)], [item("b"), item("c"), item("d")]], [0, 2])
+    assert merged["invoice_items"] == [item("a"), item("b"), item("c", 0), item("c"), item("d")]
+
+
+def test_chunk_overlaps_counts_the_repeated_lines():
+    lines = [f"line {index} " + "word " * 20 for index in range(40)]
+    chunks = split_into_chunks(["\n".join(lines)], max_tokens=200, overlap_tokens=60)
+    assert len(chunks) > 2
+    overlaps = chunk_overlaps(chunks)
+    assert overlaps[0] == 0
+    for previous, chunk, overlap in zip(chunks, chunks[1:], overlaps[1:]):
+        assert overlap > 0
+        assert chunk.split("\n")[:overlap] == previous.split("\n")[-overlap:]
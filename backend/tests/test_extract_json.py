@@ -0,0 +1,71 @@
+import json
+import pytest
+from utils.extract_json import IncrementalJSONParser, extract_json_from_response, parse_json_response, repair_truncated_json
+
+DATA = {
+    "invoice_number": "INV-1001",
+    "bill_to_address": {"name": "Acme \"West\"", "city": "Reno"},
+    "invoice_items": [
+        {"description": "Bracket, 3/4\\\" {steel}", "quantity": 4},
+        {"description": "Anchor [M8]", "quantity": 12},
+    ],
+    "total": 199.5,
+}
+RESPONSE = "```json\n" + json.dumps(DATA, indent=2) + "\n```"
+
+
+def feed_in_chunks(text: str, size: int) -> tuple[IncrementalJSONParser, list]:
+    parser = IncrementalJSONParser()
+    events = []
+    for start in range(0, len(text), size):
+        events.extend(parser.feed(text[start:start + size]))
+    return parser, events
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, len(RESPONSE)])
+def test_events_do_not_depend_on_chunk_boundaries(size):
+    parser, events = feed_in_chunks(RESPONSE, size)
+    assert events == [
+        ("field", "invoice_number", "INV-1001"),
+        ("field", "bill_to_address", DATA["bill_to_address"]),
+        ("item", "invoice_items", DATA["invoice_items"][0]),
+        ("item", "invoice_items", DATA["invoice_items"][1]),
+        ("field", "total", 199.5),
+    ]
+    assert parser.fields == DATA
+    assert parser.text == RESPONSE
+
+
+@pytest.mark.parametrize("size", [1, 5, 64])
+def test_repair_across_chunk_boundaries(size):
+    # Cut off part way through the second item's description
+    truncated = RESPONSE[:RESPONSE.index("Anchor") + 3]
+    parser, _ = feed_in_chunks(truncated, size)
+    assert parser.repaired() == {
+        "invoice_number": "INV-1001",
+        "bill_to_address": DATA["bill_to_address"],
+        "invoice_items": [DATA["invoice_items"][0], {}],
+    }
+
+
+def test_repair_drops_a_half_written_key():
+    assert repair_truncated_json('{"invoice_number": "7", "tot') == {"invoice_number": "7"}
+    assert repair_truncated_json("no json here") is None
+
+
+def test_escaped_quote_split_from_its_backslash():
+    parser = IncrementalJSONParser()
+    assert parser.feed('{"note": "say \\') == []
+    assert parser.feed('"hi\\"", "n": 1}') == [("field", "note", 'say "hi"'), ("field", "n", 1)]
+
+
+def test_extract_json_from_a_truncated_response():
+    assert extract_json_from_response('Here you go: {"invoice_items": [{"quantity": 1}, {"quan') == {
+        "invoice_items": [{"quantity": 1}, {}]
+    }
+
+
+def test_parse_json_response_reports_repair():
+    assert parse_json_response('```json\n{"a": 1}\n```') == ({"a": 1}, False)
+    assert parse_json_response('{"a": 1, "b": [2, 3, ') == ({"a": 1, "b": [2, 3]}, True)
+    assert parse_json_response("no json here") == (None, False)
@@ -0,0 +1,127 @@
+import os
+import threading
+import time
+import pytest
+from utils.jobs import JobQueue, LeaseLostError
+
+PDF = b"%PDF-1.4 test"
+OPTIONS = {"document_type": "invoice", "chunk_mode": "auto"}
+
+
+def expire_leases(queue: JobQueue) -> None:
+    time.sleep(queue.lease_seconds * 2)
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(str(tmp_path), lease_seconds=0.05, max_attempts=2)
+
+
+def test_submitting_the_same_file_returns_the_existing_job(queue):
+    job, created = queue.submit(PDF, "hash", "a.pdf", OPTIONS)
+    again, created_again = queue.submit(PDF, "hash", "copy of a.pdf", OPTIONS)
+    assert (created, created_again) == (True, False)
+    assert again["id"] == job["id"]
+
+    _, created_other = queue.submit(PDF, "hash", "a.pdf", {**OPTIONS, "chunk_mode": "single"})
+    assert created_other
+
+
+def test_a_leased_job_is_not_claimed_twice(queue):
+    job, _ = queue.submit(PDF, "hash", "a.pdf", OPTIONS)
+    claimed = queue.claim("worker-1")
+    assert claimed["id"] == job["id"]
+    assert claimed["options"] == OPTIONS
+    assert queue.claim("worker-2") is None
+
+
+def test_an_expired_lease_is_reclaimed_and_fences_out_the_old_worker(queue):
+    job, _ = queue.submit(PDF, "hash", "a.pdf", OPTIONS)
+    first = queue.claim("worker-1")
+    queue.checkpoint(job["id"], first["lease_token"], "extract_text", {"pages": ["text"]})
+
+    expire_leases(queue)
+    second = queue.claim("worker-2")
+    assert second["id"] == job["id"]
+    assert second["lease_token"] != first["lease_token"]
+    # The new worker picks up from the stages the first one finished
+    assert second["checkpoints"] == {"extract_text": {"pages": ["text"]}}
+    assert queue.get(job["id"])["attempts"] == 2
+
+    assert queue.renew_leases({job["id"]: first["lease_token"]}) == [job["id"]]
+    with pytest.raises(LeaseLostError):
+        queue.checkpoint(job["id"], first["lease_token"], "model:openai", {"stale": True})
+    with pytest.raises(LeaseLostError):
+        queue.finish(job["id"], first["lease_token"], {"data": "stale"})
+
+    assert queue.renew_leases({job["id"]: second["lease_token"]}) == []
+    queue.finish(job["id"], second["lease_token"], {"data": "fresh"})
+    finished = queue.get(job["id"])
+    assert finished["status"] == "done"
+    assert finished["result"] == {"data": "fresh"}
+    assert finished["completed_stages"] == ["extract_text"]
+
+
+def test_renewing_keeps_the_lease(tmp_path):
+    queue = JobQueue(str(tmp_path), lease_seconds=0.4)
+    job, _ = queue.submit(PDF, "hash", "a.pdf", OPTIONS)
+    claimed = queue.claim("worker-1")
+    # Renewed every half lease, for twice as long as the lease lasts
+    for _ in range(4):
+        time.sleep(queue.lease_seconds / 2)
+        assert queue.renew_leases({job["id"]: claimed["lease_token"]}) == []
+    assert queue.claim("worker-2") is None
+
+
+def test_a_job_lost_too_many_times_is_failed(queue):
+    job, _ = queue.submit(PDF, "hash", "a.pdf", OPTIONS)
+    for worker in ("worker-1", "worker-2"):
+        assert queue.claim(worker)["id"] == job["id"]
+        expire_leases(queue)
+
+    assert queue.claim("worker-3") is None
+    failed = queue.get(job["id"])
+    assert failed["status"] == "error"
+    assert failed["error"] == "Gave up after 2 attempts"
+
+    # A failed job doesn't block submitting the file again
+    _, created = queue.submit(PDF, "hash", "a.pdf", OPTIONS)
+    assert created
+
+
+def test_the_upload_is_removed_once_its_last_job_finishes(queue):
+    job, _ = queue.submit(PDF, "hash", "a.pdf", OPTIONS)
+    claimed = queue.claim("worker-1")
+    with open(queue.upload_path("hash"), "rb") as f:
+        assert f.read() == PDF
+    queue.fail(job["id"], claimed["lease_token"], "boom")
+    assert queue.get(job["id"])["error"] == "boom"
+    assert not os.path.exists(queue.upload_path("hash"))
+
+
+def test_a_job_submitted_while_the_upload_is_removed_keeps_it(queue, monkeypatch):
+    # Two processes share the queue: one finishes the last job for a file while the other queues a new one
+    other = JobQueue(queue.jobs_dir, lease_seconds=queue.lease_seconds, max_attempts=queue.max_attempts)
+    job, _ = queue.submit(PDF, "hash", "a.pdf", OPTIONS)
+    claimed = queue.claim("worker-1")
+    submitted = []
+    remove = os.remove
+
+    def remove_while_submitting(path):
+        thread = threading.Thread(target=lambda: submitted.append(other.submit(PDF, "hash", "a.pdf", {**OPTIONS, "chunk_mode": "single"})))
+        thread.start()
+        thread.join(0.2)
+        # The submit waits for the close to commit rather than reusing the upload that is going away
+        assert not submitted
+        remove(path)
+        return thread
+
+    threads = []
+    monkeypatch.setattr(os, "remove", lambda path: threads.append(remove_while_submitting(path)))
+    queue.finish(job["id"], claimed["lease_token"], {})
+    threads[0].join()
+
+    new_job, created = submitted[0]
+    assert created and new_job["status"] == "queued"
+    with open(queue.upload_path("hash"), "rb") as f:
+        assert f.read() == PDF
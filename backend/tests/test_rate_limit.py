@@ -0,0 +1,152 @@
+import asyncio
+import pytest
+from utils.rate_limit import AsyncProviderScheduler, ProviderScheduler, ProviderThrottledError
+
+
+class StatusError(Exception):
+    def __init__(self, status_code: int):
+        super().__init__(f"status {status_code}")
+        self.status_code = status_code
+
+
+def test_slot_is_released_when_the_call_fails():
+    scheduler = ProviderScheduler("test", max_concurrency=2)
+
+    def fail():
+        raise StatusError(400)
+
+    with pytest.raises(StatusError):
+        scheduler.call(fail)
+    assert scheduler.limiter._in_flight == 0
+    assert scheduler.stats()["failures"] == 1
+
+
+def test_throttled_call_is_retried_and_halves_the_limit():
+    scheduler = ProviderScheduler("test", max_concurrency=8, base_delay=0.001, max_delay=0.001)
+    attempts = []
+
+    def throttled_once():
+        attempts.append(scheduler.limiter._in_flight)
+        if len(attempts) == 1:
+            raise StatusError(429)
+        return "ok"
+
+    assert scheduler.call(throttled_once) == "ok"
+    assert attempts == [1, 1]
+    assert scheduler.limiter.limit == 4
+    assert scheduler.limiter._in_flight == 0
+    assert scheduler.stats()["throttled"] == 1
+
+
+def test_gives_up_after_max_retries():
+    scheduler = ProviderScheduler("test", max_retries=2, base_delay=0.001, max_delay=0.001)
+
+    def overloaded():
+        raise StatusError(529)
+
+    with pytest.raises(ProviderThrottledError):
+        scheduler.call(overloaded)
+    assert scheduler.stats()["retries"] == 2
+    assert scheduler.limiter._in_flight == 0
+
+
+def test_async_slot_is_released_when_the_call_is_cancelled():
+    async def run():
+        scheduler = AsyncProviderScheduler(ProviderScheduler("test", max_concurrency=2))
+        started = asyncio.Event()
+
+        async def slow():
+            started.set()
+            await asyncio.sleep(10)
+
+        tasks = [asyncio.create_task(scheduler.call(slow)) for _ in range(2)]
+        await started.wait()
+        assert scheduler.limiter._in_flight == 2
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        assert scheduler.limiter._in_flight == 0
+
+        async def fast():
+            return "ok"
+
+        # Both slots are usable again
+        assert await asyncio.wait_for(asyncio.gather(scheduler.call(fast), scheduler.call(fast)), 1) == ["ok", "ok"]
+
+    asyncio.run(run())
+
+
+def test_async_slot_is_released_when_waiting_for_it_is_cancelled():
+    async def run():
+        scheduler = AsyncProviderScheduler(ProviderScheduler("test", max_concurrency=1))
+        release = asyncio.Event()
+
+        async def held():
+            await release.wait()
+            return "held"
+
+        holder = asyncio.create_task(scheduler.call(held))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(scheduler.call(held))
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        release.set()
+        assert await holder == "held"
+        assert scheduler.limiter._in_flight == 0
+
+    asyncio.run(run())
+
+
+def test_slot_is_held_until_the_stream_is_consumed():
+    scheduler = ProviderScheduler("test", max_concurrency=2)
+    in_flight = []
+
+    def consume(stream):
+        for text in stream:
+            in_flight.append(scheduler.limiter._in_flight)
+        return "".join(stream)
+
+    assert scheduler.call(lambda: ["a", "b"], consume=consume) == "ab"
+    assert in_flight == [1, 1]
+    assert scheduler.limiter._in_flight == 0
+
+
+def test_a_stream_that_fails_part_way_is_not_retried():
+    scheduler = ProviderScheduler("test", base_delay=0.001, max_delay=0.001)
+    calls = []
+
+    def open_stream():
+        calls.append(1)
+        return iter(["a"])
+
+    def consume(stream):
+        next(stream)
+        raise StatusError(503)
+
+    with pytest.raises(StatusError):
+        scheduler.call(open_stream, consume=consume)
+    assert len(calls) == 1
+    assert scheduler.limiter._in_flight == 0
+
+
+def test_async_slot_is_held_until_the_stream_is_consumed():
+    async def run():
+        scheduler = AsyncProviderScheduler(ProviderScheduler("test", max_concurrency=1))
+        reading = asyncio.Event()
+
+        async def open_stream():
+            return "stream"
+
+        async def consume(stream):
+            reading.set()
+            await asyncio.sleep(10)
+
+        task = asyncio.create_task(scheduler.call(open_stream, consume=consume))
+        await reading.wait()
+        assert scheduler.limiter._in_flight == 1
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        assert scheduler.limiter._in_flight == 0
+
+    asyncio.run(run())
@@ -0,0 +1,34 @@
+import pytest
+from utils.results_store import ResultsStore
+
+HASH_A, HASH_B, HASH_C = "a" * 64, "b" * 64, "c" * 64
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ResultsStore(str(tmp_path / "results.sqlite3"), enabled=True)
+
+
+def invoice(number, vendor=None):
+    return {"invoice_number": number, "vendor_name": vendor, "total": "10.00"}
+
+
+def test_duplicates_with_and_without_a_file_hash_agree(store):
+    store.write(HASH_A, "a.pdf", "invoice", {"gpt": invoice("INV-1", "Acme")}, "test")
+    store.write(HASH_B, "b.pdf", "invoice", {"gpt": invoice("inv 1", "ACME")}, "test")
+    store.write(HASH_C, "c.pdf", "invoice", {"gpt": invoice("INV-2", "Acme")}, "test")
+
+    groups = store.duplicates()
+    assert [(group["invoice_number"], len(group["documents"])) for group in groups] == [("INV1", 2)]
+    assert store.duplicates(HASH_A) == groups
+    assert store.duplicates(HASH_C) == []
+
+
+def test_duplicates_of_an_invoice_without_a_vendor(store):
+    store.write(HASH_A, "a.pdf", "invoice", {"gpt": invoice("INV-1")}, "test")
+    store.write(HASH_B, "b.pdf", "invoice", {"gpt": invoice("INV-1")}, "test")
+
+    groups = store.duplicates()
+    assert len(groups) == 1 and groups[0]["vendor_name"] is None
+    assert store.duplicates(HASH_A) == groups
+    assert store.duplicates(HASH_B) == groups
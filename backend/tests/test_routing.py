@@ -0,0 +1,85 @@
+import uuid
+import pytest
+from utils.metrics import PROVIDER_LATENCY
+from utils.routing import HEDGE_DEFAULT_DELAY_SECONDS, HEDGE_MIN_SAMPLES, Router, rank_providers, validate_result
+
+
+def provider_names(count: int) -> list[str]:
+    # PROVIDER_LATENCY is shared by the whole process, so every test gets providers of its own
+    return [f"provider-{uuid.uuid4().hex[:8]}" for _ in range(count)]
+
+
+def test_rank_puts_unmeasured_providers_first_then_fastest():
+    slow, fast, new = provider_names(3)
+    PROVIDER_LATENCY.observe(slow, 3.0)
+    PROVIDER_LATENCY.observe(fast, 1.0)
+    assert rank_providers([slow, fast, new]) == [new, fast, slow]
+
+
+def test_fastest_keeps_the_fanout_in_flight_and_stops_at_the_first_valid_result():
+    a, b, c = provider_names(3)
+    router = Router("fastest", [a, b, c], fanout=2)
+    assert router.start(0) == [a, b]
+
+    router.finished(a, ["every field is null"], 1)
+    assert router.due(1) == [c]
+    assert not router.done
+
+    router.finished(c, [], 2)
+    assert router.done
+    assert router.due(2) == []
+    assert router.report() == {"policy": "fastest", "winner": c, "started": [a, b, c],
+                               "failed": {a: "every field is null"}, "cancelled": [b]}
+
+
+def test_hedged_starts_a_backup_only_after_the_hedge_delay():
+    a, b = provider_names(2)
+    router = Router("hedged", [a, b])
+    assert router.start(0) == [a]
+    # Without enough recent calls to go on, the default delay applies
+    assert router.wake_time() == HEDGE_DEFAULT_DELAY_SECONDS
+    assert router.due(HEDGE_DEFAULT_DELAY_SECONDS - 1) == []
+    assert router.due(HEDGE_DEFAULT_DELAY_SECONDS) == [b]
+
+    router.finished(b, [], HEDGE_DEFAULT_DELAY_SECONDS + 1)
+    assert router.report()["winner"] == b
+    assert router.report()["cancelled"] == [a]
+
+
+def test_hedge_delay_follows_recent_latency():
+    a, b = provider_names(2)
+    for _ in range(HEDGE_MIN_SAMPLES):
+        PROVIDER_LATENCY.observe(a, 2.0)
+        PROVIDER_LATENCY.observe(b, 5.0)
+    router = Router("hedged", [b, a])
+    assert router.start(10) == [a]
+    assert router.wake_time() == pytest.approx(12.0)
+    assert router.due(12) == [b]
+
+
+def test_hedged_replaces_a_failed_provider_straight_away():
+    a, b = provider_names(2)
+    router = Router("hedged", [a, b])
+    router.start(0)
+    router.finished(a, ["provider failed: timed out"], 1)
+    assert router.due(1) == [b]
+
+    router.finished(b, ["result is not a JSON object"], 2)
+    assert router.done
+    assert router.report()["winner"] is None
+
+
+def test_router_only_handles_fastest_and_hedged():
+    with pytest.raises(ValueError):
+        Router("consensus", provider_names(2))
+
+
+def test_validate_result():
+    assert validate_result("invoice", {"error": "boom"}) == ["provider failed: boom"]
+    assert validate_result("invoice", ["not", "an", "object"]) == ["result is not a JSON object"]
+    assert validate_result("invoice", {"total": "$1,200.00", "invoice_items": []}, ["total", "invoice_items"]) == []
+    assert validate_result("invoice", {"total": "n/a", "invoice_items": "none"}, ["total", "invoice_items"]) == [
+        "total is not an amount",
+        "invoice_items is not a list of objects",
+    ]
+    assert validate_result("spec", {}) == ["result is empty"]
@@ -0,0 +1,235 @@
+import os
+import time
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from utils.async_providers import ASYNC_PROVIDERS, aiter_provider_results, aiter_provider_stream, aiter_routed_provider_results
+from utils.cache import make_cache_key
+from utils.chunking import make_async_chunked_call
+from utils.extract_json import IncrementalJSONParser
+from utils.metrics import PDF_PAGES, RequestTrace
+from utils.pdf_extraction import extract_text_layer, ocr_page, pages_needing_ocr, process_pool_context, remove_spooled_pdf, spool_pdf
+from utils.pipeline import (
+    RULES_MODEL, build_model_prompts, cached_route, consensus_report, extraction_cache, merge_rule_fields, parse_model_result,
+    partial_update, plan_model_calls, routed_outcome
+)
+from utils.routing import Router, validate_result
+from utils.rule_extraction import extract_invoice_fields
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Processes for PDF parsing, OCR and normalization, so CPU-bound work never blocks the event loop.
+# Bounded so hundreds of concurrent uploads queue for a CPU instead of oversubscribing the machine.
+CPU_WORKERS = int(os.environ.get("CPU_WORKERS", str(os.cpu_count() or 1)))
+
+_cpu_executor = None
+
+
+def get_cpu_executor() -> ProcessPoolExecutor:
+    # Created on first use so importing this module doesn't start worker processes. The event loop
+    # already has to_thread workers by then, so the workers aren't forked, see process_pool_context.
+    global _cpu_executor
+    if _cpu_executor is None:
+        _cpu_executor = ProcessPoolExecutor(max_workers=CPU_WORKERS, mp_context=process_pool_context())
+    return _cpu_executor
+
+
+def shutdown_cpu_executor() -> None:
+    global _cpu_executor
+    if _cpu_executor is not None:
+        _cpu_executor.shutdown(wait=False, cancel_futures=True)
+        _cpu_executor = None
+
+
+async def run_cpu_bound(fn, *args, **kwargs):
+    """
+    Run fn(*args, **kwargs) on the CPU process pool and await its result. fn and its arguments must be picklable.
+    """
+    return await asyncio.get_running_loop().run_in_executor(get_cpu_executor(), partial(fn, *args, **kwargs))
+
+
+async def aextract_document_pages(pdf_file, file_hash: str, trace: RequestTrace | None = None) -> list[str]:
+    """
+    extract_document_pages for the event loop: the text layer and each OCR page are extracted on the
+    CPU process pool, so the pages of one scanned document are OCR'd in parallel.
+    """
+    trace = RequestTrace() if trace is None else trace
+    key = make_cache_key("pages", file_hash)
+    with trace.span("extract_text") as span:
+        pages = await asyncio.to_thread(extraction_cache.get, key)
+        span["cached"] = pages is not None
+        if pages is None:
+            pages = await run_cpu_bound(extract_text_layer, pdf_file)
+            ocr_page_numbers = pages_needing_ocr(pages)
+            if ocr_page_numbers:
+                ocr_start = time.perf_counter()
+                logger.debug(f"Running OCR on {len(ocr_page_numbers)} of {len(pages)} pages")
+                # Each task gets the path of the PDF rather than a pickled copy of its bytes
+                spooled = await asyncio.to_thread(spool_pdf, pdf_file) if len(ocr_page_numbers) > 1 else None
+                try:
+                    ocr_path = pdf_file if spooled is None else spooled
+                    ocr_texts = await asyncio.gather(*(run_cpu_bound(ocr_page, ocr_path, number) for number in ocr_page_numbers))
+                finally:
+                    await asyncio.to_thread(remove_spooled_pdf, spooled)
+                for page_number, text in zip(ocr_page_numbers, ocr_texts):
+                    pages[page_number - 1] = text
+                trace.record("ocr", time.perf_counter() - ocr_start, start=ocr_start, pages=len(ocr_page_numbers))
+            await asyncio.to_thread(extraction_cache.set, key, pages)
+
+            text_layer_pages = len(pages) - len(ocr_page_numbers)
+            span.update(text_layer_pages=text_layer_pages, ocr_pages=len(ocr_page_numbers))
+            PDF_PAGES.inc(text_layer_pages, method="text_layer")
+            PDF_PAGES.inc(len(ocr_page_numbers), method="ocr")
+        span["pages"] = len(pages)
+    return pages
+
+
+async def aextract_rule_fields(document_type: str, pdf_text: str, rule_mode: str, trace: RequestTrace | None = None) -> dict | None:
+    """
+    extract_rule_fields for the event loop: the rules run over the whole text on the CPU process pool.
+    """
+    if rule_mode == "off" or document_type != "invoice":
+        return None
+    trace = RequestTrace() if trace is None else trace
+    with trace.span("rules") as span:
+        rules = await run_cpu_bound(extract_invoice_fields, pdf_text)
+        span.update(found=len(rules["data"]) - len(rules["missing"]), complete=rules["complete"])
+    return rules
+
+
+async def aparse_model_result(name: str, content: str, plan: dict, rules: dict | None, trace: RequestTrace):
+    # Parses the response and writes it to the SQLite cache, so it runs off the event loop
+    return await asyncio.to_thread(parse_model_result, name, content, plan, rules, trace)
+
+
+async def aiter_model_results(document_type: str, pdf_text: str, file_hash: str, providers=None, pages=None, chunk_mode: str = "auto",
+                              trace: RequestTrace | None = None, rules: dict | None = None, rule_mode: str = "off"):
+    """
+    iter_model_results with the async provider clients; yields the same (model name, result, usage) tuples.
+    """
+    providers = ASYNC_PROVIDERS if providers is None else providers
+    trace = RequestTrace() if trace is None else trace
+    if rules is not None and rule_mode == "skip" and rules["complete"]:
+        yield RULES_MODEL, rules["data"], None
+        return
+
+    plan = plan_model_calls(document_type, pdf_text, file_hash, providers, pages, chunk_mode, rules, rule_mode)
+    uncached = {}
+    for name, call in providers.items():
+        cached = await asyncio.to_thread(extraction_cache.get, plan["keys"][name])
+        if cached is None:
+            uncached[name] = call
+        else:
+            yield name, merge_rule_fields(rules, cached) if plan["fill"] else cached, None
+
+    if not uncached:
+        return
+
+    if plan["chunked"]:
+        uncached = {name: make_async_chunked_call(call, plan["pages"]) for name, call in uncached.items()}
+
+    system_prompt, prompt = build_model_prompts(document_type, pdf_text, plan, trace)
+    async for name, content, usage, error in aiter_provider_results(system_prompt, prompt, uncached, trace=trace):
+        if error is not None:
+            yield name, {"error": error}, None
+            continue
+        yield name, await aparse_model_result(name, content, plan, rules, trace), usage
+
+
+async def aiter_model_events(document_type: str, pdf_text: str, file_hash: str, providers=None, pages=None, chunk_mode: str = "auto",
+                             trace: RequestTrace | None = None, rules: dict | None = None, rule_mode: str = "off"):
+    """
+    iter_model_events with the async provider clients; yields the same "partial" and "result" events.
+    """
+    providers = ASYNC_PROVIDERS if providers is None else providers
+    trace = RequestTrace() if trace is None else trace
+    plan = plan_model_calls(document_type, pdf_text, file_hash, providers, pages, chunk_mode, rules, rule_mode)
+    skip = rules is not None and rule_mode == "skip" and rules["complete"]
+    if skip or plan["chunked"]:
+        async for name, data, usage in aiter_model_results(document_type, pdf_text, file_hash, providers, pages, chunk_mode,
+                                                           trace, rules, rule_mode):
+            yield "result", name, data, usage
+        return
+
+    uncached = {}
+    for name, call in providers.items():
+        cached = await asyncio.to_thread(extraction_cache.get, plan["keys"][name])
+        if cached is None:
+            uncached[name] = call
+        else:
+            yield "result", name, merge_rule_fields(rules, cached) if plan["fill"] else cached, None
+
+    if not uncached:
+        return
+
+    system_prompt, prompt = build_model_prompts(document_type, pdf_text, plan, trace)
+    parsers = {name: IncrementalJSONParser() for name in uncached}
+    async for event in aiter_provider_stream(system_prompt, prompt, uncached, trace=trace):
+        if event[0] == "text":
+            _, name, text = event
+            completed = parsers[name].feed(text)
+            if completed:
+                yield "partial", name, partial_update(completed)
+            continue
+        _, name, content, usage, error = event
+        if error is not None:
+            yield "result", name, {"error": error}, None
+            continue
+        yield "result", name, await aparse_model_result(name, content, plan, rules, trace), usage
+
+
+async def arun_models(document_type: str, pdf_text: str, file_hash: str, providers=None, pages=None, chunk_mode: str = "auto",
+                      trace: RequestTrace | None = None, rules: dict | None = None, rule_mode: str = "off") -> tuple[dict, dict]:
+    """
+    Collect aiter_model_results, in provider order. See run_models.
+    """
+    providers = ASYNC_PROVIDERS if providers is None else providers
+    results, usage = {}, {}
+    async for name, data, model_usage in aiter_model_results(document_type, pdf_text, file_hash, providers, pages, chunk_mode,
+                                                             trace, rules, rule_mode):
+        results[name] = data
+        if model_usage is not None:
+            usage[name] = model_usage
+    order = [*providers, RULES_MODEL]
+    return (
+        {name: results[name] for name in order if name in results},
+        {name: usage[name] for name in order if name in usage},
+    )
+
+
+async def aroute_models(document_type: str, pdf_text: str, file_hash: str, providers=None, pages=None, chunk_mode: str = "auto",
+                        trace: RequestTrace | None = None, rules: dict | None = None, rule_mode: str = "off",
+                        policy: str = "consensus") -> tuple[dict, dict, dict]:
+    """
+    route_models with the async provider clients. Providers still running when another wins are cancelled.
+    """
+    providers = ASYNC_PROVIDERS if providers is None else providers
+    trace = RequestTrace() if trace is None else trace
+    plan = plan_model_calls(document_type, pdf_text, file_hash, providers, pages, chunk_mode, rules, rule_mode)
+    if rules is not None and rule_mode == "skip" and rules["complete"]:
+        results, usage = await arun_models(document_type, pdf_text, file_hash, providers, pages, chunk_mode, trace, rules, rule_mode)
+        return results, usage, {"policy": policy, "winner": RULES_MODEL}
+    if policy == "consensus":
+        results, usage = await arun_models(document_type, pdf_text, file_hash, providers, pages, chunk_mode, trace, rules, rule_mode)
+        return results, usage, consensus_report(document_type, plan, results)
+
+    router = Router(policy, providers)
+    cached = await asyncio.to_thread(cached_route, document_type, plan, router, rules)
+    if cached is not None:
+        return cached
+
+    calls = providers
+    if plan["chunked"]:
+        calls = {name: make_async_chunked_call(call, plan["pages"]) for name, call in providers.items()}
+    system_prompt, prompt = build_model_prompts(document_type, pdf_text, plan, trace)
+    results, usage = {}, {}
+    async for name, content, model_usage, error in aiter_routed_provider_results(system_prompt, prompt, router, calls, trace=trace):
+        data = {"error": error} if error is not None else await aparse_model_result(name, content, plan, rules, trace)
+        results[name] = data
+        if model_usage is not None:
+            usage[name] = model_usage
+        router.finished(name, validate_result(document_type, data, plan["fields"]), time.monotonic())
+    return routed_outcome(router, providers, results, usage)
@@ -0,0 +1,361 @@
+import os
+import time
+import asyncio
+import logging
+from functools import partial
+from collections import OrderedDict
+from utils.metrics import PROVIDER_LATENCY, RequestTrace, record_usage
+from utils.rate_limit import AsyncProviderScheduler
+from utils.token_utils import estimate_token_count
+from utils.providers import (
+    DEFAULT_PROVIDER_TIMEOUT, EXPECTED_OUTPUT_TOKENS, PROVIDER_SCHEDULERS, PROVIDER_TIMEOUTS,
+    anthropic_event_text, anthropic_model, anthropic_system, chat_chunk_text, chat_messages, deepseek_model,
+    deepseek_usage, enabled_provider_names, make_usage, openai_model, openai_usage
+)
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Connections each async client keeps open to its provider, shared by every request in the worker
+ASYNC_MAX_CONNECTIONS = int(os.environ.get("ASYNC_MAX_CONNECTIONS", "100"))
+ASYNC_MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("ASYNC_MAX_KEEPALIVE_CONNECTIONS", "20"))
+
+# Same quotas and counters as the blocking clients, but waiting doesn't hold a thread
+ASYNC_PROVIDER_SCHEDULERS = {name: AsyncProviderScheduler(scheduler) for name, scheduler in PROVIDER_SCHEDULERS.items()}
+
+_clients = {}
+
+
+def _connection_limits():
+    import httpx
+    return httpx.Limits(max_connections=ASYNC_MAX_CONNECTIONS, max_keepalive_connections=ASYNC_MAX_KEEPALIVE_CONNECTIONS)
+
+
+def _build_openai_client():
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+    return AsyncOpenAI(max_retries=0, http_client=DefaultAsyncHttpxClient(limits=_connection_limits()))
+
+
+def _build_deepseek_client():
+    from azure.ai.inference.aio import ChatCompletionsClient
+    from azure.core.credentials import AzureKeyCredential
+    return ChatCompletionsClient(
+        endpoint=os.environ.get("DEEPSEEK_ENDPOINT", "https://models.github.ai/inference"),
+        credential=AzureKeyCredential(os.environ["GITHUB_TOKEN"]),
+        retry_total=0
+    )
+
+
+def _build_anthropic_client():
+    import anthropic
+    return anthropic.AsyncAnthropic(
+        api_key=os.environ["ANTHROPIC_API_KEY"],
+        max_retries=0,
+        http_client=anthropic.DefaultAsyncHttpxClient(limits=_connection_limits())
+    )
+
+
+ASYNC_CLIENT_BUILDERS = {
+    "deepseek": _build_deepseek_client,
+    "openai": _build_openai_client,
+    "anthropic": _build_anthropic_client,
+}
+
+
+def get_async_client(name: str):
+    """
+    Return the provider's async SDK client, building it on first use.
+
+    Like the clients in providers.py they are built lazily, which also means each worker process
+    builds its own connection pool inside the event loop that will use it.
+    """
+    if name not in _clients:
+        logger.debug(f"Creating async {name} client")
+        _clients[name] = ASYNC_CLIENT_BUILDERS[name]()
+    return _clients[name]
+
+
+async def close_async_clients() -> None:
+    """
+    Close the async clients' connection pools, e.g. when the server shuts down.
+    """
+    for client in _clients.values():
+        await client.close()
+    _clients.clear()
+
+
+async def schedule_async_call(name: str, system_prompt: str, prompt: str, fn, consume=None, **kwargs):
+    """
+    Await an async SDK call through the provider's scheduler, see providers.schedule_call.
+    """
+    estimated_tokens = estimate_token_count(system_prompt + prompt, None)["input_tokens"] + EXPECTED_OUTPUT_TOKENS
+    return await ASYNC_PROVIDER_SCHEDULERS[name].call(fn, estimated_tokens=estimated_tokens,
+                                                      deadline_seconds=PROVIDER_TIMEOUTS[name], consume=consume, **kwargs)
+
+
+# ------------- ASYNC CLIENT CALLS -------------
+# The same requests as the call functions in providers.py, made with the async clients
+async def read_async_chat_stream(stream, on_text, make_stream_usage) -> tuple[str, dict]:
+    parts, usage = [], make_usage(0, 0)
+    async with stream:
+        async for chunk in stream:
+            text = chat_chunk_text(chunk)
+            if text:
+                parts.append(text)
+                on_text(text)
+            if getattr(chunk, "usage", None):
+                usage = make_stream_usage(chunk.usage)
+    return "".join(parts), usage
+
+
+async def read_async_anthropic_stream(stream, on_text) -> tuple[str, dict]:
+    parts, usage = [], make_usage(0, 0)
+    async with stream:
+        async for event in stream:
+            text = anthropic_event_text(event, usage)
+            if text:
+                parts.append(text)
+                on_text(text)
+    return "".join(parts), usage
+
+
+async def acall_openai(system_prompt: str, prompt: str, on_text=None) -> tuple[str, dict]:
+    stream_options = {"stream": True, "stream_options": {"include_usage": True}} if on_text else {}
+    response = await schedule_async_call(
+        "openai", system_prompt, prompt, get_async_client("openai").chat.completions.create,
+        consume=partial(read_async_chat_stream, on_text=on_text, make_stream_usage=openai_usage) if on_text else None,
+        model=openai_model,
+        temperature=0.1,
+        timeout=PROVIDER_TIMEOUTS["openai"],
+        messages=chat_messages(system_prompt, prompt),
+        **stream_options
+    )
+    if on_text:
+        return response
+    return str(response.choices[0].message.content), openai_usage(response.usage)
+
+
+async def acall_deepseek(system_prompt: str, prompt: str, on_text=None) -> tuple[str, dict]:
+    response = await schedule_async_call(
+        "deepseek", system_prompt, prompt, get_async_client("deepseek").complete,
+        consume=partial(read_async_chat_stream, on_text=on_text, make_stream_usage=deepseek_usage) if on_text else None,
+        model=deepseek_model,
+        temperature=0.1,
+        timeout=PROVIDER_TIMEOUTS["deepseek"],
+        messages=chat_messages(system_prompt, prompt),
+        stream=bool(on_text)
+    )
+    if on_text:
+        return response
+    return str(response.choices[0].message.content), deepseek_usage(response.usage)
+
+
+async def acall_anthropic(system_prompt: str, prompt: str, on_text=None) -> tuple[str, dict]:
+    response = await schedule_async_call(
+        "anthropic", system_prompt, prompt, get_async_client("anthropic").messages.create,
+        consume=partial(read_async_anthropic_stream, on_text=on_text) if on_text else None,
+        model=anthropic_model,
+        max_tokens=4000,
+        temperature=0.1,
+        timeout=PROVIDER_TIMEOUTS["anthropic"],
+        system=anthropic_system(system_prompt),
+        messages=[
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ],
+        stream=bool(on_text)
+    )
+    if on_text:
+        return response
+    usage = make_usage(
+        response.usage.input_tokens,
+        response.usage.output_tokens,
+        cache_read_input_tokens=getattr(response.usage, "cache_read_input_tokens", 0),
+        cache_creation_input_tokens=getattr(response.usage, "cache_creation_input_tokens", 0)
+    )
+    return str(response.content[0].text), usage
+
+
+# Provider name -> async call function, in the same order as ALL_PROVIDERS
+ALL_ASYNC_PROVIDERS = OrderedDict([
+    ("deepseek", acall_deepseek),
+    ("openai", acall_openai),
+    ("anthropic", acall_anthropic),
+])
+# The providers a request runs by default, narrowed by ENABLED_PROVIDERS like PROVIDERS
+ASYNC_PROVIDERS = OrderedDict((name, ALL_ASYNC_PROVIDERS[name]) for name in enabled_provider_names(ALL_ASYNC_PROVIDERS))
+
+
+async def timed_async_call(trace: RequestTrace, name: str, call, system_prompt: str, prompt: str) -> tuple[str, dict]:
+    """
+    Await a provider call, recording its duration and reported token usage as a "provider" span.
+    """
+    start = time.perf_counter()
+    try:
+        content, usage = await call(system_prompt, prompt)
+    except Exception as e:
+        trace.record("provider", time.perf_counter() - start, start=start, provider=name, error=type(e).__name__)
+        raise
+    seconds = time.perf_counter() - start
+    trace.record("provider", seconds, start=start, provider=name, usage=usage)
+    record_usage(name, usage)
+    PROVIDER_LATENCY.observe(name, seconds)
+    return content, usage
+
+
+async def aiter_provider_results(system_prompt: str, prompt: str, providers=None, timeouts=None, trace: RequestTrace | None = None):
+    """
+    Call every provider concurrently and yield each result as soon as it is available.
+
+    Same contract as providers.iter_provider_results, for async call functions. A provider that
+    misses its deadline has its task cancelled, which also closes its connection.
+
+    Yields:
+    tuple: (provider name, response content or None, token usage or None, error message or None).
+    """
+    providers = ASYNC_PROVIDERS if providers is None else providers
+    timeouts = PROVIDER_TIMEOUTS if timeouts is None else timeouts
+    trace = RequestTrace() if trace is None else trace
+
+    start = time.monotonic()
+    pending = {}
+    for name, call in providers.items():
+        task = asyncio.ensure_future(timed_async_call(trace, name, call, system_prompt, prompt))
+        pending[task] = (name, start + timeouts.get(name, DEFAULT_PROVIDER_TIMEOUT))
+
+    try:
+        while pending:
+            next_deadline = min(deadline for _, deadline in pending.values())
+            done, _ = await asyncio.wait(pending, timeout=max(0, next_deadline - time.monotonic()),
+                                         return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                name, _ = pending.pop(task)
+                try:
+                    (content, usage), error = task.result(), None
+                except Exception as e:
+                    logger.error(f"Provider {name} failed: {str(e)}", exc_info=True)
+                    content, usage, error = None, None, str(e)
+                yield name, content, usage, error
+
+            now = time.monotonic()
+            for task, (name, deadline) in list(pending.items()):
+                if deadline <= now and not task.done():
+                    task.cancel()
+                    pending.pop(task)
+                    timeout = timeouts.get(name, DEFAULT_PROVIDER_TIMEOUT)
+                    logger.error(f"Provider {name} timed out after {timeout}s")
+                    yield name, None, None, f"Timed out after {timeout} seconds"
+    finally:
+        # The consumer stopped early (e.g. client disconnected), so stop the calls still in flight
+        for task in pending:
+            task.cancel()
+
+
+async def aiter_routed_provider_results(system_prompt: str, prompt: str, router, providers=None, timeouts=None,
+                                        trace: RequestTrace | None = None):
+    """
+    providers.iter_routed_provider_results for async call functions. Once the router has a winner,
+    the calls still in flight are cancelled, which also closes their connections.
+    """
+    providers = ASYNC_PROVIDERS if providers is None else providers
+    timeouts = PROVIDER_TIMEOUTS if timeouts is None else timeouts
+    trace = RequestTrace() if trace is None else trace
+    pending = {}
+
+    def launch(names):
+        for name in names:
+            task = asyncio.ensure_future(timed_async_call(trace, name, providers[name], system_prompt, prompt))
+            pending[task] = (name, time.monotonic() + timeouts.get(name, DEFAULT_PROVIDER_TIMEOUT))
+
+    launch(router.start(time.monotonic()))
+    try:
+        while not router.done:
+            wake_times = [deadline for _, deadline in pending.values()]
+            if router.wake_time() is not None:
+                wake_times.append(router.wake_time())
+            done, _ = await asyncio.wait(pending, timeout=max(0, min(wake_times) - time.monotonic()),
+                                         return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                if router.done:
+                    break
+                name, _ = pending.pop(task)
+                try:
+                    (content, usage), error = task.result(), None
+                except Exception as e:
+                    logger.error(f"Provider {name} failed: {str(e)}", exc_info=True)
+                    content, usage, error = None, None, str(e)
+                yield name, content, usage, error
+
+            now = time.monotonic()
+            for task, (name, deadline) in list(pending.items()):
+                if deadline <= now and not task.done() and not router.done:
+                    task.cancel()
+                    pending.pop(task)
+                    timeout = timeouts.get(name, DEFAULT_PROVIDER_TIMEOUT)
+                    logger.error(f"Provider {name} timed out after {timeout}s")
+                    yield name, None, None, f"Timed out after {timeout} seconds"
+
+            launch(router.due(time.monotonic()))
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def aiter_provider_stream(system_prompt: str, prompt: str, providers=None, timeouts=None, trace: RequestTrace | None = None):
+    """
+    providers.iter_provider_stream for async call functions; yields the same "text" and "result" events.
+    """
+    providers = ASYNC_PROVIDERS if providers is None else providers
+    timeouts = PROVIDER_TIMEOUTS if timeouts is None else timeouts
+    trace = RequestTrace() if trace is None else trace
+    events = asyncio.Queue()
+
+    async def run(name, call):
+        def on_text(text):
+            events.put_nowait(("text", name, text))
+
+        try:
+            content, usage = await timed_async_call(trace, name, partial(call, on_text=on_text), system_prompt, prompt)
+            events.put_nowait(("result", name, content, usage, None))
+        except Exception as e:
+            events.put_nowait(("result", name, None, None, e))
+
+    start = time.monotonic()
+    deadlines = {name: start + timeouts.get(name, DEFAULT_PROVIDER_TIMEOUT) for name in providers}
+    tasks = {name: asyncio.ensure_future(run(name, call)) for name, call in providers.items()}
+    pending = set(providers)
+    try:
+        while pending:
+            next_deadline = min(deadlines[name] for name in pending)
+            try:
+                event = await asyncio.wait_for(events.get(), timeout=max(0, next_deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                event = None
+
+            if event is not None and event[1] in pending:
+                if event[0] == "text":
+                    yield event
+                else:
+                    _, name, content, usage, error = event
+                    pending.discard(name)
+                    if error is None:
+                        yield "result", name, content, usage, None
+                    else:
+                        logger.error(f"Provider {name} failed: {str(error)}", exc_info=error)
+                        yield "result", name, None, None, str(error)
+
+            now = time.monotonic()
+            for name in [name for name in pending if deadlines[name] <= now]:
+                tasks[name].cancel()
+                pending.discard(name)
+                timeout = timeouts.get(name, DEFAULT_PROVIDER_TIMEOUT)
+                logger.error(f"Provider {name} timed out after {timeout}s")
+                yield "result", name, None, None, f"Timed out after {timeout} seconds"
+    finally:
+        for name in pending:
+            tasks[name].cancel()
@@ -0,0 +1,206 @@
+import os
+import json
+import queue
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from utils.cache import hash_bytes, hash_file
+from utils.normalize import normalize_pages
+from utils.pdf_extraction import get_ocr_executor
+from utils.pipeline import OUTPUTS_DIR, extract_document_pages, extract_rule_fields, rules_report, run_models
+from utils.providers import PROVIDERS
+from utils.results_store import results_store
+from utils.rule_extraction import DEFAULT_RULE_MODE
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+DEFAULT_OUTPUT_DIR = os.path.join(OUTPUTS_DIR, "json")
+# Documents in the extraction stage at once. The stage's CPU-bound work (text layer, OCR, normalization,
+# rules) runs on the OCR process pool (OCR_WORKERS processes), so its threads only wait on that pool;
+# model calls mostly wait on the network, so they get a thread pool of their own
+BATCH_EXTRACT_WORKERS = int(os.environ.get("BATCH_EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+BATCH_LLM_WORKERS = int(os.environ.get("BATCH_LLM_WORKERS", "4"))
+
+
+class BatchScheduler:
+    """
+    Runs many documents through extraction and the models, pipelining the two stages.
+
+    Each document is extracted, normalized and run through the rules on the OCR process pool, so
+    several documents are parsed in parallel, and handed to the model pool as soon as its text is
+    ready, so the extraction of one document overlaps with the model calls of others. Every finished
+    document is written to output_dir as <name>_<document_type>_data.json, in the same subdirectory
+    as in the document's name (e.g. "2024/a.pdf" -> 2024/a_invoice_data.json). Documents whose output
+    already exists for the same file hash are skipped, which makes re-runs resumable. If some models
+    failed for a document, a re-run only calls those models again; if every model failed, nothing is
+    written, so the whole document is retried.
+    """
+
+    def __init__(self, document_type: str = "invoice", output_dir: str = DEFAULT_OUTPUT_DIR,
+                 extract_workers: int = BATCH_EXTRACT_WORKERS, llm_workers: int = BATCH_LLM_WORKERS,
+                 overwrite: bool = False, chunk_mode: str = "auto", rule_mode: str = DEFAULT_RULE_MODE,
+                 providers=None, normalizers: list[str] | None = None):
+        self.document_type = document_type
+        # Provider name -> call function; None runs every enabled provider
+        self.providers = providers
+        self.chunk_mode = chunk_mode
+        # Normalization steps applied to the text before it is sent; None applies the defaults
+        self.normalizers = normalizers
+        self.rule_mode = rule_mode
+        self.output_dir = output_dir
+        self.extract_workers = extract_workers
+        self.llm_workers = llm_workers
+        self.overwrite = overwrite
+
+    def output_path(self, name: str) -> str:
+        # Keep the relative directories, so same-named files from different folders don't share an
+        # output, but never anything that would point outside output_dir
+        parts = [part for part in name.replace("\\", "/").split("/") if part not in ("", ".", "..")]
+        directories, stem = parts[:-1], os.path.splitext(parts[-1] if parts else "document")[0]
+        return os.path.join(self.output_dir, *directories, f"{stem}_{self.document_type}_data.json")
+
+    def run(self, documents):
+        """
+        Process documents and yield a result for each one as it finishes, in completion order.
+
+        Parameters:
+        documents (iterable): (name, source) pairs, where source is a PDF path or the PDF bytes. The
+        name decides the output file, so names must be unique, e.g. paths relative to the input directory.
+
+        Yields:
+        dict: {"source", "status", ...} where status is "done", "skipped" or "error".
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        results = queue.Queue()
+        extract_pool = ThreadPoolExecutor(max_workers=self.extract_workers, thread_name_prefix="batch-extract")
+        llm_pool = ThreadPoolExecutor(max_workers=self.llm_workers, thread_name_prefix="batch-llm")
+
+        submitted = 0
+        output_paths = set()
+        try:
+            for name, source in documents:
+                output_path = self.output_path(name)
+                if output_path in output_paths:
+                    # Two documents writing one output would overwrite each other's results
+                    results.put({"source": name, "status": "error",
+                                 "error": f"Another document in this batch is also written to {output_path}"})
+                else:
+                    output_paths.add(output_path)
+                    extract_pool.submit(self._extract_stage, name, source, llm_pool, results)
+                submitted += 1
+            for _ in range(submitted):
+                yield results.get()
+        finally:
+            # If the consumer stops early, don't start documents that are still queued
+            extract_pool.shutdown(wait=False, cancel_futures=True)
+            llm_pool.shutdown(wait=False, cancel_futures=True)
+
+    def _extract_stage(self, name: str, source, llm_pool: ThreadPoolExecutor, results: queue.Queue) -> None:
+        try:
+            file_hash = hash_file(source) if isinstance(source, str) else hash_bytes(source)
+            output_path = self.output_path(name)
+            providers = PROVIDERS if self.providers is None else self.providers
+            previous = None if self.overwrite else self._previous_output(output_path, file_hash)
+            if previous is not None:
+                # Only the models that failed last time are called again
+                retry = failed_models(previous["data"])
+                providers = {model: call for model, call in providers.items() if model in retry}
+                if not providers:
+                    results.put({"source": name, "status": "skipped", "output": output_path})
+                    return
+
+            cpu_pool = get_ocr_executor()
+            pages = extract_document_pages(source, file_hash, executor=cpu_pool)
+            pages, normalization = cpu_pool.submit(normalize_pages, pages, self.normalizers).result()
+            rules = extract_rule_fields(self.document_type, "".join(pages), self.rule_mode, executor=cpu_pool)
+            extracted = {"pages": pages, "normalization": normalization, "rules": rules}
+            llm_pool.submit(self._model_stage, name, file_hash, extracted, output_path, providers, previous, results)
+        except Exception as e:
+            logger.error(f"Error extracting {name}: {str(e)}", exc_info=True)
+            results.put({"source": name, "status": "error", "error": str(e)})
+
+    def _model_stage(self, name: str, file_hash: str, extracted: dict, output_path: str, providers, previous: dict | None,
+                     results: queue.Queue) -> None:
+        try:
+            pages, normalization, rules = extracted["pages"], extracted["normalization"], extracted["rules"]
+            pdf_text = "".join(pages)
+            model_responses, usage = run_models(self.document_type, pdf_text, file_hash, providers=providers, pages=pages,
+                                                chunk_mode=self.chunk_mode, rules=rules, rule_mode=self.rule_mode)
+            results_store.write(file_hash, os.path.basename(name), self.document_type, model_responses, "batch")
+            if previous is not None:
+                # Keep the results of the models that succeeded last time
+                model_responses = {**previous["data"], **model_responses}
+                usage = {**previous.get("usage", {}), **usage}
+            failed = failed_models(model_responses)
+            if len(failed) == len(model_responses):
+                # Nothing worth keeping: leave no output, so the next run retries the document
+                errors = "; ".join(f"{model}: {self._error_message(model_responses[model])}" for model in failed)
+                results.put({"source": name, "status": "error", "error": f"Every model failed ({errors})", "data": model_responses})
+                return
+
+            self._write_output(output_path, {
+                "source": os.path.basename(name),
+                "file_hash": file_hash,
+                "document_type": self.document_type,
+                "normalization": normalization,
+                "rules": rules_report(rules, self.rule_mode),
+                "usage": usage,
+                "data": model_responses,
+                "failed_models": failed
+            })
+            result = {"source": name, "status": "done", "output": output_path, "data": model_responses}
+            if failed:
+                result["failed_models"] = failed
+            results.put(result)
+        except Exception as e:
+            logger.error(f"Error running models for {name}: {str(e)}", exc_info=True)
+            results.put({"source": name, "status": "error", "error": str(e)})
+
+    @staticmethod
+    def _previous_output(output_path: str, file_hash: str) -> dict | None:
+        """
+        The output an earlier run wrote for this same file, or None if there is none.
+        """
+        if not os.path.exists(output_path):
+            return None
+        try:
+            with open(output_path) as f:
+                payload = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if payload.get("file_hash") != file_hash or not isinstance(payload.get("data"), dict):
+            return None
+        return payload
+
+    @staticmethod
+    def _error_message(data) -> str:
+        return data["error"] if isinstance(data, dict) else "response could not be parsed"
+
+    @staticmethod
+    def _write_output(output_path: str, payload: dict) -> None:
+        # Write then rename, so an interrupted run never leaves a half-written file that looks done
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        temp_path = output_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(payload, f, indent=2)
+        os.replace(temp_path, output_path)
+
+
+def failed_models(model_responses: dict) -> list[str]:
+    """
+    The models whose result is an error ({"error": ...}) or a response that couldn't be parsed.
+    """
+    return [name for name, data in model_responses.items() if not isinstance(data, dict) or set(data) == {"error"}]
+
+
+def find_pdfs(directory: str, recursive: bool = False) -> list[str]:
+    """
+    Return the paths of the PDF files in a directory, sorted by name.
+    """
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        paths.extend(os.path.join(root, name) for name in files if name.lower().endswith(".pdf"))
+        if not recursive:
+            break
+    return sorted(paths)
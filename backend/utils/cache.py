@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+
+def hash_bytes(data: bytes) -> str:
+    """
+    Return the SHA-256 hex digest of a byte string, used to content-address uploaded files.
+    """
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """
+    Return the SHA-256 hex digest of a file's contents, read in chunks.
+    """
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def make_cache_key(*parts: str) -> str:
+    """
+    Build a cache key from its parts, e.g. make_cache_key("model", file_hash, "invoice", prompt_version, "gpt-4o").
+    """
+    return ":".join(str(part) for part in parts)
+
+
+class ExtractionCache:
+    """
+    Two-tier cache for extraction results: a bounded in-memory LRU in front of a SQLite file.
+
+    Values must be JSON-serializable. Entries older than ttl_seconds are treated as misses and
+    removed, and each tier is trimmed to its size limit by evicting the least recently used entries.
+    """
+
+    def __init__(self, db_path: str, max_memory_entries: int = 256, max_disk_entries: int = 10000, ttl_seconds: float = 7 * 24 * 3600,
+                 enabled: bool = True):
+        self.db_path = db_path
+        self.enabled = enabled
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.ttl_seconds = ttl_seconds
+
+        # key -> (stored_at, serialized value); values are stored serialized so callers can't mutate cached entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "sets": 0, "evictions": 0}
+
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+        self._db.commit()
+
+    def get(self, key: str):
+        """
+        Return the cached value for key, or None on a miss or expired entry.
+        """
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                stored_at, serialized = entry
+                if now - stored_at <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self._counters["memory_hits"] += 1
+                    return json.loads(serialized)
+                del self._memory[key]
+
+            row = self._db.execute("SELECT value, stored_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._counters["misses"] += 1
+                return None
+
+            serialized, stored_at = row
+            if now - stored_at > self.ttl_seconds:
+                self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self._db.commit()
+                self._counters["misses"] += 1
+                return None
+
+            self._db.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self._remember(key, stored_at, serialized)
+            self._counters["disk_hits"] += 1
+            return json.loads(serialized)
+
+    def set(self, key: str, value) -> None:
+        """
+        Store a JSON-serializable value under key in both tiers.
+        """
+        if not self.enabled:
+            return
+        now = time.time()
+        serialized = json.dumps(value)
+        with self._lock:
+            self._remember(key, now, serialized)
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache (key, value, stored_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, serialized, now, now)
+            )
+            self._evict_disk(now)
+            self._db.commit()
+            self._counters["sets"] += 1
+
+    def stats(self) -> dict:
+        """
+        Return hit/miss counters and the current size of each tier.
+        """
+        with self._lock:
+            disk_entries = self._db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            lookups = self._counters["memory_hits"] + self._counters["disk_hits"] + self._counters["misses"]
+            hits = self._counters["memory_hits"] + self._counters["disk_hits"]
+            return {
+                **self._counters,
+                "hit_rate": round(hits / lookups, 4) if lookups else 0.0,
+                "memory_entries": len(self._memory),
+                "disk_entries": disk_entries,
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            self._db.execute("DELETE FROM cache")
+            self._db.commit()
+
+    def _remember(self, key: str, stored_at: float, serialized: str) -> None:
+        # Caller holds the lock
+        self._memory[key] = (stored_at, serialized)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    def _evict_disk(self, now: float) -> None:
+        # Caller holds the lock
+        expired = self._db.execute("DELETE FROM cache WHERE stored_at < ?", (now - self.ttl_seconds,)).rowcount
+        count = self._db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        overflow = count - self.max_disk_entries
+        if overflow > 0:
+            self._db.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at LIMIT ?)",
+                (overflow,)
+            )
+        self._counters["evictions"] += max(expired, 0) + max(overflow, 0)
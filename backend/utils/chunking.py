@@ -0,0 +1,219 @@
+import os
+import json
+from collections import Counter
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from utils.extract_json import extract_json_from_response
+from utils.prompts import get_chunk_prompt
+from utils.token_utils import count_tokens
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# "auto" extracts long invoices in chunks; "single" or "chunked" force one or the other
+CHUNK_MODES = ("auto", "single", "chunked")
+# Documents whose text is longer than this are extracted in chunks when the mode is "auto"
+CHUNK_THRESHOLD_TOKENS = int(os.environ.get("CHUNK_THRESHOLD_TOKENS", "6000"))
+CHUNK_MAX_TOKENS = int(os.environ.get("CHUNK_MAX_TOKENS", "3000"))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get("CHUNK_OVERLAP_TOKENS", "200"))
+
+# Chunk calls get their own pool: they are submitted from inside the provider pool, and sharing it
+# could deadlock once every provider thread is waiting on chunks that can't be scheduled
+chunk_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("CHUNK_WORKERS", "16")),
+    thread_name_prefix="chunk"
+)
+
+LINE_ITEM_KEY_FIELDS = ("spec_tag", "description", "quantity", "unit_price", "extended_price")
+
+
+def should_chunk(document_type: str, pages: list[str], chunk_mode: str = "auto") -> bool:
+    """
+    Decide whether a document is extracted in chunks.
+
+    chunk_mode is "single" (never), "chunked" (always) or "auto" (only when the text is long).
+    Only invoices have chunk prompts, so other document types are never chunked.
+    """
+    if document_type != "invoice" or chunk_mode == "single":
+        return False
+    if chunk_mode == "chunked":
+        return True
+    return count_tokens("".join(pages)) > CHUNK_THRESHOLD_TOKENS
+
+
+def split_into_chunks(pages: list[str], max_tokens: int = CHUNK_MAX_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> list[str]:
+    """
+    Split page texts into chunks of at most max_tokens, breaking on line boundaries.
+
+    Each chunk after the first starts with the last overlap_tokens worth of lines of the previous
+    chunk, so a line item split across a chunk boundary is seen whole at least once.
+
+    Parameters:
+    pages (list): The text of each page.
+    max_tokens (int): Token budget for each chunk.
+    overlap_tokens (int): Tokens of trailing context repeated at the start of the next chunk.
+
+    Returns:
+    list: The chunk texts, in document order.
+    """
+    lines = []
+    for page in pages:
+        lines.extend((line, count_tokens(line) + 1) for line in page.splitlines())
+
+    chunks = []
+    current, current_tokens = [], 0
+    for line, tokens in lines:
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append("\n".join(text for text, _ in current))
+            # Carry the tail of this chunk into the next one
+            overlap, overlap_size = [], 0
+            for previous in reversed(current):
+                if overlap_size + previous[1] > overlap_tokens:
+                    break
+                overlap.insert(0, previous)
+                overlap_size += previous[1]
+            if overlap_size + tokens > max_tokens:
+                overlap, overlap_size = [], 0
+            current, current_tokens = overlap, overlap_size
+        current.append((line, tokens))
+        current_tokens += tokens
+
+    if current:
+        chunks.append("\n".join(text for text, _ in current))
+    return chunks
+
+
+def chunk_overlaps(chunks: list[str]) -> list[int]:
+    """
+    Count the non-empty lines each chunk repeats from the end of the previous one (0 for the first),
+    i.e. the most line items its overlap region can hold.
+    """
+    overlaps = [0]
+    for previous, chunk in zip(chunks, chunks[1:]):
+        previous_lines, lines = previous.split("\n"), chunk.split("\n")
+        size = next((size for size in range(min(len(previous_lines), len(lines)), 0, -1)
+                     if previous_lines[-size:] == lines[:size]), 0)
+        overlaps.append(sum(1 for line in lines[:size] if line.strip()))
+    return overlaps
+
+
+def header_text(pages: list[str]) -> str:
+    """
+    Return the text of the first and last pages, where invoice header and total fields live.
+    """
+    if len(pages) <= 2:
+        return "\n".join(pages)
+    return pages[0] + "\n" + pages[-1]
+
+
+def line_item_key(item) -> tuple:
+    if not isinstance(item, dict):
+        return (json.dumps(item, sort_keys=True),)
+    return tuple(" ".join(str(item.get(field)).lower().split()) for field in LINE_ITEM_KEY_FIELDS)
+
+
+def merge_chunk_results(header: dict | None, chunk_items: list[list], overlaps: list[int] | None = None) -> dict:
+    """
+    Merge the header extraction and the line items of every chunk into one invoice.
+
+    Line items keep document order. Only items that came from the overlap are dropped as duplicates:
+    the leading items of a chunk that match, copy for copy, one of the last items of the previous
+    chunk. Anything after the first unmatched item is kept, as are repeats beyond the number of
+    copies the previous chunk ended with, since invoices can legitimately list the same item twice.
+
+    Parameters:
+    header (dict): The header fields extraction.
+    chunk_items (list): The line items extracted from each chunk, in document order.
+    overlaps (list): For each chunk, how many items its overlap region can hold (see chunk_overlaps).
+    Defaults to the whole previous chunk.
+    """
+    merged = dict(header or {})
+    merged.pop("invoice_items", None)
+
+    invoice_items = []
+    previous = []
+    for index, items in enumerate(chunk_items):
+        limit = len(previous) if overlaps is None else min(overlaps[index], len(previous))
+        # The previous chunk's copies of the overlap lines are its last items
+        overlap_copies = Counter(line_item_key(item) for item in previous[len(previous) - limit:])
+        start = 0
+        for item in items:
+            key = line_item_key(item)
+            if not overlap_copies[key]:
+                break
+            overlap_copies[key] -= 1
+            start += 1
+        invoice_items.extend(items[start:])
+        previous = items
+
+    merged["invoice_items"] = invoice_items
+    return merged
+
+
+def add_usage(total: dict, usage: dict | None) -> None:
+    for key, value in (usage or {}).items():
+        total[key] = total.get(key, 0) + value
+
+
+def reduce_chunk_results(header_result: tuple, item_results: list[tuple], overlaps: list[int] | None = None) -> tuple[str, dict]:
+    """
+    Merge the (content, usage) responses of a header call and the per-chunk line item calls.
+    overlaps is passed to merge_chunk_results.
+
+    Returns:
+    tuple: (the merged invoice as a JSON string, the summed token usage).
+    """
+    usage = {}
+    header_content, header_usage = header_result
+    add_usage(usage, header_usage)
+    header = extract_json_from_response(header_content)
+    chunk_items = []
+    for index, (content, chunk_usage) in enumerate(item_results):
+        add_usage(usage, chunk_usage)
+        data = extract_json_from_response(content)
+        items = data.get("invoice_items") if isinstance(data, dict) else data
+        if not isinstance(items, list):
+            logger.error(f"Chunk {index + 1} of {len(item_results)} returned no line item list")
+            items = []
+        chunk_items.append(items)
+
+    logger.debug(f"Merged {len(item_results)} chunks into one invoice")
+    return json.dumps(merge_chunk_results(header, chunk_items, overlaps)), usage
+
+
+def make_chunked_call(call, pages: list[str]):
+    """
+    Wrap a provider call function so it extracts an invoice map-reduce style.
+
+    The returned function calls the provider once for the header fields and once per chunk for the
+    line items, all in parallel, and returns the merged invoice as a JSON string along with the
+    summed token usage, so it can be used anywhere a provider call function is.
+    """
+    chunks = split_into_chunks(pages)
+    overlaps = chunk_overlaps(chunks)
+
+    def chunked_call(system_prompt: str, prompt: str) -> tuple[str, dict]:
+        header_future = chunk_executor.submit(call, *get_chunk_prompt("invoice_header", header_text(pages)))
+        item_futures = [chunk_executor.submit(call, *get_chunk_prompt("invoice_items", chunk)) for chunk in chunks]
+        return reduce_chunk_results(header_future.result(), [future.result() for future in item_futures], overlaps)
+
+    return chunked_call
+
+
+def make_async_chunked_call(call, pages: list[str]):
+    """
+    make_chunked_call for an async provider call function; the chunk calls run concurrently as tasks.
+    """
+    chunks = split_into_chunks(pages)
+    overlaps = chunk_overlaps(chunks)
+
+    async def chunked_call(system_prompt: str, prompt: str) -> tuple[str, dict]:
+        header_result, *item_results = await asyncio.gather(
+            call(*get_chunk_prompt("invoice_header", header_text(pages))),
+            *(call(*get_chunk_prompt("invoice_items", chunk)) for chunk in chunks)
+        )
+        return reduce_chunk_results(header_result, item_results, overlaps)
+
+    return chunked_call
@@ -5,35 +5,286 @@ import logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-def extract_json_from_response(response_content):
+# Characters of a response quoted in error logs; whole responses with hundreds of line items are too big to log
+LOG_SNIPPET_CHARS = 200
+
+CLOSERS = {"{": "}", "[": "]"}
+
+
+def _snippet(text: str) -> str:
+    if len(text) <= 2 * LOG_SNIPPET_CHARS:
+        return text
+    return f"{text[:LOG_SNIPPET_CHARS]} ... {text[-LOG_SNIPPET_CHARS:]}"
+
+
+class IncrementalJSONParser:
     """
-    Extracts a JSON object from a string response.
+    Parses a JSON object as it streams in, reporting each top-level field as soon as it is complete.
+
+    Text before the first "{" (e.g. a ```json fence) is skipped. Elements of a top-level array, like
+    invoice_items, are reported one by one as they close instead of as one field at the end. Every
+    character is scanned once, however the text is split into chunks.
+
+    Positions are offsets into the whole response. The chunks are kept in a list for repaired(), and
+    only the text of the value being scanned is kept as a string, so feeding stays linear in the
+    length of the response.
+    """
+
+    def __init__(self):
+        self.fields = {}
+        self._chunks = []
+        # The unparsed tail of the response, starting at offset _buffer_start
+        self._buffer = ""
+        self._buffer_start = 0
+        self._pos = 0
+        self._start = None
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        # Per open object: True while the next string is a key
+        self._expect_key = []
+        self._key = None
+        self._member_start = None
+        self._item_start = None
+        self._items = {}
+        # A top-level array that closed, whose field is set once its member ends
+        self._closed_array = None
+        # (index just past the last complete value, containers open at that point)
+        self._safe = None
+        self._done = False
+
+    def feed(self, chunk: str) -> list[tuple]:
+        """
+        Add the next piece of the response.
+
+        Returns:
+        list: What completed in this chunk, in order: ("field", key, value) for a top-level field, and
+        ("item", key, value) for each element of a top-level array. A top-level array is reported
+        through its items only, not again as a field.
+        """
+        self._chunks.append(chunk)
+        if self._done:
+            return []
+        self._trim_buffer()
+        self._buffer += chunk
+        events = []
+        # pos is an offset into the response; text[pos - base] is the character at pos
+        text, base = self._buffer, self._buffer_start
+        pos, end = self._pos, self._buffer_start + len(self._buffer)
+        while pos < end and not self._done:
+            if self._start is None:
+                found = text.find("{", pos - base)
+                if found == -1:
+                    pos = end
+                    break
+                pos = found + base
+                self._start = pos
+                self._open("{", pos)
+                pos += 1
+                continue
+
+            if self._in_string:
+                # Jump straight to the next quote or backslash rather than stepping through the string
+                if self._escape:
+                    self._escape = False
+                    pos += 1
+                    continue
+                quote = text.find('"', pos - base)
+                backslash = text.find("\\", pos - base, len(text) if quote == -1 else quote)
+                if backslash != -1:
+                    self._escape = True
+                    pos = backslash + base + 1
+                elif quote != -1:
+                    self._in_string = False
+                    self._close_string(quote + base)
+                    pos = quote + base + 1
+                else:
+                    pos = end
+                    break
+                continue
+
+            char = text[pos - base]
+            if char == '"':
+                self._in_string = True
+                self._string_start = pos
+            elif char in "{[":
+                self._open(char, pos)
+            elif char in "}]":
+                self._end_member(pos, events)
+                self._stack.pop()
+                if char == "}":
+                    self._expect_key.pop()
+                elif len(self._stack) == 1 and self._key in self._items:
+                    self._closed_array = self._key
+                self._mark_safe(pos + 1)
+                if not self._stack:
+                    self._done = True
+            elif char == ",":
+                self._mark_safe(pos)
+                self._end_member(pos, events)
+                if self._stack[-1] == "{":
+                    self._expect_key[-1] = True
+                if len(self._stack) == 1:
+                    self._member_start = pos + 1
+                elif len(self._stack) == 2 and self._stack[-1] == "[":
+                    self._item_start = pos + 1
+            elif char == ":" and self._stack[-1] == "{":
+                self._expect_key[-1] = False
+            pos += 1
+        self._pos = pos
+        return events
+
+    @property
+    def text(self) -> str:
+        """
+        The response so far.
+        """
+        if len(self._chunks) > 1:
+            self._chunks = ["".join(self._chunks)]
+        return self._chunks[0] if self._chunks else ""
+
+    def _trim_buffer(self) -> None:
+        # Drop the scanned text that no pending key, field or array item still needs
+        if self._start is None:
+            keep = self._pos
+        else:
+            starts = [self._pos, self._member_start, self._item_start, self._string_start if self._in_string else None]
+            keep = min(start for start in starts if start is not None)
+        if keep > self._buffer_start:
+            self._buffer = self._buffer[keep - self._buffer_start:]
+            self._buffer_start = keep
+
+    def _slice(self, start: int, end: int) -> str:
+        return self._buffer[start - self._buffer_start:end - self._buffer_start]
+
+    def _open(self, char: str, pos: int) -> None:
+        self._stack.append(char)
+        if char == "{":
+            self._expect_key.append(True)
+        depth = len(self._stack)
+        if depth == 1:
+            self._member_start = pos + 1
+        elif depth == 2 and char == "[":
+            self._item_start = pos + 1
+            self._items[self._key] = []
+            # The field is collected from its items, see feed
+            self._member_start = None
+        self._mark_safe(pos + 1)
+
+    def _close_string(self, pos: int) -> None:
+        if self._stack[-1] == "{" and self._expect_key[-1]:
+            if len(self._stack) == 1:
+                self._key = json.loads(self._slice(self._string_start, pos + 1))
+            return
+        self._mark_safe(pos + 1)
+
+    def _mark_safe(self, pos: int) -> None:
+        self._safe = (pos, tuple(self._stack))
+
+    def _end_member(self, pos: int, events: list) -> None:
+        """
+        Parse the top-level field or array element that ends at pos, if one does.
+        """
+        depth = len(self._stack)
+        if depth == 1 and self._closed_array is not None:
+            # A top-level array is the list of its items, so its text never has to be kept whole
+            self.fields[self._closed_array] = self._items[self._closed_array]
+            self._closed_array = None
+        elif depth == 1 and self._member_start is not None:
+            member = self._slice(self._member_start, pos).strip()
+            self._member_start = None
+            if not member:
+                return
+            try:
+                (key, value), = json.loads("{" + member + "}").items()
+            except ValueError:
+                return
+            self.fields[key] = value
+            if key not in self._items:
+                events.append(("field", key, value))
+        elif depth == 2 and self._stack[-1] == "[" and self._item_start is not None and self._key in self._items:
+            item = self._slice(self._item_start, pos).strip()
+            self._item_start = None
+            if not item:
+                return
+            try:
+                value = json.loads(item)
+            except ValueError:
+                return
+            self._items[self._key].append(value)
+            events.append(("item", self._key, value))
+
+    def repaired(self):
+        """
+        The text so far closed off at its last complete value, e.g. after a response was cut off by
+        max_tokens: a half-written key or value is dropped and the open arrays and objects are closed.
+
+        Returns:
+        dict: The parsed object, or None if no object has started.
+        """
+        if self._safe is None:
+            return None
+        pos, stack = self._safe
+        text = self.text[self._start:pos]
+        try:
+            return json.loads(text + "".join(CLOSERS[char] for char in reversed(stack)))
+        except ValueError:
+            return None
+
+
+def repair_truncated_json(text: str):
+    """
+    Parse a JSON object that was cut off part way, see IncrementalJSONParser.repaired.
+    """
+    parser = IncrementalJSONParser()
+    parser.feed(text)
+    return parser.repaired()
+
+
+def parse_json_response(response_content):
+    """
+    Extracts a JSON object from a string response, noting whether it had to be repaired.
 
     Parameters:
     response_content (str): The response string from which to extract the JSON object.
 
     Returns:
-    dict: The extracted JSON object as a Python dictionary, or None if parsing fails.
+    tuple: (the extracted JSON object, or None if parsing fails;
+            True if the response was cut off and only the complete part was kept).
     """
-    logger.debug("Raw response content: %s", response_content)
     try:
         # Directly parse the JSON string into a Python dictionary
-        parsed_json = json.loads(response_content)
-        logger.debug("Parsed JSON object: %s", parsed_json)
-        return parsed_json
+        return json.loads(response_content), False
     except json.JSONDecodeError as e:
-        logger.error("Error decoding JSON: %s", e)
-        logger.error("Problematic JSON string: %s", response_content)
-        # Attempt to trim the string to extract JSON
-        start_index = response_content.find('{')
-        end_index = response_content.rfind('}') + 1
-        if start_index != -1 and end_index != -1:
-            trimmed_content = response_content[start_index:end_index]
-            try:
-                parsed_json = json.loads(trimmed_content)
-                logger.debug("Parsed JSON object after trimming: %s", parsed_json)
-                return parsed_json
-            except json.JSONDecodeError as e:
-                logger.error("Error decoding JSON after trimming: %s", e)
-                return None
-        return None 
\ No newline at end of file
+        logger.debug("Response of %d characters isn't plain JSON (%s), trimming it", len(response_content), e)
+
+    # Attempt to trim the string to extract JSON, e.g. from a ```json fence
+    start_index = response_content.find('{')
+    end_index = response_content.rfind('}') + 1
+    if start_index != -1 and end_index > start_index:
+        try:
+            return json.loads(response_content[start_index:end_index]), False
+        except json.JSONDecodeError:
+            pass
+
+    # The response may have been cut off, e.g. by max_tokens; keep whatever was complete
+    repaired = repair_truncated_json(response_content)
+    if repaired is not None:
+        logger.warning("Repaired truncated JSON response of %d characters", len(response_content))
+        return repaired, True
+    logger.error("Error decoding JSON from response of %d characters: %s", len(response_content), _snippet(response_content))
+    return None, False
+
+
+def extract_json_from_response(response_content):
+    """
+    Extracts a JSON object from a string response.
+
+    Parameters:
+    response_content (str): The response string from which to extract the JSON object.
+
+    Returns:
+    dict: The extracted JSON object as a Python dictionary, or None if parsing fails.
+    """
+    return parse_json_response(response_content)[0]
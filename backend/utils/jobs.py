@@ -0,0 +1,499 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import socket
+import sqlite3
+import logging
+import threading
+from utils.cache import hash_bytes
+from utils.normalize import normalize_pages
+from utils.pipeline import OUTPUTS_DIR, RULES_MODEL, extract_document_pages, extract_rule_fields, iter_model_results, rules_report
+from utils.providers import select_providers
+from utils.results_store import results_store
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Extraction jobs outlive the request that submitted them: the queue, each job's stage checkpoints
+# and the uploaded PDFs are kept on disk, so jobs survive a restart and pick up where they stopped.
+JOBS_DIR = os.environ.get("JOBS_DIR", os.path.join(OUTPUTS_DIR, "jobs"))
+# Worker threads per process; 0 only accepts jobs, e.g. when workers run in another process
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+# Seconds an idle worker waits before checking the queue again, for jobs submitted by other processes
+JOB_POLL_SECONDS = float(os.environ.get("JOB_POLL_SECONDS", "1"))
+# A running job whose worker hasn't renewed its lease for this long is assumed lost (e.g. the
+# process was killed) and is picked up again by the next free worker
+JOB_LEASE_SECONDS = float(os.environ.get("JOB_LEASE_SECONDS", "60"))
+# Jobs that keep getting lost, e.g. a PDF that crashes the OCR, are failed after this many tries
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+
+# How often /api/jobs/<id>/events checks a job for progress
+JOB_EVENTS_POLL_SECONDS = float(os.environ.get("JOB_EVENTS_POLL_SECONDS", "0.5"))
+
+JOB_STATUSES = ("queued", "running", "done", "error")
+EXTRACT_STAGE = "extract_text"
+MODEL_STAGE_PREFIX = "model:"
+
+
+class LeaseLostError(Exception):
+    """
+    Raised when a worker writes to a job it no longer holds the lease of, because the lease expired
+    and the job was claimed again. The worker must stop working on the job.
+    """
+
+
+def job_options(options: dict) -> dict:
+    """
+    The parts of parse_extraction_options' result a job keeps, in a JSON-serializable form. Jobs
+    always run every chosen model; the routing policy only applies to /api/process-pdf.
+    """
+    return {
+        "document_type": options["document_type"],
+        "chunk_mode": options["chunk_mode"],
+        "normalizers": options["normalizers"],
+        "rule_mode": options["rule_mode"],
+        "models": list(options["providers"]),
+    }
+
+
+class JobQueue:
+    """
+    Durable queue of extraction jobs in a SQLite file, shared by every process that opens it.
+
+    A job is claimed by one worker at a time under a lease. Every write a worker makes to a job is
+    checked against the lease token it was given, so once an expired lease has been claimed by
+    another worker, the first worker can no longer change the job. Each stage's output is saved as a
+    checkpoint as soon as it completes, so a job that is picked up again skips the stages it had
+    already done. Jobs are deduplicated on the file hash and extraction options: submitting the
+    same file again returns the existing job unless that one failed.
+    """
+
+    def __init__(self, jobs_dir: str = JOBS_DIR, lease_seconds: float = JOB_LEASE_SECONDS, max_attempts: int = JOB_MAX_ATTEMPTS):
+        self.jobs_dir = jobs_dir
+        self.uploads_dir = os.path.join(jobs_dir, "uploads")
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+
+        os.makedirs(self.uploads_dir, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(jobs_dir, "jobs.sqlite3"), timeout=30, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, dedup_key TEXT NOT NULL, file_hash TEXT NOT NULL, filename TEXT, options TEXT NOT NULL, "
+            "status TEXT NOT NULL, stage TEXT, result TEXT, error TEXT, attempts INTEGER NOT NULL DEFAULT 0, "
+            "worker TEXT, lease_token TEXT, lease_expires_at REAL, "
+            "created_at REAL NOT NULL, updated_at REAL NOT NULL, finished_at REAL)"
+        )
+        # One live job per file and options; failed jobs don't block a retry
+        self._db.execute("CREATE UNIQUE INDEX IF NOT EXISTS jobs_dedup ON jobs (dedup_key) WHERE status != 'error'")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS job_checkpoints ("
+            "job_id TEXT NOT NULL, stage TEXT NOT NULL, data TEXT NOT NULL, completed_at REAL NOT NULL, "
+            "PRIMARY KEY (job_id, stage))"
+        )
+        self._db.commit()
+
+    def upload_path(self, file_hash: str) -> str:
+        return os.path.join(self.uploads_dir, f"{file_hash}.pdf")
+
+    def submit(self, pdf_source, file_hash: str, filename: str, options: dict) -> tuple[dict, bool]:
+        """
+        Queue a PDF for extraction, or find the job already queued, running or done for it.
+
+        Parameters:
+        pdf_source (bytes | str): The PDF bytes, or the path of a spooled upload, which is copied into the queue.
+        file_hash (str): SHA-256 hex digest of the PDF.
+        filename (str): The uploaded file's name, for display.
+        options (dict): JSON-serializable extraction options, see JobWorkerPool.run_job.
+
+        Returns:
+        tuple: (the job, as returned by get; True if it was created, False if an existing job was returned).
+        """
+        dedup_key = hash_bytes(json.dumps([file_hash, options], sort_keys=True).encode("utf-8"))
+        with self._lock:
+            # Take the write lock before looking: _close deletes the upload once no queued or running job
+            # needs it, so storing it and queueing the job must not interleave with that in another process
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                existing = self._db.execute(
+                    "SELECT id FROM jobs WHERE dedup_key = ? AND status != 'error'", (dedup_key,)
+                ).fetchone()
+                if existing is not None:
+                    self._db.rollback()
+                    return self._get(existing["id"]), False
+
+                self._store_upload(pdf_source, file_hash)
+                job_id = uuid.uuid4().hex
+                now = time.time()
+                self._db.execute(
+                    "INSERT INTO jobs (id, dedup_key, file_hash, filename, options, status, stage, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, 'queued', 'queued', ?, ?)",
+                    (job_id, dedup_key, file_hash, filename, json.dumps(options), now, now)
+                )
+                self._db.commit()
+            except BaseException:
+                self._db.rollback()
+                raise
+            logger.debug(f"Queued job {job_id} for {filename}")
+            return self._get(job_id), True
+
+    def claim(self, worker: str) -> dict | None:
+        """
+        Take the oldest queued job, or a running job whose lease has expired, and lease it to worker.
+
+        Returns:
+        dict: The job, with its options, checkpoints and lease_token, or None if there is nothing to do.
+        """
+        with self._lock:
+            now = time.time()
+            # Jobs that were lost too many times are failed rather than retried forever
+            exhausted = self._db.execute(
+                "SELECT id FROM jobs WHERE status = 'running' AND lease_expires_at < ? AND attempts >= ?",
+                (now, self.max_attempts)
+            ).fetchall()
+            for row in exhausted:
+                try:
+                    self._close(row["id"], None, "error", error=f"Gave up after {self.max_attempts} attempts")
+                except LeaseLostError:
+                    # Another process closed or claimed it first
+                    pass
+            token = uuid.uuid4().hex
+            # One statement, so two processes can't claim the same job
+            claimed = self._db.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, lease_token = ?, lease_expires_at = ?, "
+                "attempts = attempts + 1, updated_at = ? "
+                "WHERE id = (SELECT id FROM jobs WHERE status = 'queued' OR (status = 'running' AND lease_expires_at < ?) "
+                "ORDER BY created_at LIMIT 1)",
+                (worker, token, now + self.lease_seconds, now, now)
+            ).rowcount
+            self._db.commit()
+            if not claimed:
+                return None
+            row = self._db.execute("SELECT id FROM jobs WHERE lease_token = ?", (token,)).fetchone()
+            job = self._get(row["id"])
+            job["options"] = json.loads(self._db.execute("SELECT options FROM jobs WHERE id = ?", (row["id"],)).fetchone()[0])
+            job["checkpoints"] = self._checkpoints(row["id"])
+            job["lease_token"] = token
+            return job
+
+    def renew_leases(self, leases: dict) -> list[str]:
+        """
+        Extend the leases of running jobs.
+
+        Parameters:
+        leases (dict): job id -> the lease token it was claimed with.
+
+        Returns:
+        list: The ids of the jobs whose lease had already been lost.
+        """
+        with self._lock:
+            now = time.time()
+            lost = [
+                job_id for job_id, lease_token in leases.items()
+                if not self._db.execute(
+                    "UPDATE jobs SET lease_expires_at = ? WHERE id = ? AND lease_token = ? AND status = 'running'",
+                    (now + self.lease_seconds, job_id, lease_token)
+                ).rowcount
+            ]
+            self._db.commit()
+            return lost
+
+    def set_stage(self, job_id: str, lease_token: str, stage: str) -> None:
+        with self._lock:
+            self._fence(self._db.execute(
+                "UPDATE jobs SET stage = ?, updated_at = ? WHERE id = ? AND lease_token = ? AND status = 'running'",
+                (stage, time.time(), job_id, lease_token)
+            ), job_id)
+            self._db.commit()
+
+    def checkpoint(self, job_id: str, lease_token: str, stage: str, data) -> None:
+        """
+        Save the JSON-serializable output of a completed stage.
+
+        Raises:
+        LeaseLostError: If the job is no longer leased with lease_token; nothing is saved.
+        """
+        with self._lock:
+            now = time.time()
+            # Checked and written in one transaction, so the job can't change hands in between
+            self._fence(self._db.execute(
+                "UPDATE jobs SET updated_at = ? WHERE id = ? AND lease_token = ? AND status = 'running'",
+                (now, job_id, lease_token)
+            ), job_id)
+            self._db.execute(
+                "INSERT OR REPLACE INTO job_checkpoints (job_id, stage, data, completed_at) VALUES (?, ?, ?, ?)",
+                (job_id, stage, json.dumps(data), now)
+            )
+            self._db.commit()
+
+    def finish(self, job_id: str, lease_token: str, result: dict) -> None:
+        with self._lock:
+            self._close(job_id, lease_token, "done", result=json.dumps(result))
+
+    def fail(self, job_id: str, lease_token: str, error: str) -> None:
+        with self._lock:
+            self._close(job_id, lease_token, "error", error=error)
+
+    def get(self, job_id: str) -> dict | None:
+        """
+        The job's status, for clients: {"id", "status", "stage", "filename", "file_hash", "attempts",
+        "created_at", "updated_at", "finished_at", "completed_stages", and "result" or "error" once it
+        has finished}, or None if there is no such job.
+        """
+        with self._lock:
+            return self._get(job_id)
+
+    def _get(self, job_id: str) -> dict | None:
+        # Caller holds the lock
+        row = self._db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        stages = self._db.execute(
+            "SELECT stage FROM job_checkpoints WHERE job_id = ? ORDER BY completed_at", (job_id,)
+        ).fetchall()
+        job = {
+            "id": row["id"],
+            "status": row["status"],
+            "stage": row["stage"],
+            "filename": row["filename"],
+            "file_hash": row["file_hash"],
+            "attempts": row["attempts"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+            "finished_at": row["finished_at"],
+            "completed_stages": [stage["stage"] for stage in stages],
+        }
+        if row["result"] is not None:
+            job["result"] = json.loads(row["result"])
+        if row["error"] is not None:
+            job["error"] = row["error"]
+        return job
+
+    def _checkpoints(self, job_id: str) -> dict:
+        # Caller holds the lock
+        rows = self._db.execute("SELECT stage, data FROM job_checkpoints WHERE job_id = ?", (job_id,)).fetchall()
+        return {row["stage"]: json.loads(row["data"]) for row in rows}
+
+    def _fence(self, cursor: sqlite3.Cursor, job_id: str) -> None:
+        # Caller holds the lock and has just run a write conditioned on the job's lease token
+        if not cursor.rowcount:
+            self._db.rollback()
+            raise LeaseLostError(f"Job {job_id} is no longer leased to this worker")
+
+    def _close(self, job_id: str, lease_token: str | None, status: str, result: str | None = None,
+               error: str | None = None) -> None:
+        # Caller holds the lock. lease_token is None when the queue itself gives up on the job.
+        now = time.time()
+        # One write transaction from closing the job to deleting its upload, see submit
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            self._fence(self._db.execute(
+                "UPDATE jobs SET status = ?, stage = ?, result = ?, error = ?, lease_expires_at = NULL, "
+                "updated_at = ?, finished_at = ? WHERE id = ? AND status = 'running' AND lease_token IS COALESCE(?, lease_token)",
+                (status, status, result, error, now, now, job_id, lease_token)
+            ), job_id)
+            file_hash = self._db.execute("SELECT file_hash FROM jobs WHERE id = ?", (job_id,)).fetchone()["file_hash"]
+            # The PDF is only needed until the last job for it has finished
+            active = self._db.execute(
+                "SELECT COUNT(*) FROM jobs WHERE file_hash = ? AND status IN ('queued', 'running')", (file_hash,)
+            ).fetchone()[0]
+            if not active and os.path.exists(self.upload_path(file_hash)):
+                os.remove(self.upload_path(file_hash))
+            self._db.commit()
+        except BaseException:
+            self._db.rollback()
+            raise
+
+    def _store_upload(self, pdf_source, file_hash: str) -> None:
+        # Caller holds the lock. Write then rename, so a crash never leaves a truncated PDF behind.
+        path = self.upload_path(file_hash)
+        if os.path.exists(path):
+            return
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        if isinstance(pdf_source, str):
+            shutil.copyfile(pdf_source, temp_path)
+        else:
+            with open(temp_path, "wb") as f:
+                f.write(pdf_source)
+        os.replace(temp_path, path)
+
+
+class JobWorkerPool:
+    """
+    Worker threads that run the jobs of a JobQueue, plus one thread that keeps their leases alive.
+
+    Every process can run a pool against the same queue; each job is only run by one worker at a time.
+    """
+
+    def __init__(self, queue: JobQueue, workers: int = JOB_WORKERS, poll_seconds: float = JOB_POLL_SECONDS):
+        self.queue = queue
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self._threads = []
+        # job id -> lease token, for the jobs this pool is running
+        self._running = {}
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def start(self) -> None:
+        """
+        Start the worker threads, unless they are running already.
+        """
+        with self._start_lock:
+            if self._threads or self.workers <= 0:
+                return
+            self._stopping.clear()
+            for index in range(self.workers):
+                thread = threading.Thread(target=self._work, args=(f"{socket.gethostname()}:{os.getpid()}:{index}",),
+                                          name=f"job-worker-{index}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            heartbeat = threading.Thread(target=self._heartbeat, name="job-heartbeat", daemon=True)
+            heartbeat.start()
+            self._threads.append(heartbeat)
+            logger.debug(f"Started {self.workers} job workers")
+
+    def stop(self, timeout: float | None = None) -> None:
+        """
+        Stop taking jobs. Jobs still running are picked up again by the next pool once their lease expires.
+        """
+        with self._start_lock:
+            self._stopping.set()
+            self._wake.set()
+            for thread in self._threads:
+                thread.join(timeout)
+            self._threads = []
+
+    def notify(self) -> None:
+        """
+        Wake an idle worker, e.g. right after a job was submitted in this process.
+        """
+        self._wake.set()
+
+    def _work(self, worker: str) -> None:
+        while not self._stopping.is_set():
+            try:
+                job = self.queue.claim(worker)
+            except sqlite3.Error as e:
+                logger.error(f"Error claiming a job: {str(e)}", exc_info=True)
+                job = None
+            if job is None:
+                self._wake.wait(self.poll_seconds)
+                self._wake.clear()
+                continue
+
+            with self._lock:
+                self._running[job["id"]] = job["lease_token"]
+            try:
+                if job["checkpoints"]:
+                    logger.debug(f"Resuming job {job['id']} after {', '.join(job['checkpoints'])}")
+                self.queue.finish(job["id"], job["lease_token"], self.run_job(job))
+            except LeaseLostError as e:
+                # Another worker has the job now, and its result is the one that counts
+                logger.warning(f"Stopped working on job {job['id']}: {str(e)}")
+            except Exception as e:
+                logger.error(f"Job {job['id']} failed: {str(e)}", exc_info=True)
+                try:
+                    self.queue.fail(job["id"], job["lease_token"], str(e))
+                except LeaseLostError as lost:
+                    logger.warning(f"Not failing job {job['id']}: {str(lost)}")
+            finally:
+                with self._lock:
+                    self._running.pop(job["id"], None)
+
+    def _heartbeat(self) -> None:
+        while not self._stopping.wait(self.queue.lease_seconds / 3):
+            with self._lock:
+                running = dict(self._running)
+            if running:
+                try:
+                    for job_id in self.queue.renew_leases(running):
+                        # The job's next checkpoint raises LeaseLostError, which stops it
+                        logger.warning(f"Lost the lease on job {job_id}; it was claimed by another worker")
+                except sqlite3.Error as e:
+                    logger.error(f"Error renewing job leases: {str(e)}", exc_info=True)
+
+    def run_job(self, job: dict) -> dict:
+        """
+        Run a claimed job through extraction and the models, skipping the stages it has checkpoints for.
+        Raises LeaseLostError as soon as the job turns out to have been claimed by another worker.
+
+        job["options"] holds {"document_type", "chunk_mode", "normalizers", "rule_mode", "models": the
+        provider names to run}.
+
+        Returns:
+        dict: {"data", "usage", "normalization", "rules"} as in the /api/process-pdf response.
+        """
+        job_id, lease_token, file_hash, options = job["id"], job["lease_token"], job["file_hash"], job["options"]
+        checkpoints = job["checkpoints"]
+        document_type, chunk_mode, rule_mode = options["document_type"], options["chunk_mode"], options["rule_mode"]
+
+        extracted = checkpoints.get(EXTRACT_STAGE)
+        if extracted is None:
+            self.queue.set_stage(job_id, lease_token, EXTRACT_STAGE)
+            pages = extract_document_pages(self.queue.upload_path(file_hash), file_hash)
+            pages, normalization = normalize_pages(pages, options["normalizers"])
+            extracted = {"pages": pages, "normalization": normalization}
+            self.queue.checkpoint(job_id, lease_token, EXTRACT_STAGE, extracted)
+        pages = extracted["pages"]
+        pdf_text = "".join(pages)
+        rules = extract_rule_fields(document_type, pdf_text, rule_mode)
+
+        providers = select_providers(",".join(options["models"]))
+        results = {
+            stage[len(MODEL_STAGE_PREFIX):]: data for stage, data in checkpoints.items() if stage.startswith(MODEL_STAGE_PREFIX)
+        }
+        remaining = {name: call for name, call in providers.items() if name not in results}
+        if remaining:
+            self.queue.set_stage(job_id, lease_token, "models")
+            for name, data, usage in iter_model_results(document_type, pdf_text, file_hash, remaining, pages, chunk_mode,
+                                                        rules=rules, rule_mode=rule_mode):
+                results[name] = {"data": data, "usage": usage}
+                # Failed calls aren't checkpointed, so they are tried again if the job is resumed
+                if not (isinstance(data, dict) and set(data) == {"error"}):
+                    self.queue.checkpoint(job_id, lease_token, MODEL_STAGE_PREFIX + name, results[name])
+
+        order = [name for name in [*providers, RULES_MODEL] if name in results]
+        data = {name: results[name]["data"] for name in order}
+        results_store.write(file_hash, job["filename"], document_type, data, "job")
+        return {
+            "data": data,
+            "usage": {name: results[name]["usage"] for name in order if results[name]["usage"] is not None},
+            "normalization": extracted["normalization"],
+            "rules": rules_report(rules, rule_mode),
+        }
+
+
+_job_queue = None
+_job_workers = None
+_job_lock = threading.Lock()
+
+
+def get_job_queue() -> JobQueue:
+    # Created on first use, so importing this module doesn't create the jobs database
+    global _job_queue
+    with _job_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue()
+        return _job_queue
+
+
+def get_job_workers() -> JobWorkerPool:
+    """
+    The pool that runs this process's jobs. It is only created here; the server that serves the job
+    endpoints starts it once it is serving, so scripts that import the app don't run jobs.
+    """
+    global _job_workers
+    queue = get_job_queue()
+    with _job_lock:
+        if _job_workers is None:
+            _job_workers = JobWorkerPool(queue)
+        return _job_workers
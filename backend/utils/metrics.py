@@ -0,0 +1,266 @@
+import os
+import math
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+# Upper bounds in seconds; provider calls take seconds to minutes, parsing and prompt building microseconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_sample(name: str, labels: dict, value) -> str:
+    label_text = ",".join(f'{key}="{_escape_label(label)}"' for key, label in labels.items())
+    return f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}"
+
+
+class Counter:
+    """
+    A count that only goes up, kept per combination of label values.
+    """
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+
+class Histogram:
+    """
+    Observed values counted into cumulative buckets, with their sum and count, per combination of label values.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            # [per-bucket counts, observation count, sum]
+            entry = self._values.setdefault(key, [[0] * len(self.buckets), 0, 0.0])
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][index] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), count, total)) for key, (counts, count, total) in self._values.items())
+        for key, (counts, count, total) in values:
+            labels = dict(zip(self.labelnames, key))
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield self.name + "_bucket", {**labels, "le": str(float(bound))}, bucket_count
+            yield self.name + "_bucket", {**labels, "le": "+Inf"}, count
+            yield self.name + "_sum", labels, round(total, 6)
+            yield self.name + "_count", labels, count
+
+
+class LatencyWindow:
+    """
+    The most recent durations observed per label (e.g. provider), for percentiles that follow
+    current conditions rather than the whole lifetime of the process like a Histogram does.
+    """
+
+    def __init__(self, size: int = 100):
+        self.size = size
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, key: str, seconds: float) -> None:
+        with self._lock:
+            self._values.setdefault(key, deque(maxlen=self.size)).append(seconds)
+
+    def count(self, key: str) -> int:
+        with self._lock:
+            return len(self._values.get(key, ()))
+
+    def percentile(self, key: str, pct: float) -> float | None:
+        """
+        Nearest-rank percentile of the window, or None if nothing has been observed for key.
+        """
+        with self._lock:
+            ordered = sorted(self._values.get(key, ()))
+        if not ordered:
+            return None
+        index = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+    def stats(self, key: str) -> dict:
+        p50, p90 = self.percentile(key, 50), self.percentile(key, 90)
+        return {
+            "samples": self.count(key),
+            "p50_seconds": round(p50, 3) if p50 is not None else None,
+            "p90_seconds": round(p90, 3) if p90 is not None else None,
+        }
+
+
+class MetricsRegistry:
+    """
+    The metrics exposed on /metrics, rendered in the Prometheus text format.
+
+    Collectors are called at scrape time for values that live elsewhere, like the cache's hit
+    counters; each returns (name, type, documentation, [(labels, value), ...]) tuples.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def counter(self, name: str, documentation: str, labelnames=()) -> Counter:
+        metric = Counter(name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        metric = Histogram(name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector) -> None:
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(_format_sample(name, labels, value) for name, labels, value in metric.samples())
+        for collector in self._collectors:
+            for name, metric_type, documentation, samples in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                lines.extend(_format_sample(name, labels, value) for labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "extraction_stage_duration_seconds",
+    "Time spent in each extraction stage; provider is set for provider calls and parsing.",
+    ["stage", "provider"]
+)
+STAGE_ERRORS = REGISTRY.counter(
+    "extraction_stage_errors_total",
+    "Extraction stages that raised an error.",
+    ["stage", "provider"]
+)
+PROVIDER_TOKENS = REGISTRY.counter(
+    "extraction_provider_tokens_total",
+    "Tokens reported by the providers, by kind (input, output, cache_read_input, cache_creation_input).",
+    ["provider", "kind"]
+)
+PDF_PAGES = REGISTRY.counter(
+    "extraction_pdf_pages_total",
+    "PDF pages whose text was extracted, by method (text_layer or ocr).",
+    ["method"]
+)
+HTTP_REQUESTS = REGISTRY.counter(
+    "extraction_http_requests_total",
+    "HTTP requests handled, by route and status code.",
+    ["endpoint", "method", "status"]
+)
+HTTP_SECONDS = REGISTRY.histogram(
+    "extraction_http_request_duration_seconds",
+    "Time until the response starts; for streaming routes that is before the stream is sent.",
+    ["endpoint", "method"]
+)
+
+# Durations of the latest successful calls to each provider, which routing decisions are based on
+PROVIDER_LATENCY = LatencyWindow(int(os.environ.get("PROVIDER_LATENCY_WINDOW", "100")))
+
+
+class RequestTrace:
+    """
+    Collects the timed spans of one request and feeds each one into the stage metrics.
+
+    Spans can be recorded from any thread, so provider calls running on the provider pool report
+    into the trace of the request that started them. Code that runs outside a request can pass a
+    fresh RequestTrace and ignore it; the metrics are recorded either way.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage: str, **attributes):
+        """
+        Time the body of a with block as a span of this request.
+
+        Yields:
+        dict: The span's attributes, which the body can add to (e.g. page counts).
+        """
+        start = time.perf_counter()
+        error = None
+        try:
+            yield attributes
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            if error is not None and not isinstance(error, GeneratorExit):
+                attributes["error"] = type(error).__name__
+            self.record(stage, time.perf_counter() - start, start=start, **attributes)
+
+    def record(self, stage: str, seconds: float, start: float | None = None, **attributes) -> None:
+        """
+        Add a span that was timed elsewhere, e.g. by a worker thread or process.
+        """
+        start = time.perf_counter() - seconds if start is None else start
+        provider = attributes.get("provider", "")
+        STAGE_SECONDS.observe(seconds, stage=stage, provider=provider)
+        if "error" in attributes:
+            STAGE_ERRORS.inc(stage=stage, provider=provider)
+        with self._lock:
+            self.spans.append({
+                "stage": stage,
+                "start_ms": round(1000 * (start - self.started), 2),
+                "duration_ms": round(1000 * seconds, 2),
+                **attributes
+            })
+
+    def summary(self) -> dict:
+        """
+        The spans in start order and the elapsed time so far, as returned in debug responses.
+        """
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span["start_ms"])
+        return {"total_ms": round(1000 * (time.perf_counter() - self.started), 2), "spans": spans}
+
+
+def record_usage(provider: str, usage: dict | None) -> None:
+    """
+    Add a provider's reported token usage (see providers.make_usage) to the token counters.
+    """
+    for kind, value in (usage or {}).items():
+        if value:
+            PROVIDER_TOKENS.inc(value, provider=provider, kind=kind.removesuffix("_tokens"))
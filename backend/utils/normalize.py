@@ -0,0 +1,138 @@
+import os
+import re
+import logging
+from collections import Counter, OrderedDict
+from utils.token_utils import count_tokens
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Lines this close to the top or bottom of a page are candidates for page headers/footers
+HEADER_FOOTER_LINES = 4
+# A header/footer line must appear on at least this share of pages to be removed
+REPEATED_LINE_MIN_SHARE = 0.5
+
+HORIZONTAL_WHITESPACE = re.compile(r"[ \t\u00a0\u2000-\u200b\u202f\u205f\u3000]+")
+BLANK_LINES = re.compile(r"\n{3,}")
+DIGITS = re.compile(r"\d+")
+MONEY = re.compile(r"\$\s?(\d{1,3}(?:,\d{3})+|\d+)(\.\d+)?")
+
+
+def collapse_whitespace(pages: list[str]) -> list[str]:
+    """
+    Turn non-breaking and other unusual spaces into plain spaces, collapse runs of spaces, strip
+    each line and squeeze runs of blank lines. Every page ends with a newline so pages don't run
+    together when joined.
+    """
+    normalized = []
+    for page in pages:
+        lines = [HORIZONTAL_WHITESPACE.sub(" ", line).strip() for line in page.splitlines()]
+        text = BLANK_LINES.sub("\n\n", "\n".join(lines)).strip()
+        normalized.append(text + "\n" if text else "")
+    return normalized
+
+
+def remove_repeated_lines(pages: list[str]) -> list[str]:
+    """
+    Remove page headers and footers: lines near the top or bottom of a page that repeat across pages.
+
+    Digits are ignored when comparing, so "Page 1 of 3" and "Page 2 of 3" count as the same line.
+    The first page keeps its copy, since headers often carry the vendor name and invoice number.
+    """
+    if len(pages) < 2:
+        return pages
+
+    def key(line: str) -> str:
+        return DIGITS.sub("#", " ".join(line.split()).lower())
+
+    page_lines = [page.splitlines() for page in pages]
+    counts = Counter()
+    for lines in page_lines:
+        edges = lines[:HEADER_FOOTER_LINES] + lines[-HEADER_FOOTER_LINES:]
+        counts.update({key(line) for line in edges if line.strip()})
+
+    min_pages = max(2, int(len(pages) * REPEATED_LINE_MIN_SHARE + 0.5))
+    repeated = {line for line, count in counts.items() if count >= min_pages}
+    if not repeated:
+        return pages
+
+    normalized = [pages[0]]
+    for lines in page_lines[1:]:
+        kept = []
+        for index, line in enumerate(lines):
+            near_edge = index < HEADER_FOOTER_LINES or index >= len(lines) - HEADER_FOOTER_LINES
+            if near_edge and key(line) in repeated:
+                continue
+            kept.append(line)
+        normalized.append("\n".join(kept) + "\n" if kept else "")
+    return normalized
+
+
+def compact_table_rows(pages: list[str]) -> list[str]:
+    """
+    Shorten line item rows: in lines with two or more dollar amounts, drop the "$" and thousands
+    separators ("$1,234.00" -> "1234.00"). The prompts ask for bare numbers anyway.
+    """
+    def compact(line: str) -> str:
+        if len(MONEY.findall(line)) < 2:
+            return line
+        return MONEY.sub(lambda match: match.group(1).replace(",", "") + (match.group(2) or ""), line)
+
+    return ["\n".join(compact(line) for line in page.split("\n")) for page in pages]
+
+
+# Name -> normalizer. Each takes and returns the list of page texts.
+NORMALIZERS = OrderedDict([
+    ("collapse_whitespace", collapse_whitespace),
+    ("remove_repeated_lines", remove_repeated_lines),
+    ("compact_table_rows", compact_table_rows),
+])
+
+DEFAULT_NORMALIZERS = [
+    name.strip() for name in os.environ.get("TEXT_NORMALIZERS", "collapse_whitespace,remove_repeated_lines").split(",")
+    if name.strip()
+]
+
+
+def parse_normalizers(value: str | None) -> list[str]:
+    """
+    Parse a comma-separated list of normalizer names. None or "default" gives the defaults, "none" gives none.
+    """
+    if value is None or value.strip().lower() == "default":
+        return DEFAULT_NORMALIZERS
+    if value.strip().lower() == "none":
+        return []
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    unknown = [name for name in names if name not in NORMALIZERS]
+    if unknown:
+        raise ValueError(f"Unknown normalizers: {', '.join(unknown)}")
+    return names
+
+
+def normalize_pages(pages: list[str], normalizers: list[str] | None = None) -> tuple[list[str], dict]:
+    """
+    Run page texts through the normalization steps, in order, before they are put in a prompt.
+
+    Parameters:
+    pages (list): The text of each page.
+    normalizers (list): Names from NORMALIZERS to apply. Defaults to DEFAULT_NORMALIZERS.
+
+    Returns:
+    tuple: (normalized pages, stats with the steps applied and the token counts before and after).
+    """
+    normalizers = DEFAULT_NORMALIZERS if normalizers is None else normalizers
+    tokens_before = count_tokens("".join(pages))
+
+    for name in normalizers:
+        pages = NORMALIZERS[name](pages)
+
+    tokens_after = count_tokens("".join(pages))
+    stats = {
+        "normalizers": list(normalizers),
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_after,
+        "tokens_saved": tokens_before - tokens_after,
+    }
+    logger.info(f"Normalization saved {tokens_before - tokens_after} of {tokens_before} tokens")
+    return pages, stats
@@ -1,19 +1,147 @@
+import os
+import io
+import time
+import tempfile
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from PyPDF2 import PdfReader
-import pytesseract
-from pdf2image import convert_from_path
 
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
 
-def extract_text_from_pdf(pdf_file):
-    # Extract text using PyPDF2
-    pdf_reader = PdfReader(pdf_file)
-    text = ""
-    for page in pdf_reader.pages:
-        text += page.extract_text() or ""
+# Pages with fewer non-whitespace characters than this in their text layer are treated as scanned
+MIN_TEXT_LAYER_CHARS = int(os.environ.get("OCR_MIN_TEXT_LAYER_CHARS", "1"))
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", str(os.cpu_count() or 1)))
 
-    # If text extraction is empty, use OCR
-    if not text.strip():
-        images = convert_from_path(pdf_file)
-        for image in images:
-            text += pytesseract.image_to_string(image)
+_ocr_executor = None
 
-    return text 
\ No newline at end of file
+
+def process_pool_context():
+    """
+    The start method for worker process pools. The pools are created lazily in a process that is
+    already running threads (request handlers, job workers, provider pools), and forking it could
+    copy a lock another thread holds, e.g. logging's or SQLite's, into a child that then deadlocks.
+    A forkserver (or spawn where there is none) starts the workers from a clean process instead;
+    everything the pools run is a picklable top-level function.
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return multiprocessing.get_context(method)
+
+
+def get_ocr_executor() -> ProcessPoolExecutor:
+    # Created on first use so importing this module doesn't start worker processes
+    global _ocr_executor
+    if _ocr_executor is None:
+        _ocr_executor = ProcessPoolExecutor(max_workers=OCR_WORKERS, mp_context=process_pool_context())
+    return _ocr_executor
+
+
+def ocr_page(pdf_file, page_number: int) -> str:
+    """
+    Rasterize a single page (1-based) and run OCR on it, so only one page image is held in memory.
+
+    pdf_file may be a path or the PDF bytes.
+    """
+    # Only documents without a text layer need OCR, so these are imported on first use
+    import pytesseract
+    from pdf2image import convert_from_bytes, convert_from_path
+    if isinstance(pdf_file, (bytes, bytearray, memoryview)):
+        images = convert_from_bytes(bytes(pdf_file), first_page=page_number, last_page=page_number)
+    else:
+        images = convert_from_path(pdf_file, first_page=page_number, last_page=page_number)
+    return "".join(pytesseract.image_to_string(image) for image in images)
+
+
+def spool_pdf(pdf_file) -> str | None:
+    """
+    Write in-memory PDF bytes to a temp file, so OCR tasks on the process pool get a path instead of
+    each pickling a copy of the whole document.
+
+    Parameters:
+    pdf_file (str | bytes): Path to the PDF, or the PDF bytes.
+
+    Returns:
+    str | None: The path of the new temp file, which the caller removes, or None if pdf_file is already a path.
+    """
+    if not isinstance(pdf_file, (bytes, bytearray, memoryview)):
+        return None
+    with tempfile.NamedTemporaryFile(prefix="ocr-", suffix=".pdf", delete=False) as temp_file:
+        temp_file.write(pdf_file)
+    return temp_file.name
+
+
+def remove_spooled_pdf(path: str | None) -> None:
+    if path is None:
+        return
+    try:
+        os.remove(path)
+    except OSError as e:
+        logger.warning(f"Could not remove OCR temp file {path}: {e}")
+
+
+def needs_ocr(page_text: str) -> bool:
+    return len("".join(page_text.split())) < MIN_TEXT_LAYER_CHARS
+
+
+def extract_text_layer(pdf_file) -> list[str]:
+    """
+    Extract the text layer of each page with PyPDF2, without OCR. pdf_file may be a path or the PDF bytes.
+    """
+    if isinstance(pdf_file, (bytes, bytearray, memoryview)):
+        pdf_reader = PdfReader(io.BytesIO(pdf_file))
+    else:
+        pdf_reader = PdfReader(pdf_file)
+    return [page.extract_text() or "" for page in pdf_reader.pages]
+
+
+def pages_needing_ocr(pages: list[str]) -> list[int]:
+    """
+    The 1-based numbers of the pages whose text layer is too sparse to use.
+    """
+    return [index + 1 for index, text in enumerate(pages) if needs_ocr(text)]
+
+
+def extract_pages_from_pdf(pdf_file, stats: dict | None = None, executor: ProcessPoolExecutor | None = None) -> list[str]:
+    """
+    Extract the text of each page of a PDF, falling back to OCR for pages without a text layer.
+
+    Parameters:
+    pdf_file (str | bytes): Path to the PDF, or the PDF bytes.
+    stats (dict): Optional dict that is filled with text_layer_pages, ocr_pages and ocr_seconds.
+    executor (ProcessPoolExecutor): Optional process pool to parse the text layer and OCR every page
+    on, so callers extracting many documents at once aren't serialized by the GIL. By default the text
+    layer is parsed in the calling thread, and only documents with several scanned pages use the OCR pool.
+
+    Returns:
+    list: The text of each page.
+    """
+    pages = extract_text_layer(pdf_file) if executor is None else executor.submit(extract_text_layer, pdf_file).result()
+
+    # Use OCR for every page without a usable text layer, e.g. a scanned page in a digital invoice
+    ocr_page_numbers = pages_needing_ocr(pages)
+    if stats is not None:
+        stats.update(text_layer_pages=len(pages) - len(ocr_page_numbers), ocr_pages=len(ocr_page_numbers), ocr_seconds=0.0)
+    if not ocr_page_numbers:
+        return pages
+
+    ocr_start = time.perf_counter()
+    logger.debug(f"Running OCR on {len(ocr_page_numbers)} of {len(pages)} pages")
+    if len(ocr_page_numbers) == 1 and executor is None:
+        ocr_texts = [ocr_page(pdf_file, ocr_page_numbers[0])]
+    else:
+        spooled = spool_pdf(pdf_file)
+        try:
+            ocr_path = pdf_file if spooled is None else spooled
+            pool = get_ocr_executor() if executor is None else executor
+            ocr_texts = list(pool.map(ocr_page, [ocr_path] * len(ocr_page_numbers), ocr_page_numbers))
+        finally:
+            remove_spooled_pdf(spooled)
+
+    for page_number, text in zip(ocr_page_numbers, ocr_texts):
+        pages[page_number - 1] = text
+
+    if stats is not None:
+        stats["ocr_seconds"] = time.perf_counter() - ocr_start
+    return pages
@@ -0,0 +1,365 @@
+import os
+import time
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from utils.cache import ExtractionCache, hash_bytes, make_cache_key
+from utils.chunking import CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS, make_chunked_call, should_chunk
+from utils.extract_json import IncrementalJSONParser, parse_json_response
+from utils.metrics import PDF_PAGES, RequestTrace
+from utils.pdf_extraction import extract_pages_from_pdf
+from utils.prompts import get_prompts, get_prompt_version, get_missing_fields_prompt
+from utils.providers import PROVIDERS, PROVIDER_MODELS, iter_provider_results, iter_provider_stream, iter_routed_provider_results
+from utils.routing import Router, agreement_report, validate_result
+from utils.rule_extraction import extract_invoice_fields, merge_rule_fields
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+OUTPUTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "outputs")
+
+# Repeat uploads of the same document skip PDF parsing, OCR and the model round-trips
+extraction_cache = ExtractionCache(
+    os.environ.get("EXTRACTION_CACHE_PATH", os.path.join(OUTPUTS_DIR, "cache", "extraction_cache.sqlite3")),
+    max_memory_entries=int(os.environ.get("EXTRACTION_CACHE_MEMORY_ENTRIES", "256")),
+    max_disk_entries=int(os.environ.get("EXTRACTION_CACHE_DISK_ENTRIES", "10000")),
+    ttl_seconds=float(os.environ.get("EXTRACTION_CACHE_TTL_SECONDS", str(7 * 24 * 3600))),
+    enabled=os.environ.get("EXTRACTION_CACHE_ENABLED", "true").lower() == "true"
+)
+
+# Name the rule-based result is reported under when it is used instead of the models
+RULES_MODEL = "rules"
+
+
+def extract_document_pages(pdf_file, file_hash: str, trace: RequestTrace | None = None,
+                           executor: ProcessPoolExecutor | None = None) -> list[str]:
+    """
+    Extract the text of each page of a PDF, reusing the cached pages if this file has been seen before.
+
+    Parameters:
+    pdf_file (str | bytes): Path to the PDF file, or the PDF bytes.
+    file_hash (str): Hash of the PDF bytes.
+    trace (RequestTrace): Optional trace to record the extraction and OCR spans in.
+    executor (ProcessPoolExecutor): Optional process pool to extract on, see extract_pages_from_pdf.
+
+    Returns:
+    list: The extracted text of each page.
+    """
+    trace = RequestTrace() if trace is None else trace
+    key = make_cache_key("pages", file_hash)
+    with trace.span("extract_text") as span:
+        pages = extraction_cache.get(key)
+        span["cached"] = pages is not None
+        if pages is None:
+            stats = {}
+            pages = extract_pages_from_pdf(pdf_file, stats, executor)
+            extraction_cache.set(key, pages)
+            span.update(text_layer_pages=stats["text_layer_pages"], ocr_pages=stats["ocr_pages"])
+            PDF_PAGES.inc(stats["text_layer_pages"], method="text_layer")
+            PDF_PAGES.inc(stats["ocr_pages"], method="ocr")
+            if stats["ocr_pages"]:
+                trace.record("ocr", stats["ocr_seconds"], pages=stats["ocr_pages"])
+        span["pages"] = len(pages)
+    return pages
+
+
+def extract_rule_fields(document_type: str, pdf_text: str, rule_mode: str, trace: RequestTrace | None = None,
+                        executor: ProcessPoolExecutor | None = None) -> dict | None:
+    """
+    Run rule-based extraction (see utils/rule_extraction.py) if rule_mode uses it. Only invoices have rules.
+    With executor, the rules run on that process pool instead of the calling thread.
+
+    Returns:
+    dict: The result of extract_invoice_fields, or None if no rules were run.
+    """
+    if rule_mode == "off" or document_type != "invoice":
+        return None
+    trace = RequestTrace() if trace is None else trace
+    with trace.span("rules") as span:
+        rules = extract_invoice_fields(pdf_text) if executor is None else executor.submit(extract_invoice_fields, pdf_text).result()
+        span.update(found=len(rules["data"]) - len(rules["missing"]), complete=rules["complete"])
+    return rules
+
+
+def rules_report(rules: dict | None, rule_mode: str) -> dict | None:
+    """
+    Summarize a rule-based extraction for a response: each value found with its confidence, the
+    fields left to the models, and whether the models were skipped.
+    """
+    if rules is None:
+        return None
+    return {
+        "mode": rule_mode,
+        "llm_skipped": rule_mode == "skip" and rules["complete"],
+        "complete": rules["complete"],
+        "fields": rules["fields"],
+        "missing": rules["missing"],
+    }
+
+
+def plan_model_calls(document_type: str, pdf_text: str, file_hash: str, providers, pages, chunk_mode: str,
+                     rules: dict | None, rule_mode: str) -> dict:
+    """
+    Decide how a document goes to the models, shared by iter_model_results and aiter_model_results.
+
+    Returns:
+    dict: {"pages", "chunked", "fill", "fields": the fields asked for, or None for the full schema,
+    "keys": provider name -> cache key of its result}.
+    """
+    pages = [pdf_text] if pages is None else pages
+    fill = rules is not None and rule_mode == "fill"
+    chunked = should_chunk(document_type, pages, chunk_mode)
+    # Chunked extraction keeps its own prompts; the rule-based values are still merged in afterwards
+    fields = rules["missing"] if fill and not chunked else None
+    prompt_version = get_prompt_version(document_type, chunked, fields)
+    if chunked:
+        prompt_version += f"-chunked-{CHUNK_MAX_TOKENS}-{CHUNK_OVERLAP_TOKENS}"
+
+    # The text hash covers everything done to the text before prompting, e.g. normalization
+    text_hash = hash_bytes(pdf_text.encode("utf-8"))[:16]
+    keys = {
+        name: make_cache_key("model", file_hash, text_hash, document_type, prompt_version, name, PROVIDER_MODELS.get(name, name))
+        for name in providers
+    }
+    return {"pages": pages, "chunked": chunked, "fill": fill, "fields": fields, "keys": keys}
+
+
+def build_model_prompts(document_type: str, pdf_text: str, plan: dict, trace: RequestTrace) -> tuple[str, str]:
+    fields = plan["fields"]
+    with trace.span("build_prompts", chunked=plan["chunked"], fields=len(fields) if fields is not None else None):
+        if fields is not None:
+            return get_missing_fields_prompt(fields, pdf_text)
+        return get_prompts(document_type, pdf_text)
+
+
+def parse_model_result(name: str, content: str, plan: dict, rules: dict | None, trace: RequestTrace):
+    with trace.span("parse", provider=name) as span:
+        data, repaired = parse_json_response(content)
+        span["parsed"] = data is not None
+        span["repaired"] = repaired
+    # Only complete results are worth reusing; a bad or cut off completion gets another chance next time
+    if data is not None and not repaired:
+        extraction_cache.set(plan["keys"][name], data)
+    return merge_rule_fields(rules, data) if plan["fill"] else data
+
+
+def iter_model_results(document_type: str, pdf_text: str, file_hash: str, providers=None, pages=None, chunk_mode: str = "auto",
+                       trace: RequestTrace | None = None, rules: dict | None = None, rule_mode: str = "off"):
+    """
+    Run the document through every provider, yielding each model's parsed JSON as soon as it is ready.
+
+    Cached results are yielded first, and only the remaining providers are called. Long invoices are
+    extracted in chunks (see utils/chunking.py) according to chunk_mode.
+
+    Parameters:
+    document_type (str): The type of document (e.g., 'invoice', 'spec', etc.).
+    pdf_text (str): The extracted text from the PDF.
+    file_hash (str): Hash of the PDF bytes.
+    providers (dict): Optional mapping of provider name to call function. Defaults to PROVIDERS.
+    pages (list): Optional text of each page, used to split chunks on page boundaries.
+    chunk_mode (str): "auto", "single" or "chunked".
+    trace (RequestTrace): Optional trace to record the prompt, provider and parsing spans in.
+    rules (dict): Optional result of extract_rule_fields for this text.
+    rule_mode (str): With rules, "skip" yields only the rule-based result (as RULES_MODEL) if it is
+    complete, and "fill" asks the models only for the missing fields and merges in the rest.
+
+    Yields:
+    tuple: (model name, parsed JSON or {"error": message} if the provider failed, token usage reported
+    by the provider or None if the result came from the cache or the call failed).
+    """
+    providers = PROVIDERS if providers is None else providers
+    trace = RequestTrace() if trace is None else trace
+    if rules is not None and rule_mode == "skip" and rules["complete"]:
+        yield RULES_MODEL, rules["data"], None
+        return
+
+    plan = plan_model_calls(document_type, pdf_text, file_hash, providers, pages, chunk_mode, rules, rule_mode)
+    uncached = {}
+    for name, call in providers.items():
+        cached = extraction_cache.get(plan["keys"][name])
+        if cached is None:
+            uncached[name] = call
+        else:
+            yield name, merge_rule_fields(rules, cached) if plan["fill"] else cached, None
+
+    if not uncached:
+        return
+
+    if plan["chunked"]:
+        uncached = {name: make_chunked_call(call, plan["pages"]) for name, call in uncached.items()}
+
+    system_prompt, prompt = build_model_prompts(document_type, pdf_text, plan, trace)
+    for name, content, usage, error in iter_provider_results(system_prompt, prompt, uncached, trace=trace):
+        if error is not None:
+            yield name, {"error": error}, None
+            continue
+        yield name, parse_model_result(name, content, plan, rules, trace), usage
+
+
+def partial_update(events: list[tuple]) -> dict:
+    """
+    Group IncrementalJSONParser events for a "partial" result: {"fields": top-level fields that are
+    complete, "items": array name -> elements completed since the last update}.
+    """
+    update = {"fields": {}, "items": {}}
+    for kind, key, value in events:
+        if kind == "field":
+            update["fields"][key] = value
+        else:
+            update["items"].setdefault(key, []).append(value)
+    return update
+
+
+def iter_model_events(document_type: str, pdf_text: str, file_hash: str, providers=None, pages=None, chunk_mode: str = "auto",
+                      trace: RequestTrace | None = None, rules: dict | None = None, rule_mode: str = "off"):
+    """
+    iter_model_results with the provider responses streamed, so each model's fields can be shown as
+    soon as the model has written them.
+
+    Yields:
+    tuple: ("partial", model name, partial_update(...)) whenever a model completes more top-level
+    fields or array elements, and ("result", model name, result, usage) exactly as iter_model_results
+    yields them. Cached, rule-based and chunked results only get a "result".
+    """
+    providers = PROVIDERS if providers is None else providers
+    trace = RequestTrace() if trace is None else trace
+    plan = plan_model_calls(document_type, pdf_text, file_hash, providers, pages, chunk_mode, rules, rule_mode)
+    skip = rules is not None and rule_mode == "skip" and rules["complete"]
+    if skip or plan["chunked"]:
+        # Chunked results are merged from whole chunk responses, so there is nothing to stream
+        for name, data, usage in iter_model_results(document_type, pdf_text, file_hash, providers, pages, chunk_mode, trace, rules, rule_mode):
+            yield "result", name, data, usage
+        return
+
+    uncached = {}
+    for name, call in providers.items():
+        cached = extraction_cache.get(plan["keys"][name])
+        if cached is None:
+            uncached[name] = call
+        else:
+            yield "result", name, merge_rule_fields(rules, cached) if plan["fill"] else cached, None
+
+    if not uncached:
+        return
+
+    system_prompt, prompt = build_model_prompts(document_type, pdf_text, plan, trace)
+    parsers = {name: IncrementalJSONParser() for name in uncached}
+    for event in iter_provider_stream(system_prompt, prompt, uncached, trace=trace):
+        if event[0] == "text":
+            _, name, text = event
+            completed = parsers[name].feed(text)
+            if completed:
+                yield "partial", name, partial_update(completed)
+            continue
+        _, name, content, usage, error = event
+        if error is not None:
+            yield "result", name, {"error": error}, None
+            continue
+        yield "result", name, parse_model_result(name, content, plan, rules, trace), usage
+
+
+def run_models(document_type: str, pdf_text: str, file_hash: str, providers=None, pages=None, chunk_mode: str = "auto",
+               trace: RequestTrace | None = None, rules: dict | None = None, rule_mode: str = "off") -> tuple[dict, dict]:
+    """
+    Collect iter_model_results, in provider order.
+
+    Returns:
+    tuple: (model name -> result, model name -> token usage for the models that were called).
+    """
+    providers = PROVIDERS if providers is None else providers
+    results, usage = {}, {}
+    for name, data, model_usage in iter_model_results(document_type, pdf_text, file_hash, providers, pages, chunk_mode, trace, rules, rule_mode):
+        results[name] = data
+        if model_usage is not None:
+            usage[name] = model_usage
+    order = [*providers, RULES_MODEL]
+    return (
+        {name: results[name] for name in order if name in results},
+        {name: usage[name] for name in order if name in usage},
+    )
+
+
+
+# ------------- ROUTING -------------
+def consensus_report(document_type: str, plan: dict, results: dict) -> dict:
+    """
+    The routing report for "consensus": which results are invalid, and how well the valid ones agree.
+    """
+    invalid = {name: "; ".join(problems) for name, data in results.items()
+               if (problems := validate_result(document_type, data, plan["fields"]))}
+    valid = {name: data for name, data in results.items() if name not in invalid}
+    return {"policy": "consensus", "invalid": invalid, "agreement": agreement_report(valid)}
+
+
+def cached_route(document_type: str, plan: dict, router: Router, rules: dict | None):
+    """
+    The first provider, in the router's order, with a valid cached result, so "fastest" and "hedged"
+    can answer without calling anything. Returns (results, usage, report) like route_models, or None.
+    """
+    for name in router.order:
+        cached = extraction_cache.get(plan["keys"][name])
+        if cached is None:
+            continue
+        data = merge_rule_fields(rules, cached) if plan["fill"] else cached
+        if not validate_result(document_type, data, plan["fields"]):
+            return {name: data}, {}, {**router.report(), "winner": name, "cached": True}
+    return None
+
+
+def routed_outcome(router: Router, providers, results: dict, usage: dict) -> tuple[dict, dict, dict]:
+    """
+    Keep only the winner's result, or every result if none was valid. Usage is kept for every
+    provider that reported it, since those calls are paid for either way.
+    """
+    order = list(providers)
+    if router.winner is not None:
+        results = {router.winner: results[router.winner]}
+    return (
+        {name: results[name] for name in order if name in results},
+        {name: usage[name] for name in order if name in usage},
+        router.report(),
+    )
+
+
+def route_models(document_type: str, pdf_text: str, file_hash: str, providers=None, pages=None, chunk_mode: str = "auto",
+                 trace: RequestTrace | None = None, rules: dict | None = None, rule_mode: str = "off",
+                 policy: str = "consensus") -> tuple[dict, dict, dict]:
+    """
+    run_models under a routing policy (see utils/routing.py).
+
+    Parameters:
+    policy (str): "consensus" calls every provider, as run_models does. "fastest" and "hedged" stop
+    at the first result that validates against the document type's fields.
+    The other parameters are as for iter_model_results.
+
+    Returns:
+    tuple: (model name -> result, model name -> token usage, routing report). "fastest" and "hedged"
+    only return the winning model's result, or every result if none was valid.
+    """
+    providers = PROVIDERS if providers is None else providers
+    trace = RequestTrace() if trace is None else trace
+    plan = plan_model_calls(document_type, pdf_text, file_hash, providers, pages, chunk_mode, rules, rule_mode)
+    if rules is not None and rule_mode == "skip" and rules["complete"]:
+        results, usage = run_models(document_type, pdf_text, file_hash, providers, pages, chunk_mode, trace, rules, rule_mode)
+        return results, usage, {"policy": policy, "winner": RULES_MODEL}
+    if policy == "consensus":
+        results, usage = run_models(document_type, pdf_text, file_hash, providers, pages, chunk_mode, trace, rules, rule_mode)
+        return results, usage, consensus_report(document_type, plan, results)
+
+    router = Router(policy, providers)
+    cached = cached_route(document_type, plan, router, rules)
+    if cached is not None:
+        return cached
+
+    calls = providers
+    if plan["chunked"]:
+        calls = {name: make_chunked_call(call, plan["pages"]) for name, call in providers.items()}
+    system_prompt, prompt = build_model_prompts(document_type, pdf_text, plan, trace)
+    results, usage = {}, {}
+    for name, content, model_usage, error in iter_routed_provider_results(system_prompt, prompt, router, calls, trace=trace):
+        data = {"error": error} if error is not None else parse_model_result(name, content, plan, rules, trace)
+        results[name] = data
+        if model_usage is not None:
+            usage[name] = model_usage
+        router.finished(name, validate_result(document_type, data, plan["fields"]), time.monotonic())
+    return routed_outcome(router, providers, results, usage)
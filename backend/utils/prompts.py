@@ -1,8 +1,42 @@
+import re
+import hashlib
+
+
+# Prompts for different document types
+def split_prompt(system_prompt: str, user_prompt: str, pdf_text: str) -> tuple[str, str]:
+    """
+    Split a prompt template into a static, cacheable prefix and the document-specific remainder.
+
+    Everything in the template before {pdf_text} is identical for every document, so it is moved
+    into the system prompt. Providers can then cache that prefix (Anthropic via cache_control,
+    OpenAI automatically), and only the document text at the end changes between requests.
+    Templates without a {pdf_text} placeholder get the document text appended.
+    """
+    if "{pdf_text}" in user_prompt:
+        instructions, _, remainder = user_prompt.partition("{pdf_text}")
+        # Undo the {{ }} escaping that str.format would have handled
+        instructions = instructions.replace("{{", "{").replace("}}", "}")
+        document = pdf_text + remainder.replace("{{", "{").replace("}}", "}")
+    else:
+        instructions, document = user_prompt, "Text to analyze:\n" + pdf_text
+
+    # The document section starts with the "Text to analyze:" heading that closes the instructions
+    heading = "Text to analyze:\n"
+    if instructions.rstrip(" ").endswith(heading):
+        instructions = instructions.rstrip(" ")[:-len(heading)]
+        document = heading + document
+
+    return system_prompt + "\n\n" + instructions.strip(), document
+
+
 # Prompts for different document types
 def get_prompts(document_type: str, pdf_text: str) -> tuple[str, str]:
     """
     Retrieve and format the system and user prompts based on the document type.
 
+    The static instructions are part of the system prompt and the user prompt holds only the
+    document text, so the prompt prefix is the same for every document (see split_prompt).
+
     Parameters:
     document_type (str): The type of document (e.g., 'invoice', 'spec', etc.).
     pdf_text (str): The extracted text from the PDF.
@@ -12,8 +46,85 @@ def get_prompts(document_type: str, pdf_text: str) -> tuple[str, str]:
     """
     system_prompt = system_prompts.get(document_type, system_prompts['invoice'])
     user_prompt = user_prompts.get(document_type, user_prompts['invoice'])
-    formatted_user_prompt = user_prompt.format(pdf_text=pdf_text)
-    return system_prompt, formatted_user_prompt 
+    return split_prompt(system_prompt, user_prompt, pdf_text)
+
+
+def get_chunk_prompt(chunk_type: str, pdf_text: str) -> tuple[str, str]:
+    """
+    Retrieve and format the prompts for one call of a chunked (map-reduce) invoice extraction.
+
+    Parameters:
+    chunk_type (str): 'invoice_header' for the header fields or 'invoice_items' for line items.
+    pdf_text (str): The text of the pages in this chunk.
+
+    Returns:
+    tuple: A tuple containing the system prompt and the formatted user prompt.
+    """
+    return split_prompt(system_prompts['invoice'], chunk_prompts[chunk_type], pdf_text)
+
+
+def get_field_descriptions(document_type: str) -> dict:
+    """
+    Return the fields listed under "Fields to extract:" in a document type's prompt, in order.
+
+    Returns:
+    dict: field name -> its description lines as written in the prompt, including the "--" lines
+    describing nested fields (e.g. the line item fields under invoice_items).
+    """
+    template = user_prompts.get(document_type, user_prompts['invoice'])
+    section = template.partition("Fields to extract:")[2].split("\n\n")[0]
+    fields = {}
+    name = None
+    for line in section.strip().splitlines():
+        match = re.match(r"- (\w+)", line)
+        if match:
+            name = match.group(1)
+            fields[name] = [line]
+        elif name is not None and line.startswith("--"):
+            fields[name].append(line)
+    return {name: "\n".join(lines) for name, lines in fields.items()}
+
+
+def get_field_names(document_type: str) -> list[str]:
+    return list(get_field_descriptions(document_type))
+
+
+def get_missing_fields_prompt(fields: list[str], pdf_text: str) -> tuple[str, str]:
+    """
+    Retrieve and format the prompts for an invoice whose other fields were already extracted by rules.
+
+    Parameters:
+    fields (list): Names of the invoice fields still to extract.
+    pdf_text (str): The extracted text from the PDF.
+
+    Returns:
+    tuple: A tuple containing the system prompt and the formatted user prompt.
+    """
+    descriptions = get_field_descriptions("invoice")
+    field_text = "\n".join(descriptions.get(name, f"- {name}") for name in fields)
+    return split_prompt(system_prompts['invoice'], missing_fields_prompt.replace("{fields}", field_text), pdf_text)
+
+
+def get_prompt_version(document_type: str, chunked: bool = False, fields: list[str] | None = None) -> str:
+    """
+    Return a short hash of the prompt templates used for a document type.
+
+    Cached model results are keyed on this, so editing a prompt invalidates them. fields is the list
+    of fields asked for by a missing fields prompt, if that is the prompt used.
+    """
+    system_prompt = system_prompts.get(document_type, system_prompts['invoice'])
+    if fields is not None:
+        templates = [system_prompt, missing_fields_prompt, ",".join(fields)]
+    elif chunked:
+        templates = [system_prompt, chunk_prompts['invoice_header'], chunk_prompts['invoice_items']]
+    else:
+        templates = [system_prompt, user_prompts.get(document_type, user_prompts['invoice'])]
+    return hashlib.sha256("\0".join(templates).encode("utf-8")).hexdigest()[:16]
+
+# Anthropic (cache_control) and OpenAI (automatic) only cache a prompt prefix of at least this many
+# tokens. Every prefix here is shorter (the invoice system prompt and instructions are about 960
+# tokens), so the providers don't cache them yet; see "Prompt caching" in the README.
+PROMPT_CACHE_MIN_TOKENS = 1024
 
 # System prompts
 system_prompts = {
@@ -25,10 +136,7 @@ system_prompts = {
 
 # User prompts
 user_prompts = {
-    "invoice": """You are an expert at extracting information from invoices. Analyze the following invoice text and extract the requested information.
-
-Text to analyze:
-{pdf_text}
+    "invoice": """You are an expert at extracting information from invoices. Analyze the invoice text provided after these instructions and extract the requested information.
 
 Instructions:
 1. Extract all the fields listed below
@@ -100,8 +208,120 @@ Return the data in a similar JSON format:
         "overage": 1.4,
         "fob": North Carolina,
     }}]
-}}""",
+}}
+
+Text to analyze:
+{pdf_text}""",
     "spec": "You are an expert at extracting information from specifications. Analyze the following specification text and extract the requested information.",
     "quote": "You are an expert at extracting information from quotes. Analyze the following quote text and extract the requested information.",
     "submittal": "You are an expert at extracting information from submittals. Analyze the following submittal text and extract the requested information."
-}
\ No newline at end of file
+}
+
+# Prompts for chunked extraction of long invoices: header fields come from the first and last pages,
+# line items from every chunk
+chunk_prompts = {
+    "invoice_header": """You are an expert at extracting information from invoices. Analyze the pages from the start and end of an invoice provided after these instructions and extract the requested information. Do not extract line items.
+
+Instructions:
+1. Extract all the fields listed below
+2. Return the data in valid JSON format
+3. Use null for any fields not found in the text
+4. For addresses, include an object with the following fields:
+    - company_name: the company name (or null if not found)
+    - address_line_1: the first line of the address (or null if not found)
+    - address_line_2: the second line of the address (or null if not found)
+    - city: the city of the address (or null if not found)
+    - state: the state of the address (or null if not found)
+    - zip: the zip code of the address (or null if not found)
+5. For monetary values, include only the numerical amount, to two decimal places (no currency symbols)
+6. Look for variations in field names (e.g., "Shipping" vs "Freight" vs "Freight Charges")
+7. For Terms, capture any payment terms format (e.g., "Net 30", "2/10 Net 30", "Due on Receipt")
+8. Do not include other texts or comments outside of the JSON format
+
+Fields to extract:
+- vendor_name: Company or business name issuing the invoice
+- invoice_date: Look for any date format associated with invoice date/issue date
+- due_date: Payment due date in any format
+- ship_date: Look for any date format associated with shipping date
+- invoice_number: Look for invoice #, reference number, or similar identifiers
+- vendor_order_number: Look for SO#, Order #, or similar references
+- account_number: Any customer or account reference number
+- po_number: Purchase order number reference
+- terms: Payment terms in any format found
+- banking_info: Any bank account, routing numbers, or payment instructions
+- currency: Type of currency used (USD, EUR, etc.)
+- bill_to_address: Complete billing address including company name if present
+- ship_to_address: Complete shipping address including company name if present. If the ship to address includes Source Logistics, this is NOT the shipping address - leave null
+- subtotal: Look for numbers that represent a subtotal, typically a float with 2 decimal places
+- packing_fee Any packaging or handling charges
+- freight: Any shipping, freight, or delivery charges
+- sales_tax: Tax amount or rate applied
+- sales_tax_rate: Tax rate applied, typically a %
+- total: Final total amount of the invoice
+- prepayment: Any advance payments or deposits applied
+- balance_due: Remaining amount to be paid
+
+Text to analyze:
+{pdf_text}""",
+    "invoice_items": """You are an expert at extracting line item information from invoices. Analyze the section of an invoice provided after these instructions and extract every line item that appears in it.
+
+Instructions:
+1. Look for a table of line items in the text. The section may start or end partway through the table
+2. Only extract line items that appear in this text; ignore totals, headers and addresses
+3. Return the data in valid JSON format
+4. Use null for any fields not found in the text
+5. For monetary values, include only the numerical amount, to two decimal places (no currency symbols)
+6. Do not include other texts or comments outside of the JSON format
+
+Fields to extract for each line item:
+-- spec_tag: Look for text that contains "Item" or "Spec" or "Tag", typically XX-### format, or similar
+-- description: will typically describe a product or service, like 'decorative bed scarf @ King Guest Room'
+-- quantity: Look for numbers that represent a quantity, typically a whole number
+-- units: Look for text that represents a unit of measure, typically 2 or 3 letter codes. If not found, use "EA" as the default unit.
+-- overage: Look for numbers that represent a quantity overage, typically a whole number
+-- unit_price: Look for numbers that represent a price per unit, typically a float with 2 decimal places
+-- discount: Look for numbers that represent a discount, typically a %
+-- extended_price: Look for numbers that represent a total price, typically a float with 2 decimal places
+-- fob: Look for text that represents a shipping term, typically a city, state, or country
+
+Return the data in this JSON format, with an empty list if there are no line items:
+{{
+    "invoice_items": [{{
+        "spec_tag": FCH-002A.F3,
+        "description": Fabric for chair CH-002A,
+        "quantity": 32,
+        "units": YD,
+        "unit_price": 9.12,
+        "extended_price": 291.84,
+        "overage": 1.4,
+        "fob": North Carolina,
+    }}]
+}}
+
+Text to analyze:
+{pdf_text}"""
+}
+
+# Prompt for the fields rule-based extraction (utils/rule_extraction.py) couldn't find with confidence
+missing_fields_prompt = """You are an expert at extracting information from invoices. Some fields of this invoice have already been extracted. Analyze the invoice text provided after these instructions and extract only the fields listed below.
+
+Instructions:
+1. Extract only the fields listed below, and no other fields
+2. Return the data in valid JSON format
+3. Use null for any fields not found in the text
+4. For addresses, include an object with the following fields:
+    - company_name: the company name (or null if not found)
+    - address_line_1: the first line of the address (or null if not found)
+    - address_line_2: the second line of the address (or null if not found)
+    - city: the city of the address (or null if not found)
+    - state: the state of the address (or null if not found)
+    - zip: the zip code of the address (or null if not found)
+5. For monetary values, include only the numerical amount, to two decimal places (no currency symbols)
+6. Look for variations in field names (e.g., "Shipping" vs "Freight" vs "Freight Charges")
+7. Do not include other texts or comments outside of the JSON format
+
+Fields to extract:
+{fields}
+
+Text to analyze:
+{pdf_text}"""
@@ -0,0 +1,546 @@
+import os
+import time
+import queue
+import logging
+import threading
+from functools import partial
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dotenv import load_dotenv
+from utils.metrics import PROVIDER_LATENCY, RequestTrace, record_usage
+from utils.rate_limit import ProviderScheduler
+from utils.token_utils import estimate_token_count
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+openai_model = "gpt-4o"
+deepseek_model = "deepseek/DeepSeek-V3-0324"
+anthropic_model = "claude-3-5-sonnet-20240620"
+
+
+# ------------- CLIENTS -------------
+# Each SDK is imported and its client built the first time that provider is called, so the app
+# starts quickly and only needs credentials for the providers it actually uses.
+# SDK-level retries are turned off; ProviderScheduler owns retrying so it can back off and pace calls.
+def _build_openai_client():
+    from openai import OpenAI
+    return OpenAI(max_retries=0)  # It will automatically use OPENAI_API_KEY from environment
+
+
+def _build_deepseek_client():
+    from azure.ai.inference import ChatCompletionsClient
+    from azure.core.credentials import AzureKeyCredential
+    return ChatCompletionsClient(endpoint=os.environ.get("DEEPSEEK_ENDPOINT", "https://models.github.ai/inference"),
+                                 credential=AzureKeyCredential(os.environ["GITHUB_TOKEN"]), retry_total=0)
+
+
+def _build_anthropic_client():
+    import anthropic
+    return anthropic.Anthropic(api_key=os.environ["ANTHROPIC_API_KEY"], max_retries=0)
+
+
+CLIENT_BUILDERS = {
+    "deepseek": _build_deepseek_client,
+    "openai": _build_openai_client,
+    "anthropic": _build_anthropic_client,
+}
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(name: str):
+    """
+    Return the provider's SDK client, building it on first use. Clients are shared by every thread.
+    """
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                logger.debug(f"Creating {name} client")
+                client = _clients[name] = CLIENT_BUILDERS[name]()
+    return client
+
+# Model id behind each provider, used when keying cached results
+PROVIDER_MODELS = {
+    "deepseek": deepseek_model,
+    "openai": openai_model,
+    "anthropic": anthropic_model,
+}
+
+# Seconds each provider is allowed before its result is reported as timed out
+PROVIDER_TIMEOUTS = {
+    "deepseek": 90,
+    "openai": 90,
+    "anthropic": 90,
+}
+DEFAULT_PROVIDER_TIMEOUT = 90
+
+# Requests/min and tokens/min quotas per provider, overridable with e.g. OPENAI_RPM / OPENAI_TPM.
+# None means that quota isn't enforced.
+PROVIDER_LIMITS = {
+    "deepseek": {"rpm": 10, "tpm": None, "max_concurrency": 2},
+    "openai": {"rpm": 500, "tpm": 30000, "max_concurrency": 8},
+    "anthropic": {"rpm": 50, "tpm": 40000, "max_concurrency": 8},
+}
+# Output tokens charged up front for every call, on top of the prompt
+EXPECTED_OUTPUT_TOKENS = int(os.environ.get("EXPECTED_OUTPUT_TOKENS", "1500"))
+
+
+def _limit_from_env(name: str, key: str, default):
+    value = os.environ.get(f"{name.upper()}_{key.upper()}")
+    if value is None:
+        return default
+    return None if value.lower() in ("", "none", "0") else float(value)
+
+
+PROVIDER_SCHEDULERS = {
+    name: ProviderScheduler(
+        name,
+        requests_per_minute=_limit_from_env(name, "rpm", limits["rpm"]),
+        tokens_per_minute=_limit_from_env(name, "tpm", limits["tpm"]),
+        max_concurrency=int(_limit_from_env(name, "max_concurrency", limits["max_concurrency"]) or 1)
+    )
+    for name, limits in PROVIDER_LIMITS.items()
+}
+
+
+def schedule_call(name: str, system_prompt: str, prompt: str, fn, consume=None, **kwargs):
+    """
+    Make an SDK call through the provider's scheduler, charging the prompt's estimated tokens to its quota.
+
+    A streamed response is read by consume inside the scheduler, so the call keeps its concurrency
+    slot until the whole response has arrived, not just until the stream is opened.
+    """
+    estimated_tokens = estimate_token_count(system_prompt + prompt, None)["input_tokens"] + EXPECTED_OUTPUT_TOKENS
+    return PROVIDER_SCHEDULERS[name].call(fn, estimated_tokens=estimated_tokens,
+                                          deadline_seconds=PROVIDER_TIMEOUTS[name], consume=consume, **kwargs)
+
+
+# Shared pool for provider calls, so every request fans out without paying for thread start-up
+provider_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("PROVIDER_WORKERS", "32")),
+    thread_name_prefix="provider"
+)
+
+
+def make_usage(input_tokens, output_tokens, cache_read_input_tokens=0, cache_creation_input_tokens=0) -> dict:
+    """
+    Token usage reported by a provider, in one shape for every provider. cache_read_input_tokens are
+    prompt tokens served from the provider's prompt cache; cache_creation_input_tokens were written to it.
+    """
+    return {
+        "input_tokens": input_tokens or 0,
+        "output_tokens": output_tokens or 0,
+        "cache_read_input_tokens": cache_read_input_tokens or 0,
+        "cache_creation_input_tokens": cache_creation_input_tokens or 0,
+    }
+
+
+# ------------- CLIENT CALLS -------------
+# Each call function takes (system_prompt, prompt) and returns (response content, usage).
+# get_prompts puts the static instructions in the system prompt, so it is the cacheable prefix.
+# With on_text, the response is streamed and on_text is called with each piece of text as it arrives.
+def chat_messages(system_prompt: str, prompt: str) -> list[dict]:
+    return [
+        {
+            "role": "system",
+            "content": system_prompt
+        },
+        {"role": "user", "content": prompt}
+    ]
+
+
+def anthropic_system(system_prompt: str) -> list[dict]:
+    # Mark the static instructions as a cache breakpoint so repeat calls only pay for the document.
+    # Anthropic ignores the breakpoint below PROMPT_CACHE_MIN_TOKENS (see utils/prompts.py).
+    return [
+        {
+            "type": "text",
+            "text": system_prompt,
+            "cache_control": {"type": "ephemeral"}
+        }
+    ]
+
+
+def openai_usage(usage) -> dict:
+    # OpenAI caches prompt prefixes of 1024+ tokens automatically and reports the hits here
+    details = getattr(usage, "prompt_tokens_details", None)
+    return make_usage(usage.prompt_tokens, usage.completion_tokens, cache_read_input_tokens=getattr(details, "cached_tokens", 0))
+
+
+def deepseek_usage(usage) -> dict:
+    return make_usage(usage.prompt_tokens, usage.completion_tokens)
+
+
+def chat_chunk_text(chunk) -> str | None:
+    return chunk.choices[0].delta.content if chunk.choices else None
+
+
+def anthropic_event_text(event, usage: dict) -> str | None:
+    """
+    Add a streamed Anthropic event's token counts to usage and return its text, if any. Input tokens
+    arrive in message_start and output tokens in message_delta.
+    """
+    if event.type == "message_start":
+        start_usage = event.message.usage
+        usage.update(make_usage(
+            start_usage.input_tokens,
+            0,
+            cache_read_input_tokens=getattr(start_usage, "cache_read_input_tokens", 0),
+            cache_creation_input_tokens=getattr(start_usage, "cache_creation_input_tokens", 0)
+        ))
+    elif event.type == "message_delta":
+        usage["output_tokens"] = event.usage.output_tokens or 0
+    elif event.type == "content_block_delta":
+        return getattr(event.delta, "text", None)
+    return None
+
+
+def read_chat_stream(stream, on_text, make_stream_usage) -> tuple[str, dict]:
+    """
+    Collect a streamed OpenAI-style chat completion, passing each piece of text to on_text.
+    """
+    parts, usage = [], make_usage(0, 0)
+    with stream:
+        for chunk in stream:
+            text = chat_chunk_text(chunk)
+            if text:
+                parts.append(text)
+                on_text(text)
+            if getattr(chunk, "usage", None):
+                usage = make_stream_usage(chunk.usage)
+    return "".join(parts), usage
+
+
+def read_anthropic_stream(stream, on_text) -> tuple[str, dict]:
+    parts, usage = [], make_usage(0, 0)
+    with stream:
+        for event in stream:
+            text = anthropic_event_text(event, usage)
+            if text:
+                parts.append(text)
+                on_text(text)
+    return "".join(parts), usage
+
+
+def call_openai(system_prompt: str, prompt: str, on_text=None) -> tuple[str, dict]:
+    stream_options = {"stream": True, "stream_options": {"include_usage": True}} if on_text else {}
+    response = schedule_call(
+        "openai", system_prompt, prompt, get_client("openai").chat.completions.create,
+        consume=partial(read_chat_stream, on_text=on_text, make_stream_usage=openai_usage) if on_text else None,
+        model=openai_model,
+        temperature=0.1,
+        timeout=PROVIDER_TIMEOUTS["openai"],
+        messages=chat_messages(system_prompt, prompt),
+        **stream_options
+    )
+    if on_text:
+        return response
+    return str(response.choices[0].message.content), openai_usage(response.usage)
+
+
+def call_deepseek(system_prompt: str, prompt: str, on_text=None) -> tuple[str, dict]:
+    response = schedule_call(
+        "deepseek", system_prompt, prompt, get_client("deepseek").complete,
+        consume=partial(read_chat_stream, on_text=on_text, make_stream_usage=deepseek_usage) if on_text else None,
+        model=deepseek_model,
+        temperature=0.1,
+        timeout=PROVIDER_TIMEOUTS["deepseek"],
+        messages=chat_messages(system_prompt, prompt),
+        stream=bool(on_text)
+    )
+    if on_text:
+        return response
+    return str(response.choices[0].message.content), deepseek_usage(response.usage)
+
+
+def call_anthropic(system_prompt: str, prompt: str, on_text=None) -> tuple[str, dict]:
+    response = schedule_call(
+        "anthropic", system_prompt, prompt, get_client("anthropic").messages.create,
+        consume=partial(read_anthropic_stream, on_text=on_text) if on_text else None,
+        model=anthropic_model,
+        max_tokens=4000,
+        temperature=0.1,
+        timeout=PROVIDER_TIMEOUTS["anthropic"],
+        system=anthropic_system(system_prompt),
+        messages=[
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ],
+        stream=bool(on_text)
+    )
+    if on_text:
+        return response
+    usage = make_usage(
+        response.usage.input_tokens,
+        response.usage.output_tokens,
+        cache_read_input_tokens=getattr(response.usage, "cache_read_input_tokens", 0),
+        cache_creation_input_tokens=getattr(response.usage, "cache_creation_input_tokens", 0)
+    )
+    # Anthropic returns a list of textblocks, so we need to convert the first one to a string
+    return str(response.content[0].text), usage
+
+
+# Provider name -> call function. The order here is the order results are returned in.
+ALL_PROVIDERS = OrderedDict([
+    ("deepseek", call_deepseek),
+    ("openai", call_openai),
+    ("anthropic", call_anthropic),
+])
+
+
+def enabled_provider_names(names) -> list[str]:
+    """
+    The providers turned on by ENABLED_PROVIDERS (comma separated, e.g. "openai,anthropic"), in
+    registry order; all of them if it isn't set.
+    """
+    value = os.environ.get("ENABLED_PROVIDERS", "")
+    enabled = [name.strip() for name in value.split(",") if name.strip()]
+    if not enabled:
+        return list(names)
+    unknown = [name for name in enabled if name not in names]
+    if unknown:
+        raise ValueError(f"ENABLED_PROVIDERS has unknown providers: {', '.join(unknown)}")
+    return [name for name in names if name in enabled]
+
+
+# The providers a request runs by default
+PROVIDERS = OrderedDict((name, ALL_PROVIDERS[name]) for name in enabled_provider_names(ALL_PROVIDERS))
+
+
+def select_providers(models: str | None, providers=None) -> OrderedDict:
+    """
+    Narrow the providers to the ones named in a request's models parameter.
+
+    Parameters:
+    models (str): Comma-separated provider names, e.g. "openai,anthropic". Empty or None keeps them all.
+    providers (dict): Provider name -> call function to choose from. Defaults to PROVIDERS.
+
+    Returns:
+    OrderedDict: The chosen providers, in registry order.
+
+    Raises:
+    ValueError: If a name isn't an enabled provider.
+    """
+    providers = PROVIDERS if providers is None else providers
+    names = [name.strip() for name in (models or "").split(",") if name.strip()]
+    if not names:
+        return OrderedDict(providers)
+    unknown = [name for name in names if name not in providers]
+    if unknown:
+        raise ValueError(f"Unknown or disabled models: {', '.join(unknown)}. Available: {', '.join(providers)}")
+    return OrderedDict((name, call) for name, call in providers.items() if name in names)
+
+
+def timed_call(trace: RequestTrace, name: str, call, system_prompt: str, prompt: str) -> tuple[str, dict]:
+    """
+    Make a provider call, recording its duration and reported token usage as a "provider" span.
+    """
+    start = time.perf_counter()
+    try:
+        content, usage = call(system_prompt, prompt)
+    except Exception as e:
+        trace.record("provider", time.perf_counter() - start, start=start, provider=name, error=type(e).__name__)
+        raise
+    seconds = time.perf_counter() - start
+    trace.record("provider", seconds, start=start, provider=name, usage=usage)
+    record_usage(name, usage)
+    PROVIDER_LATENCY.observe(name, seconds)
+    return content, usage
+
+
+def iter_provider_results(system_prompt: str, prompt: str, providers=None, timeouts=None, trace: RequestTrace | None = None):
+    """
+    Call every provider concurrently and yield each result as soon as it is available.
+
+    Parameters:
+    system_prompt (str): The system prompt sent to every provider.
+    prompt (str): The user prompt sent to every provider.
+    providers (dict): Optional mapping of provider name to call function. Defaults to PROVIDERS.
+    timeouts (dict): Optional per-provider deadlines in seconds. Defaults to PROVIDER_TIMEOUTS.
+    trace (RequestTrace): Optional trace to record each provider call in.
+
+    Yields:
+    tuple: (provider name, response content or None, token usage or None, error message or None),
+    in completion order. A provider that misses its deadline is cancelled and yielded with a timeout error.
+    """
+    providers = PROVIDERS if providers is None else providers
+    timeouts = PROVIDER_TIMEOUTS if timeouts is None else timeouts
+    trace = RequestTrace() if trace is None else trace
+
+    start = time.monotonic()
+    pending = {}
+    for name, call in providers.items():
+        future = provider_executor.submit(timed_call, trace, name, call, system_prompt, prompt)
+        deadline = start + timeouts.get(name, DEFAULT_PROVIDER_TIMEOUT)
+        pending[future] = (name, deadline)
+
+    try:
+        while pending:
+            next_deadline = min(deadline for _, deadline in pending.values())
+            done, _ = wait(pending, timeout=max(0, next_deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                name, _ = pending.pop(future)
+                try:
+                    (content, usage), error = future.result(), None
+                except Exception as e:
+                    logger.error(f"Provider {name} failed: {str(e)}", exc_info=True)
+                    content, usage, error = None, None, str(e)
+                yield name, content, usage, error
+
+            now = time.monotonic()
+            for future, (name, deadline) in list(pending.items()):
+                if deadline <= now and not future.done():
+                    # A call already in flight can't be interrupted, but its result is discarded
+                    future.cancel()
+                    pending.pop(future)
+                    timeout = timeouts.get(name, DEFAULT_PROVIDER_TIMEOUT)
+                    logger.error(f"Provider {name} timed out after {timeout}s")
+                    yield name, None, None, f"Timed out after {timeout} seconds"
+    finally:
+        # The consumer stopped early (e.g. client disconnected), so drop work that hasn't started
+        for future in pending:
+            future.cancel()
+
+
+def iter_routed_provider_results(system_prompt: str, prompt: str, router, providers=None, timeouts=None,
+                                 trace: RequestTrace | None = None):
+    """
+    iter_provider_results for the "fastest" and "hedged" policies: providers are started when the
+    router (utils/routing.py) says so, rather than all at once.
+
+    The consumer must report each result it is given with router.finished() before asking for the
+    next one. Iteration stops as soon as the router has a winner; calls that haven't started yet
+    are cancelled, and the results of calls already in flight are discarded.
+
+    Yields:
+    tuple: (provider name, response content or None, token usage or None, error message or None).
+    """
+    providers = PROVIDERS if providers is None else providers
+    timeouts = PROVIDER_TIMEOUTS if timeouts is None else timeouts
+    trace = RequestTrace() if trace is None else trace
+    pending = {}
+
+    def launch(names):
+        for name in names:
+            future = provider_executor.submit(timed_call, trace, name, providers[name], system_prompt, prompt)
+            pending[future] = (name, time.monotonic() + timeouts.get(name, DEFAULT_PROVIDER_TIMEOUT))
+
+    launch(router.start(time.monotonic()))
+    try:
+        while not router.done:
+            wake_times = [deadline for _, deadline in pending.values()]
+            if router.wake_time() is not None:
+                wake_times.append(router.wake_time())
+            done, _ = wait(pending, timeout=max(0, min(wake_times) - time.monotonic()), return_when=FIRST_COMPLETED)
+
+            for future in done:
+                if router.done:
+                    break
+                name, _ = pending.pop(future)
+                try:
+                    (content, usage), error = future.result(), None
+                except Exception as e:
+                    logger.error(f"Provider {name} failed: {str(e)}", exc_info=True)
+                    content, usage, error = None, None, str(e)
+                yield name, content, usage, error
+
+            now = time.monotonic()
+            for future, (name, deadline) in list(pending.items()):
+                if deadline <= now and not future.done() and not router.done:
+                    future.cancel()
+                    pending.pop(future)
+                    timeout = timeouts.get(name, DEFAULT_PROVIDER_TIMEOUT)
+                    logger.error(f"Provider {name} timed out after {timeout}s")
+                    yield name, None, None, f"Timed out after {timeout} seconds"
+
+            launch(router.due(time.monotonic()))
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+class ProviderCancelledError(Exception):
+    """
+    Raised from a streaming callback to stop reading a response that is no longer wanted.
+    """
+
+
+def iter_provider_stream(system_prompt: str, prompt: str, providers=None, timeouts=None, trace: RequestTrace | None = None):
+    """
+    iter_provider_results with the responses streamed, so the text is available as it is generated.
+
+    The call functions must accept on_text (see CLIENT CALLS). Unlike a blocking call, a streaming
+    call that misses its deadline or is no longer wanted stops reading at its next piece of text,
+    which closes the connection.
+
+    Yields:
+    tuple: ("text", provider name, piece of text) as the responses stream in, and ("result", provider
+    name, response content or None, token usage or None, error message or None) as each provider
+    finishes, fails or times out.
+    """
+    providers = PROVIDERS if providers is None else providers
+    timeouts = PROVIDER_TIMEOUTS if timeouts is None else timeouts
+    trace = RequestTrace() if trace is None else trace
+    events = queue.Queue()
+    stopped = {name: threading.Event() for name in providers}
+
+    def run(name, call):
+        def on_text(text):
+            if stopped[name].is_set():
+                raise ProviderCancelledError(f"{name} response is no longer needed")
+            events.put(("text", name, text))
+
+        try:
+            content, usage = timed_call(trace, name, partial(call, on_text=on_text), system_prompt, prompt)
+            events.put(("result", name, content, usage, None))
+        except Exception as e:
+            events.put(("result", name, None, None, e))
+
+    start = time.monotonic()
+    deadlines = {name: start + timeouts.get(name, DEFAULT_PROVIDER_TIMEOUT) for name in providers}
+    futures = [provider_executor.submit(run, name, call) for name, call in providers.items()]
+    pending = set(providers)
+    try:
+        while pending:
+            next_deadline = min(deadlines[name] for name in pending)
+            try:
+                event = events.get(timeout=max(0, next_deadline - time.monotonic()))
+            except queue.Empty:
+                event = None
+
+            # Events from a provider that already timed out are dropped
+            if event is not None and event[1] in pending:
+                if event[0] == "text":
+                    yield event
+                else:
+                    _, name, content, usage, error = event
+                    pending.discard(name)
+                    if error is None:
+                        yield "result", name, content, usage, None
+                    else:
+                        logger.error(f"Provider {name} failed: {str(error)}", exc_info=error)
+                        yield "result", name, None, None, str(error)
+
+            now = time.monotonic()
+            for name in [name for name in pending if deadlines[name] <= now]:
+                stopped[name].set()
+                pending.discard(name)
+                timeout = timeouts.get(name, DEFAULT_PROVIDER_TIMEOUT)
+                logger.error(f"Provider {name} timed out after {timeout}s")
+                yield "result", name, None, None, f"Timed out after {timeout} seconds"
+    finally:
+        # The consumer stopped early (e.g. client disconnected), so stop reading the streams still open
+        for name in pending:
+            stopped[name].set()
+        for future in futures:
+            future.cancel()
+
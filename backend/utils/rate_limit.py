@@ -0,0 +1,357 @@
+import time
+import random
+import asyncio
+import logging
+import threading
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Status codes worth retrying: rate limited, server errors, and Anthropic's "overloaded"
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+class ProviderThrottledError(Exception):
+    """
+    Raised when a provider keeps rate limiting or failing after every retry.
+    """
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket that refills continuously at rate_per_minute up to capacity.
+
+    reserve() always succeeds and returns how long the caller must wait before its reservation is
+    covered, so large requests queue behind each other instead of starving.
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: float | None = None):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate_per_second)
+            self._updated_at = now
+            self._tokens -= amount
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate_per_second
+
+    def refund(self, amount: float) -> None:
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + amount)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Caps in-flight calls with additive-increase/multiplicative-decrease: the limit halves whenever the
+    provider throttles us and grows by one after a full window of successful calls.
+    """
+
+    def __init__(self, max_concurrency: int, min_concurrency: int = 1):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = max_concurrency
+        self._in_flight = 0
+        self._successes = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout: float | None = None) -> bool:
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._in_flight < self.limit, timeout=timeout):
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self) -> None:
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+
+    def on_success(self) -> None:
+        with self._condition:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.max_concurrency:
+                self.limit += 1
+                self._successes = 0
+                self._condition.notify()
+
+    def on_throttle(self) -> None:
+        with self._condition:
+            self.limit = max(self.min_concurrency, self.limit // 2)
+            self._successes = 0
+
+
+def get_status_code(exc: Exception) -> int | None:
+    """
+    Return the HTTP status code carried by an OpenAI, Anthropic or Azure SDK error, if any.
+    """
+    status_code = getattr(exc, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(exc, "response", None), "status_code", None)
+    return status_code if isinstance(status_code, int) else None
+
+
+def get_retry_after(exc: Exception) -> float | None:
+    headers = getattr(getattr(exc, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class ProviderScheduler:
+    """
+    Paces calls to one provider within its requests/min and tokens/min quotas.
+
+    Every call is charged against the quotas before it is sent, runs under an adaptive concurrency
+    limit, and is retried with exponential backoff and jitter on 429/5xx responses. Nothing is
+    retried past the call's deadline.
+    """
+
+    def __init__(self, name: str, requests_per_minute: float | None = None, tokens_per_minute: float | None = None,
+                 max_concurrency: int = 8, max_retries: int = 4, base_delay: float = 1.0, max_delay: float = 30.0):
+        self.name = name
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.limiter = AdaptiveConcurrencyLimiter(max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.counters = {"calls": 0, "retries": 0, "throttled": 0, "failures": 0}
+        self._counter_lock = threading.Lock()
+
+    def call(self, fn, *args, estimated_tokens: int = 0, deadline_seconds: float | None = None, consume=None, **kwargs):
+        """
+        Call fn(*args, **kwargs) within the provider's quotas, retrying throttled and failed attempts.
+
+        Parameters:
+        fn (callable): The SDK call to make.
+        estimated_tokens (int): Tokens to charge against the tokens/min quota before each attempt.
+        deadline_seconds (float): Seconds after which no further waiting or retrying is done. Kept apart
+        from fn's own keyword arguments, since the SDK calls take a timeout of their own.
+        consume (callable): Optional; called with fn's result while the slot is still held, e.g. to read a
+        streamed response to the end, and its return value is returned instead. Errors it raises aren't
+        retried, since part of the stream may already have been passed on.
+        """
+        deadline = None if deadline_seconds is None else time.monotonic() + deadline_seconds
+        attempt = 0
+        while True:
+            self._wait_for_quota(estimated_tokens, deadline)
+            if not self.limiter.acquire(timeout=self._remaining(deadline)):
+                raise ProviderThrottledError(f"{self.name}: no capacity available before the deadline")
+            consume_error = None
+            try:
+                self._count("calls")
+                result, error = fn(*args, **kwargs), None
+            except Exception as e:
+                result, error = None, e
+            else:
+                if consume is not None:
+                    try:
+                        result = consume(result)
+                    except Exception as e:
+                        consume_error = e
+            finally:
+                # Also reached when the call is interrupted, so the slot is never lost
+                self.limiter.release()
+
+            if consume_error is not None:
+                self._count("failures")
+                raise consume_error
+            if error is None:
+                self.limiter.on_success()
+                return result
+
+            status_code = get_status_code(error)
+            if status_code not in RETRYABLE_STATUS_CODES:
+                self._count("failures")
+                raise error
+            if status_code == 429:
+                self._count("throttled")
+                self.limiter.on_throttle()
+
+            delay = self._backoff(attempt, get_retry_after(error))
+            remaining = self._remaining(deadline)
+            if attempt >= self.max_retries or (remaining is not None and delay >= remaining):
+                self._count("failures")
+                raise ProviderThrottledError(
+                    f"{self.name} returned {status_code} after {attempt + 1} attempts: {str(error)}"
+                ) from error
+
+            logger.warning(f"{self.name} returned {status_code}, retrying in {delay:.1f}s (attempt {attempt + 1})")
+            self._count("retries")
+            attempt += 1
+            time.sleep(delay)
+
+    def stats(self) -> dict:
+        with self._counter_lock:
+            return {**self.counters, "concurrency_limit": self.limiter.limit}
+
+    def _wait_for_quota(self, estimated_tokens: int, deadline: float | None) -> None:
+        wait = self._reserve_quota(estimated_tokens, deadline)
+        if wait > 0:
+            time.sleep(wait)
+
+    def _reserve_quota(self, estimated_tokens: int, deadline: float | None) -> float:
+        """
+        Charge one call against the quotas and return how long to wait before making it.
+        """
+        wait = 0.0
+        if self.request_bucket is not None:
+            wait = max(wait, self.request_bucket.reserve(1))
+        if self.token_bucket is not None and estimated_tokens:
+            wait = max(wait, self.token_bucket.reserve(estimated_tokens))
+        if wait <= 0:
+            return 0.0
+
+        remaining = self._remaining(deadline)
+        if remaining is not None and wait >= remaining:
+            # Give the reservation back so it doesn't delay calls that can still make their deadline
+            if self.request_bucket is not None:
+                self.request_bucket.refund(1)
+            if self.token_bucket is not None and estimated_tokens:
+                self.token_bucket.refund(estimated_tokens)
+            raise ProviderThrottledError(f"{self.name}: rate limit quota would not free up before the deadline")
+        logger.debug(f"{self.name}: waiting {wait:.2f}s for rate limit quota")
+        return wait
+
+    def _backoff(self, attempt: int, retry_after: float | None) -> float:
+        if retry_after is not None:
+            return min(self.max_delay, retry_after)
+        # "Full jitter": spread retries out so concurrent callers don't hit the provider in lockstep
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def _count(self, counter: str) -> None:
+        with self._counter_lock:
+            self.counters[counter] += 1
+
+    @staticmethod
+    def _remaining(deadline: float | None) -> float | None:
+        return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+
+class AsyncConcurrencyLimiter:
+    """
+    asyncio version of AdaptiveConcurrencyLimiter, for calls made from an event loop.
+    """
+
+    def __init__(self, max_concurrency: int, min_concurrency: int = 1):
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = max_concurrency
+        self._in_flight = 0
+        self._successes = 0
+        self._condition = asyncio.Condition()
+
+    async def acquire(self, timeout: float | None = None) -> bool:
+        async with self._condition:
+            try:
+                await asyncio.wait_for(self._condition.wait_for(lambda: self._in_flight < self.limit), timeout)
+            except asyncio.TimeoutError:
+                return False
+            self._in_flight += 1
+            return True
+
+    async def release(self) -> None:
+        # Counted before waiting for the lock, so the slot is freed even if this is interrupted
+        self._in_flight -= 1
+        async with self._condition:
+            self._condition.notify()
+
+    async def on_success(self) -> None:
+        async with self._condition:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.max_concurrency:
+                self.limit += 1
+                self._successes = 0
+                self._condition.notify()
+
+    def on_throttle(self) -> None:
+        self.limit = max(self.min_concurrency, self.limit // 2)
+        self._successes = 0
+
+
+class AsyncProviderScheduler:
+    """
+    asyncio counterpart of ProviderScheduler for the async SDK clients.
+
+    It charges the same token buckets and counters as the ProviderScheduler it wraps, so both kinds
+    of call share one set of quotas, but waits with asyncio.sleep instead of holding a thread.
+    """
+
+    def __init__(self, scheduler: ProviderScheduler):
+        self.scheduler = scheduler
+        self.name = scheduler.name
+        self.limiter = AsyncConcurrencyLimiter(scheduler.limiter.max_concurrency)
+
+    async def call(self, fn, *args, estimated_tokens: int = 0, deadline_seconds: float | None = None, consume=None, **kwargs):
+        """
+        Await fn(*args, **kwargs) within the provider's quotas, retrying throttled and failed attempts.
+        consume, if given, is an async function awaited with the result while the slot is held.
+        See ProviderScheduler.call.
+        """
+        scheduler = self.scheduler
+        deadline = None if deadline_seconds is None else time.monotonic() + deadline_seconds
+        attempt = 0
+        while True:
+            wait = scheduler._reserve_quota(estimated_tokens, deadline)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if not await self.limiter.acquire(timeout=scheduler._remaining(deadline)):
+                raise ProviderThrottledError(f"{self.name}: no capacity available before the deadline")
+            consume_error = None
+            try:
+                scheduler._count("calls")
+                result, error = await fn(*args, **kwargs), None
+            except Exception as e:
+                result, error = None, e
+            else:
+                if consume is not None:
+                    try:
+                        result = await consume(result)
+                    except Exception as e:
+                        consume_error = e
+            finally:
+                # Also reached when the task is cancelled (timeout, a routing winner, a client
+                # disconnect): CancelledError isn't an Exception, and the slot must still be freed
+                await asyncio.shield(self.limiter.release())
+
+            if consume_error is not None:
+                scheduler._count("failures")
+                raise consume_error
+            if error is None:
+                await self.limiter.on_success()
+                return result
+
+            status_code = get_status_code(error)
+            if status_code not in RETRYABLE_STATUS_CODES:
+                scheduler._count("failures")
+                raise error
+            if status_code == 429:
+                scheduler._count("throttled")
+                self.limiter.on_throttle()
+
+            delay = scheduler._backoff(attempt, get_retry_after(error))
+            remaining = scheduler._remaining(deadline)
+            if attempt >= scheduler.max_retries or (remaining is not None and delay >= remaining):
+                scheduler._count("failures")
+                raise ProviderThrottledError(
+                    f"{self.name} returned {status_code} after {attempt + 1} attempts: {str(error)}"
+                ) from error
+
+            logger.warning(f"{self.name} returned {status_code}, retrying in {delay:.1f}s (attempt {attempt + 1})")
+            scheduler._count("retries")
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        return {**self.scheduler.stats(), "concurrency_limit": self.limiter.limit}
@@ -0,0 +1,301 @@
+import os
+import io
+import re
+import csv
+import json
+import time
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from utils.pipeline import OUTPUTS_DIR
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Every extraction's results are kept here, so reconciliation can read them instead of re-extracting
+RESULTS_DB_PATH = os.environ.get("RESULTS_DB_PATH", os.path.join(OUTPUTS_DIR, "results", "results.sqlite3"))
+RESULTS_STORE_ENABLED = os.environ.get("RESULTS_STORE_ENABLED", "true").lower() == "true"
+# Rows fetched from SQLite at a time while exporting, so exports don't load the whole table
+EXPORT_BATCH_ROWS = 500
+MAX_QUERY_LIMIT = 1000
+
+# Fields that can be looked up, in the normalized form they are indexed in
+LOOKUP_FIELDS = ("vendor_name", "invoice_number", "invoice_date", "po_number", "file_hash")
+EXPORT_COLUMNS = ["id", "file_hash", "filename", "document_type", "model", "vendor_name", "invoice_number", "invoice_date",
+                  "po_number", "total", "source", "stored_at", "data"]
+DATE_FORMATS = ("%m/%d/%Y", "%m/%d/%y", "%Y-%m-%d", "%m-%d-%Y", "%B %d, %Y", "%b %d, %Y", "%B %d %Y", "%b %d %Y", "%d %B %Y")
+
+
+def normalize_name(value) -> str | None:
+    # "ACME  Corp." and "Acme Corp" are the same vendor
+    if value is None:
+        return None
+    text = " ".join(re.sub(r"[^\w\s]", " ", str(value).lower()).split())
+    return text or None
+
+
+def normalize_identifier(value) -> str | None:
+    # "INV 10042", "inv-10042" and "INV10042" are the same invoice number
+    if value is None:
+        return None
+    text = re.sub(r"[^0-9A-Z]", "", str(value).upper())
+    return text or None
+
+
+def normalize_date(value) -> str | None:
+    """
+    An extracted date as YYYY-MM-DD, or the text as given if it isn't in a format we recognize.
+    """
+    if value is None:
+        return None
+    text = " ".join(str(value).replace(".", "").split())
+    if not text:
+        return None
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).date().isoformat()
+        except ValueError:
+            continue
+    return text
+
+
+def _amount(value) -> float | None:
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        return float(str(value).replace(",", "").replace("$", "").strip())
+    except ValueError:
+        return None
+
+
+NORMALIZERS = {
+    "vendor_name": normalize_name,
+    "invoice_number": normalize_identifier,
+    "invoice_date": normalize_date,
+    "po_number": normalize_identifier,
+    "file_hash": lambda value: str(value).lower() if value else None,
+}
+
+
+class ResultsStore:
+    """
+    SQLite table of extraction results, one row per document and model, indexed on the fields
+    invoices are looked up and matched by.
+
+    Storing the same document's result from the same model again replaces the earlier row, so the
+    table holds the latest extraction of each document. Lookups compare normalized values, e.g.
+    invoice numbers ignore case and punctuation, and dates are compared as YYYY-MM-DD.
+    """
+
+    def __init__(self, db_path: str = RESULTS_DB_PATH, enabled: bool = RESULTS_STORE_ENABLED):
+        self.db_path = db_path
+        self.enabled = enabled
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._db = self._connect()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, file_hash TEXT NOT NULL, filename TEXT, document_type TEXT NOT NULL, "
+            "model TEXT NOT NULL, vendor_name TEXT, invoice_number TEXT, invoice_date TEXT, po_number TEXT, total REAL, "
+            "source TEXT, stored_at REAL NOT NULL, data TEXT NOT NULL, "
+            "UNIQUE (file_hash, document_type, model))"
+        )
+        for field in ("vendor_name", "invoice_number", "invoice_date", "po_number"):
+            self._db.execute(f"CREATE INDEX IF NOT EXISTS results_{field} ON results ({field})")
+        # file_hash is covered by the UNIQUE constraint's index; this one serves duplicate detection
+        self._db.execute("CREATE INDEX IF NOT EXISTS results_invoice ON results (invoice_number, vendor_name, file_hash)")
+        self._db.commit()
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def write(self, file_hash: str, filename: str | None, document_type: str, results: dict, source: str) -> int:
+        """
+        Store each model's result for a document. Failed results ({"error": ...}) are skipped. A
+        storage error is logged rather than raised, so it never fails the extraction itself.
+
+        Parameters:
+        file_hash (str): SHA-256 hex digest of the PDF.
+        filename (str): The document's file name, if known.
+        document_type (str): The type of document that was extracted.
+        results (dict): model name -> parsed result, as returned by run_models.
+        source (str): What ran the extraction, e.g. "process-pdf", "batch" or "job".
+
+        Returns:
+        int: The number of results stored.
+        """
+        if not self.enabled:
+            return 0
+        now = time.time()
+        rows = []
+        for model, data in results.items():
+            if not isinstance(data, dict) or set(data) == {"error"}:
+                continue
+            rows.append((
+                file_hash, filename, document_type, model,
+                *(NORMALIZERS[field](data.get(field)) for field in ("vendor_name", "invoice_number", "invoice_date", "po_number")),
+                _amount(data.get("total")), source, now, json.dumps(data)
+            ))
+        if not rows:
+            return 0
+        try:
+            with self._lock:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO results (file_hash, filename, document_type, model, vendor_name, invoice_number, "
+                    "invoice_date, po_number, total, source, stored_at, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    rows
+                )
+                self._db.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Error storing results for {filename or file_hash}: {str(e)}", exc_info=True)
+            return 0
+        return len(rows)
+
+    @staticmethod
+    def _where(filters: dict) -> tuple[str, list]:
+        """
+        SQL conditions for lookup filters: the LOOKUP_FIELDS, plus model and document_type as given.
+
+        Raises:
+        ValueError: If a filter isn't one of those fields.
+        """
+        unknown = [name for name in filters if name not in (*LOOKUP_FIELDS, "model", "document_type")]
+        if unknown:
+            raise ValueError(f"Unknown filters: {', '.join(unknown)}")
+        conditions, values = [], []
+        for name, value in filters.items():
+            value = NORMALIZERS[name](value) if name in NORMALIZERS else value
+            conditions.append(f"{name} = ?")
+            values.append(value)
+        return (" WHERE " + " AND ".join(conditions)) if conditions else "", values
+
+    @staticmethod
+    def _row(row: sqlite3.Row) -> dict:
+        result = dict(row)
+        result["data"] = json.loads(result["data"])
+        return result
+
+    def query(self, filters: dict, limit: int = 100, offset: int = 0) -> list[dict]:
+        """
+        Look up stored results, newest first.
+
+        Parameters:
+        filters (dict): Field -> value to match, e.g. {"vendor_name": "Acme Corp", "invoice_number": "INV-1"}.
+        limit (int): At most this many rows, capped at MAX_QUERY_LIMIT.
+        offset (int): Rows to skip, for paging.
+
+        Returns:
+        list: The matching rows, each with its parsed data.
+        """
+        where, values = self._where(filters)
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT * FROM results{where} ORDER BY stored_at DESC, id DESC LIMIT ? OFFSET ?",
+                (*values, max(0, min(limit, MAX_QUERY_LIMIT)), max(0, offset))
+            ).fetchall()
+        return [self._row(row) for row in rows]
+
+    def duplicates(self, file_hash: str | None = None, limit: int = 100) -> list[dict]:
+        """
+        Find invoices that were extracted from more than one document: the same invoice number from
+        the same vendor, in different files (e.g. a rescan, or an invoice sent twice).
+
+        Parameters:
+        file_hash (str): Only report the duplicates of this document.
+        limit (int): At most this many groups, capped at MAX_QUERY_LIMIT.
+
+        Returns:
+        list: {"vendor_name", "invoice_number", "documents": [{"file_hash", "filename", "invoice_date",
+        "total", "models", "stored_at"}, ...]} for each duplicated invoice.
+        """
+        conditions = "invoice_number IS NOT NULL"
+        values = []
+        if file_hash is not None:
+            # IS rather than = so an invoice without a vendor matches, as in the per-group query below
+            conditions += (" AND EXISTS (SELECT 1 FROM results r2 WHERE r2.file_hash = ? "
+                           "AND r2.invoice_number = results.invoice_number AND r2.vendor_name IS results.vendor_name)")
+            values.append(NORMALIZERS["file_hash"](file_hash))
+        with self._lock:
+            groups = self._db.execute(
+                f"SELECT invoice_number, vendor_name FROM results WHERE {conditions} "
+                "GROUP BY invoice_number, vendor_name HAVING COUNT(DISTINCT file_hash) > 1 "
+                "ORDER BY MAX(stored_at) DESC LIMIT ?",
+                (*values, max(0, min(limit, MAX_QUERY_LIMIT)))
+            ).fetchall()
+            report = []
+            for group in groups:
+                rows = self._db.execute(
+                    "SELECT file_hash, filename, model, invoice_date, total, stored_at FROM results "
+                    "WHERE invoice_number = ? AND vendor_name IS ? ORDER BY stored_at",
+                    (group["invoice_number"], group["vendor_name"])
+                ).fetchall()
+                documents = {}
+                for row in rows:
+                    document = documents.setdefault(row["file_hash"], {
+                        "file_hash": row["file_hash"],
+                        "filename": row["filename"],
+                        "invoice_date": row["invoice_date"],
+                        "total": row["total"],
+                        "models": [],
+                        "stored_at": row["stored_at"],
+                    })
+                    document["models"].append(row["model"])
+                report.append({
+                    "vendor_name": group["vendor_name"],
+                    "invoice_number": group["invoice_number"],
+                    "documents": list(documents.values()),
+                })
+        return report
+
+    def iter_rows(self, filters: dict, batch_rows: int = EXPORT_BATCH_ROWS):
+        """
+        Yield every matching row, oldest first, reading batch_rows at a time on a connection of its
+        own, so a long export neither holds the whole table in memory nor blocks writers.
+        """
+        where, values = self._where(filters)
+        db = self._connect()
+        try:
+            cursor = db.execute(f"SELECT {', '.join(EXPORT_COLUMNS)} FROM results{where} ORDER BY id", values)
+            while True:
+                rows = cursor.fetchmany(batch_rows)
+                if not rows:
+                    break
+                for row in rows:
+                    yield dict(row)
+        finally:
+            db.close()
+
+    def export_ndjson(self, filters: dict):
+        """
+        Yield matching results as NDJSON lines, the data as a nested object.
+        """
+        for row in self.iter_rows(filters):
+            row["data"] = json.loads(row["data"])
+            yield json.dumps(row) + "\n"
+
+    def export_csv(self, filters: dict):
+        """
+        Yield matching results as CSV lines, starting with a header; the data column holds the JSON.
+        """
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+
+        def line(values) -> str:
+            writer.writerow(values)
+            text = buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            return text
+
+        yield line(EXPORT_COLUMNS)
+        for row in self.iter_rows(filters):
+            yield line(row[column] for column in EXPORT_COLUMNS)
+
+
+results_store = ResultsStore()
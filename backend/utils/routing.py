@@ -0,0 +1,240 @@
+import os
+import logging
+from utils.metrics import PROVIDER_LATENCY
+from utils.prompts import get_field_names
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# "consensus" calls every provider and scores how well they agree; "fastest" calls ROUTING_FANOUT
+# providers and keeps the first valid result; "hedged" calls one provider and only starts a backup
+# if it is slower than usual or fails
+ROUTING_POLICIES = ("consensus", "fastest", "hedged")
+DEFAULT_ROUTING_POLICY = os.environ.get("ROUTING_POLICY", "consensus")
+# Providers started at once by "fastest"
+ROUTING_FANOUT = int(os.environ.get("ROUTING_FANOUT", "2"))
+# "hedged" starts the backup once the provider in flight passes this percentile of its recent latency...
+HEDGE_PERCENTILE = float(os.environ.get("HEDGE_PERCENTILE", "90"))
+# ...given at least this many recent calls to go on, and otherwise after HEDGE_DEFAULT_DELAY_SECONDS
+HEDGE_MIN_SAMPLES = int(os.environ.get("HEDGE_MIN_SAMPLES", "5"))
+HEDGE_DEFAULT_DELAY_SECONDS = float(os.environ.get("HEDGE_DEFAULT_DELAY_SECONDS", "20"))
+
+ADDRESS_FIELDS = ("bill_to_address", "ship_to_address")
+AMOUNT_FIELDS = ("subtotal", "packing_fee", "freight", "sales_tax", "total", "prepayment", "balance_due")
+
+
+def rank_providers(names) -> list[str]:
+    """
+    Order providers by their recent median latency, fastest first. Providers without any recent
+    calls go first, in the given order, so every provider gets measured.
+    """
+    names = list(names)
+    medians = {name: PROVIDER_LATENCY.percentile(name, 50) for name in names}
+    unmeasured = [name for name in names if medians[name] is None]
+    measured = sorted((name for name in names if medians[name] is not None), key=lambda name: medians[name])
+    return unmeasured + measured
+
+
+def hedge_delay(name: str) -> float:
+    """
+    Seconds to wait on a provider before starting a backup: its recent HEDGE_PERCENTILE latency.
+    """
+    if PROVIDER_LATENCY.count(name) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY_SECONDS
+    return PROVIDER_LATENCY.percentile(name, HEDGE_PERCENTILE)
+
+
+def _is_amount(value) -> bool:
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, (int, float)):
+        return True
+    try:
+        float(str(value).replace(",", "").replace("$", "").strip())
+        return True
+    except ValueError:
+        return False
+
+
+def validate_result(document_type: str, data, fields: list[str] | None = None) -> list[str]:
+    """
+    Check a parsed model result against the shape the prompt asks for.
+
+    Parameters:
+    document_type (str): The type of document that was extracted.
+    data: The parsed result.
+    fields (list): The fields that were asked for, if not the document type's full field list.
+
+    Returns:
+    list: A description of each problem found; empty if the result is valid.
+    """
+    if not isinstance(data, dict):
+        return ["result is not a JSON object"]
+    if "error" in data and len(data) == 1:
+        return [f"provider failed: {data['error']}"]
+    if document_type != "invoice":
+        return [] if data else ["result is empty"]
+
+    problems = []
+    expected = fields if fields is not None else get_field_names("invoice")
+    missing = [name for name in expected if name not in data]
+    if missing:
+        problems.append(f"missing fields: {', '.join(missing)}")
+    if all(data.get(name) is None for name in expected):
+        problems.append("every field is null")
+    for name in ADDRESS_FIELDS:
+        if data.get(name) is not None and not isinstance(data[name], dict):
+            problems.append(f"{name} is not an object")
+    for name in AMOUNT_FIELDS:
+        if data.get(name) is not None and not _is_amount(data[name]):
+            problems.append(f"{name} is not an amount")
+    items = data.get("invoice_items")
+    if items is not None and not (isinstance(items, list) and all(isinstance(item, dict) for item in items)):
+        problems.append("invoice_items is not a list of objects")
+    return problems
+
+
+class Router:
+    """
+    Decides which providers to start, and when, for the "fastest" and "hedged" policies.
+
+    The router does no I/O: the caller starts the providers it returns from start() and due(),
+    reports every outcome with finished(), and stops once done is set. A provider that fails or
+    returns an invalid result is replaced by the next one, which due() then returns. The same router
+    drives the thread pool (providers.iter_routed_provider_results) and the event loop
+    (async_providers.aiter_routed_provider_results).
+    """
+
+    def __init__(self, policy: str, names, fanout: int = ROUTING_FANOUT):
+        if policy not in ("fastest", "hedged"):
+            raise ValueError(f"Router doesn't handle the {policy} policy")
+        self.policy = policy
+        self.order = rank_providers(names)
+        self.fanout = max(1, fanout)
+        self.started = []
+        self.failed = {}
+        self.winner = None
+        self._running = set()
+        self._queued = []
+        self._hedge_at = None
+
+    def _start_next(self, now: float) -> None:
+        remaining = [name for name in self.order if name not in self.started]
+        if not remaining:
+            self._hedge_at = None
+            return
+        name = remaining[0]
+        self.started.append(name)
+        self._running.add(name)
+        self._queued.append(name)
+        if self.policy == "hedged":
+            self._hedge_at = now + hedge_delay(name)
+
+    def _take_queued(self) -> list[str]:
+        names, self._queued = self._queued, []
+        return names
+
+    def start(self, now: float) -> list[str]:
+        """
+        The providers to start with: the ROUTING_FANOUT fastest for "fastest", the fastest for "hedged".
+        """
+        for _ in range(self.fanout if self.policy == "fastest" else 1):
+            self._start_next(now)
+        return self._take_queued()
+
+    def wake_time(self) -> float | None:
+        """
+        When due() may next start a backup, or None if there is nothing to wait for.
+        """
+        return None if self.done else self._hedge_at
+
+    def due(self, now: float) -> list[str]:
+        """
+        The providers to start now: replacements for failed ones, and a backup if the provider in
+        flight has passed its hedge delay.
+        """
+        if self.done:
+            return []
+        if self._hedge_at is not None and now >= self._hedge_at:
+            logger.debug(f"Hedging: {', '.join(sorted(self._running))} still running, starting a backup")
+            self._start_next(now)
+        return self._take_queued()
+
+    def finished(self, name: str, problems: list[str], now: float) -> None:
+        """
+        Record a provider's outcome; problems is empty if its result was valid.
+        """
+        self._running.discard(name)
+        if self.winner is not None:
+            return
+        if not problems:
+            self.winner = name
+            return
+        logger.warning(f"Routing: {name} result not usable ({'; '.join(problems)})")
+        self.failed[name] = "; ".join(problems)
+        # "fastest" keeps ROUTING_FANOUT providers in flight; "hedged" only needs one
+        if self.policy == "fastest" or not self._running:
+            self._start_next(now)
+
+    @property
+    def done(self) -> bool:
+        return self.winner is not None or not self._running
+
+    def report(self) -> dict:
+        """
+        How the request was routed, for the response: the winner, the providers started in order,
+        the ones that failed or were invalid, and the ones cancelled once there was a winner.
+        """
+        return {
+            "policy": self.policy,
+            "winner": self.winner,
+            "started": list(self.started),
+            "failed": dict(self.failed),
+            "cancelled": [name for name in self.started if name in self._running],
+        }
+
+
+def _comparable(value):
+    if isinstance(value, str):
+        text = value.strip().lower()
+        if _is_amount(text) and any(char.isdigit() for char in text):
+            return round(float(text.replace(",", "").replace("$", "")), 2)
+        return " ".join(text.split())
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return round(float(value), 2)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _comparable(item)) for key, item in value.items()))
+    if isinstance(value, list):
+        return tuple(_comparable(item) for item in value)
+    return value
+
+
+def agreement_report(results: dict) -> dict:
+    """
+    Score how well the models agree, field by field. Values are compared after normalizing case,
+    whitespace and number formatting; invoice_items are compared as a whole list.
+
+    Parameters:
+    results (dict): model name -> parsed result. Failed results ({"error": ...}) are left out.
+
+    Returns:
+    dict: {"score": mean agreement over the fields, "fields": field -> {"value": the value most
+    models gave, "agreement": share of the models that gave it, "models": those models}}.
+    """
+    results = {name: data for name, data in results.items() if isinstance(data, dict) and set(data) != {"error"}}
+    fields = {}
+    for name in dict.fromkeys(key for data in results.values() for key in data):
+        groups = {}
+        for model, data in results.items():
+            value = data.get(name)
+            groups.setdefault(_comparable(value), []).append((model, value))
+        # Ties go to the group of the model listed first
+        best = max(groups.values(), key=len)
+        fields[name] = {
+            "value": best[0][1],
+            "agreement": round(len(best) / len(results), 3),
+            "models": [model for model, _ in best],
+        }
+    score = sum(field["agreement"] for field in fields.values()) / len(fields) if fields else None
+    return {"score": round(score, 3) if score is not None else None, "fields": fields}
@@ -0,0 +1,183 @@
+import os
+import re
+import logging
+from utils.prompts import get_field_names
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# "off" always calls the models; "skip" returns the rule-based result without calling them when every
+# required field was found; "fill" asks the models only for the fields the rules didn't find
+RULE_MODES = ("off", "skip", "fill")
+DEFAULT_RULE_MODE = os.environ.get("RULE_EXTRACTION_MODE", "off")
+# Values found with at least this confidence are trusted and not asked of the models
+RULE_MIN_CONFIDENCE = float(os.environ.get("RULE_MIN_CONFIDENCE", "0.85"))
+# Fields that must be found for "skip" mode to leave out the models
+RULE_REQUIRED_FIELDS = [
+    name.strip() for name in os.environ.get("RULE_REQUIRED_FIELDS", "invoice_number,invoice_date,total").split(",")
+    if name.strip()
+]
+
+MONEY = r"\d{1,3}(?:,\d{3})+\.\d{2}|\d+\.\d{2}"
+DATE = (
+    r"\d{1,2}/\d{1,2}/(?:\d{4}|\d{2})|\d{4}-\d{2}-\d{2}|"
+    r"(?:jan|feb|mar|apr|may|jun|jul|aug|sep|sept|oct|nov|dec)[a-z]*\.?\s+\d{1,2},?\s+\d{4}"
+)
+# An identifier: at least three characters and at least one digit, so "PO Box" isn't read as a PO number
+IDENTIFIER = r"(?=[A-Z0-9\-/.]*\d)[A-Z0-9][A-Z0-9\-/.]{2,}"
+NUMBER_LABEL = r"\s*(?:#|no\.?|num\.?|number)\s*[:#]?\s*"
+TERMS = r"\d+(?:\.\d+)?%?\s*/\s*\d+,?\s*net\s*\d+|net\s*\d+|due\s+(?:on|upon)\s+receipt|c\.?o\.?d\.?(?![a-z])"
+
+
+def _rule(field: str, pattern: str, confidence: float, flags: int = re.IGNORECASE):
+    return field, re.compile(pattern, flags), confidence
+
+
+# (field, pattern with a "value" group, confidence of a match). Labels before the value are the usual
+# layout; labels after it are how PyPDF2 often linearizes right-aligned totals, so they score lower.
+RULES = [
+    _rule("invoice_number", r"\binvoice" + NUMBER_LABEL + r"(?P<value>" + IDENTIFIER + r")", 0.95),
+    _rule("invoice_number", r"\binvoice\s*:\s*(?P<value>" + IDENTIFIER + r")", 0.85),
+    _rule("invoice_date", r"\binvoice\s+date\s*:?\s*(?P<value>" + DATE + r")", 0.95),
+    _rule("invoice_date", r"^\s*(?:date|dated|date\s+issued)\s*:?\s*(?P<value>" + DATE + r")", 0.85,
+          re.IGNORECASE | re.MULTILINE),
+    _rule("due_date", r"\b(?:due\s+date|payment\s+due|date\s+due)\s*:?\s*(?P<value>" + DATE + r")", 0.95),
+    _rule("po_number", r"\b(?:p\.?\s?o\.?|purchase\s+order)" + NUMBER_LABEL + r"(?P<value>" + IDENTIFIER + r")", 0.9),
+    _rule("po_number", r"\b(?:p\.?\s?o\.?|purchase\s+order)\s*:\s*(?P<value>" + IDENTIFIER + r")", 0.85),
+    _rule("vendor_order_number", r"\b(?:s\.?\s?o\.?|sales\s+order|order)" + NUMBER_LABEL + r"(?P<value>" + IDENTIFIER + r")", 0.9),
+    _rule("account_number", r"\b(?:acct\.?|account|customer)" + NUMBER_LABEL + r"(?P<value>" + IDENTIFIER + r")", 0.9),
+    _rule("terms", r"\b(?:payment\s+)?terms\s*:?\s*(?P<value>" + TERMS + r")", 0.95),
+    _rule("terms", r"(?<![a-z])(?P<value>" + TERMS + r")", 0.8),
+    _rule("currency", r"\b(?P<value>USD|EUR|GBP|CAD|AUD|MXN)\b", 0.95, 0),
+    _rule("currency", r"(?P<value>[$€£])\s?\d", 0.85, 0),
+    _rule("subtotal", r"\bsub\s*-?\s*total\s*:?\s*\$?\s*(?P<value>" + MONEY + r")", 0.9),
+    _rule("subtotal", r"\$\s?(?P<value>" + MONEY + r")\s*sub\s*-?\s*total\b", 0.8),
+    _rule("freight", r"\b(?:freight|shipping(?:\s+(?:and|&)\s+handling)?)(?:\s+charges?)?\s*:?\s*\$?\s*(?P<value>" + MONEY + r")", 0.85),
+    _rule("freight", r"\$\s?(?P<value>" + MONEY + r")\s*(?:freight|shipping(?:\s+(?:and|&)\s+handling)?)\b", 0.8),
+    _rule("sales_tax", r"\b(?:sales\s+)?tax(?:\s*\(\s*[\d.]+\s*%\s*\))?\s*:?\s*\$?\s*(?P<value>" + MONEY + r")", 0.85),
+    _rule("sales_tax", r"\$\s?(?P<value>" + MONEY + r")\s*(?:sales\s+)?tax\b", 0.8),
+    _rule("total", r"^\s*(?:invoice\s+|grand\s+|order\s+)?total(?:\s+amount)?\s*:?\s*\$?\s*(?P<value>" + MONEY + r")", 0.9,
+          re.IGNORECASE | re.MULTILINE),
+    _rule("total", r"\$\s?(?P<value>" + MONEY + r")\s*(?:invoice\s+|grand\s+|order\s+)?total\b(?!\s*(?:price|discount))", 0.8),
+    _rule("prepayment", r"\b(?:deposit\s+received|deposit\s+paid|prepayment|payments?\s+received|amount\s+paid)\s*:?\s*\$?\s*(?P<value>" + MONEY + r")", 0.9),
+    _rule("balance_due", r"\b(?:balance|amount)\s+due\s*:?\s*\$?\s*(?P<value>" + MONEY + r")", 0.95),
+    _rule("balance_due", r"\$\s?(?P<value>" + MONEY + r")\s*(?:balance|amount)\s+due\b", 0.85),
+]
+
+MONEY_FIELDS = {"subtotal", "freight", "sales_tax", "total", "prepayment", "balance_due", "packing_fee"}
+CURRENCY_SYMBOLS = {"$": "USD", "€": "EUR", "£": "GBP"}
+
+
+def _normalize_value(field: str, value: str):
+    value = " ".join(value.split())
+    if field in MONEY_FIELDS:
+        return round(float(value.replace(",", "")), 2)
+    if field == "currency":
+        return CURRENCY_SYMBOLS.get(value, value.upper())
+    if field == "terms":
+        return re.sub(r"\bnet\b", "Net", value, flags=re.IGNORECASE)
+    # PyPDF2 often runs a value into the next label, e.g. "23-1018016Terms"
+    return re.sub(r"(?<=\d)[A-Z][a-z]+$", "", value).rstrip(".-/")
+
+
+def _pick(candidates: list[tuple]) -> tuple:
+    """
+    Choose a field's value from its (value, confidence) matches.
+
+    The same value matched more than once gains a little confidence; a different value matched
+    almost as confidently makes the field ambiguous and loses a lot.
+    """
+    best = {}
+    counts = {}
+    for value, confidence in candidates:
+        best[value] = max(best.get(value, 0.0), confidence)
+        counts[value] = counts.get(value, 0) + 1
+
+    ranked = sorted(best, key=lambda value: (best[value], counts[value]), reverse=True)
+    value = ranked[0]
+    confidence = min(0.99, best[value] + 0.02 * (counts[value] - 1))
+    if len(ranked) > 1 and best[ranked[1]] >= best[value] - 0.1:
+        confidence -= 0.25
+    return value, round(max(confidence, 0.0), 2)
+
+
+def _cross_check(fields: dict) -> None:
+    """
+    Raise the confidence of amounts that add up, e.g. subtotal + freight + tax = total.
+    """
+    def amount(name):
+        return fields[name]["value"] if name in fields else None
+
+    def confirm(*names):
+        for name in names:
+            fields[name]["confidence"] = max(fields[name]["confidence"], 0.97)
+
+    total, subtotal = amount("total"), amount("subtotal")
+    if total is not None and subtotal is not None:
+        extras = [name for name in ("freight", "sales_tax", "packing_fee") if name in fields]
+        if abs(subtotal + sum(amount(name) for name in extras) - total) < 0.015:
+            confirm("total", "subtotal", *extras)
+
+    balance_due, prepayment = amount("balance_due"), amount("prepayment")
+    if total is not None and balance_due is not None:
+        if prepayment is not None and abs(total - prepayment - balance_due) < 0.015:
+            confirm("total", "prepayment", "balance_due")
+        elif prepayment is None and abs(total - balance_due) < 0.015:
+            confirm("total", "balance_due")
+
+
+def extract_invoice_fields(pdf_text: str, min_confidence: float = RULE_MIN_CONFIDENCE,
+                           required_fields: list[str] | None = None) -> dict:
+    """
+    Find invoice header fields with regular expressions, without calling a model.
+
+    Parameters:
+    pdf_text (str): The extracted text of the invoice.
+    min_confidence (float): Confidence a value needs to be used.
+    required_fields (list): Fields that must be found for the result to count as complete.
+    Defaults to RULE_REQUIRED_FIELDS.
+
+    Returns:
+    dict: {"data": every field of the invoice schema, with the values found at min_confidence or
+    above and null (or [] for invoice_items) elsewhere; "fields": each value found with its confidence,
+    including the ones below min_confidence; "missing": schema fields without a trusted value;
+    "complete": whether every required field has a trusted value}.
+    """
+    required_fields = RULE_REQUIRED_FIELDS if required_fields is None else required_fields
+
+    candidates = {}
+    for field, pattern, confidence in RULES:
+        for match in pattern.finditer(pdf_text):
+            try:
+                value = _normalize_value(field, match.group("value"))
+            except ValueError:
+                continue
+            candidates.setdefault(field, []).append((value, confidence))
+
+    fields = {}
+    for field, matches in candidates.items():
+        value, confidence = _pick(matches)
+        fields[field] = {"value": value, "confidence": confidence}
+    _cross_check(fields)
+
+    data = {name: [] if name == "invoice_items" else None for name in get_field_names("invoice")}
+    for field, found in fields.items():
+        if found["confidence"] >= min_confidence:
+            data[field] = found["value"]
+
+    missing = [name for name in data if name not in fields or fields[name]["confidence"] < min_confidence]
+    complete = all(name not in missing for name in required_fields)
+    logger.debug(f"Rules found {len(data) - len(missing)} of {len(data)} invoice fields, complete: {complete}")
+    return {"data": data, "fields": fields, "missing": missing, "complete": complete}
+
+
+def merge_rule_fields(rules: dict, model_data):
+    """
+    Overlay the trusted rule-based values on a model's result, which only had to supply the missing fields.
+    """
+    if not isinstance(model_data, dict):
+        return model_data
+    merged = dict(rules["data"])
+    merged.update({name: value for name, value in model_data.items() if name in rules["missing"] or name not in merged})
+    return merged
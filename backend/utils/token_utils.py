@@ -1,8 +1,41 @@
-import tiktoken
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+_tokenizer = None
+_tokenizer_unavailable = False
+
+
+def get_tokenizer():
+    """
+    Return the gpt-4 tiktoken encoding, or None if it can't be loaded.
+
+    tiktoken downloads the encoding on first use; on a machine without network access (and no
+    TIKTOKEN_CACHE_DIR) that fails, and token counts fall back to an estimate instead of crashing.
+    """
+    global _tokenizer, _tokenizer_unavailable
+    if _tokenizer is None and not _tokenizer_unavailable:
+        try:
+            # Imported here rather than at the top so starting the app doesn't pay for it
+            import tiktoken
+            _tokenizer = tiktoken.encoding_for_model("gpt-4")
+        except Exception as e:
+            logger.warning(f"tiktoken encoding unavailable, estimating token counts from length: {str(e)}")
+            _tokenizer_unavailable = True
+    return _tokenizer
+
+
+def count_tokens(text: str) -> int:
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        # Roughly four characters per token for English text
+        return (len(text) + 3) // 4
+    return len(tokenizer.encode(text))
 
 
 def estimate_token_count(prompt: str, response: str | None) -> dict[str, int]:
-    tokenizer = tiktoken.encoding_for_model("gpt-4")
-    input_tokens = len(tokenizer.encode(prompt))
-    output_tokens = 0 if response is None else len(tokenizer.encode(response))
-    return {"input_tokens": input_tokens, "output_tokens": output_tokens} 
\ No newline at end of file
+    input_tokens = count_tokens(prompt)
+    output_tokens = 0 if response is None else count_tokens(response)
+    return {"input_tokens": input_tokens, "output_tokens": output_tokens}
@@ -0,0 +1,67 @@
+import os
+import hashlib
+import tempfile
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.DEBUG)
+logger = logging.getLogger(__name__)
+
+# Uploads larger than this are rejected while they stream in (Flask's MAX_CONTENT_LENGTH)
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+# PDFs up to this size are processed from memory; larger ones are spooled to a uniquely named temp file
+PDF_SPOOL_THRESHOLD_BYTES = int(os.environ.get("PDF_SPOOL_THRESHOLD_BYTES", str(16 * 1024 * 1024)))
+READ_CHUNK_BYTES = 1024 * 1024
+
+
+def read_upload(stream, spool_threshold: int = PDF_SPOOL_THRESHOLD_BYTES) -> tuple[bytes | str, str]:
+    """
+    Read an uploaded PDF in chunks, hashing it as it streams in.
+
+    Parameters:
+    stream: A readable binary file object, e.g. a Flask FileStorage.
+    spool_threshold (int): Size in bytes above which the PDF is written to a temp file instead of kept in memory.
+
+    Returns:
+    tuple: (the PDF bytes, or the path of a temp file holding them; SHA-256 hex digest of the PDF).
+    A temp file path must be released with discard_upload once processing is done.
+    """
+    hasher = hashlib.sha256()
+    chunks = []
+    size = 0
+    temp_file = None
+    try:
+        while True:
+            chunk = stream.read(READ_CHUNK_BYTES)
+            if not chunk:
+                break
+            hasher.update(chunk)
+            size += len(chunk)
+            if temp_file is None and size > spool_threshold:
+                temp_file = tempfile.NamedTemporaryFile(prefix="upload-", suffix=".pdf", delete=False)
+                temp_file.write(b"".join(chunks))
+                chunks = []
+            if temp_file is None:
+                chunks.append(chunk)
+            else:
+                temp_file.write(chunk)
+    except BaseException:
+        if temp_file is not None:
+            temp_file.close()
+            os.remove(temp_file.name)
+        raise
+
+    if temp_file is None:
+        return b"".join(chunks), hasher.hexdigest()
+
+    temp_file.close()
+    logger.debug(f"Spooled {size} byte upload to {temp_file.name}")
+    return temp_file.name, hasher.hexdigest()
+
+
+def discard_upload(pdf_source) -> None:
+    """
+    Remove the temp file behind a spooled upload; in-memory uploads need no cleanup.
+    """
+    if isinstance(pdf_source, str) and os.path.exists(pdf_source):
+        os.remove(pdf_source)
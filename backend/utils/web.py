@@ -0,0 +1,115 @@
+import json
+from utils.chunking import CHUNK_MODES
+from utils.metrics import PROVIDER_LATENCY
+from utils.normalize import parse_normalizers
+from utils.pipeline import extraction_cache
+from utils.providers import select_providers
+from utils.results_store import LOOKUP_FIELDS
+from utils.routing import DEFAULT_ROUTING_POLICY, ROUTING_POLICIES
+from utils.rule_extraction import DEFAULT_RULE_MODE, RULE_MODES
+
+# Request handling shared by the Flask app (app.py) and the async server (asgi.py)
+
+
+def parse_extraction_options(form, providers) -> dict:
+    """
+    Read the extraction options of an upload request's form.
+
+    Parameters:
+    form: The request's form fields.
+    providers (dict): The server's enabled providers, which the models field chooses from.
+
+    Returns:
+    dict: {"document_type", "chunk_mode", "normalizers", "rule_mode", "providers", "policy"}.
+
+    Raises:
+    ValueError: If chunk_mode, normalize, rules, models or routing has an unknown value; the message is meant for the client.
+    """
+    # "skip" answers from rule-based extraction alone when it finds every required field; "fill"
+    # only asks the models for the fields the rules missed
+    chunk_mode = form.get('chunk_mode', 'auto')
+    if chunk_mode not in CHUNK_MODES:
+        raise ValueError(f"chunk_mode must be one of {', '.join(CHUNK_MODES)}")
+    rule_mode = form.get('rules', DEFAULT_RULE_MODE)
+    if rule_mode not in RULE_MODES:
+        raise ValueError(f"rules must be one of {', '.join(RULE_MODES)}")
+    policy = form.get('routing', DEFAULT_ROUTING_POLICY)
+    if policy not in ROUTING_POLICIES:
+        raise ValueError(f"routing must be one of {', '.join(ROUTING_POLICIES)}")
+    return {
+        "document_type": form.get('type', 'invoice'),  # Default to 'invoice' if not specified
+        # "auto" extracts long invoices in chunks; "single" or "chunked" force one or the other
+        "chunk_mode": chunk_mode,
+        "normalizers": parse_normalizers(form.get('normalize')),
+        "rule_mode": rule_mode,
+        # e.g. "openai,anthropic" to only run (and pay for) those models
+        "providers": select_providers(form.get('models'), providers),
+        # How process-pdf spends model calls, see utils/routing.py
+        "policy": policy,
+    }
+
+
+def provider_stats(schedulers: dict) -> dict:
+    """
+    Each provider's rate limiter counters and recent latency, as served by /api/provider-stats.
+    """
+    return {name: {**scheduler.stats(), "latency": PROVIDER_LATENCY.stats(name)} for name, scheduler in schedulers.items()}
+
+
+def parse_result_filters(args) -> dict:
+    """
+    Read the lookup filters and paging of a /api/results request's query parameters.
+
+    Returns:
+    dict: {"filters": field -> value, "limit", "offset"}.
+
+    Raises:
+    ValueError: If limit or offset isn't a number; the message is meant for the client.
+    """
+    try:
+        limit, offset = int(args.get('limit', '100')), int(args.get('offset', '0'))
+    except ValueError:
+        raise ValueError("limit and offset must be whole numbers")
+    filters = {name: args[name] for name in (*LOOKUP_FIELDS, "model", "document_type") if args.get(name)}
+    return {"filters": filters, "limit": limit, "offset": offset}
+
+
+def debug_requested(form, args) -> bool:
+    # Either a form field or a query parameter, so it also works for requests built by hand
+    value = form.get('debug') or args.get('debug') or ""
+    return value.lower() in ("1", "true", "yes")
+
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# ------------- METRICS COLLECTORS -------------
+def collect_cache_metrics():
+    stats = extraction_cache.stats()
+    return [
+        ("extraction_cache_lookups_total", "counter", "Extraction cache lookups, by result.",
+         [({"result": result}, stats[result]) for result in ("memory_hits", "disk_hits", "misses")]),
+        ("extraction_cache_entries", "gauge", "Entries held in each extraction cache tier.",
+         [({"tier": "memory"}, stats["memory_entries"]), ({"tier": "disk"}, stats["disk_entries"])]),
+    ]
+
+
+def provider_metrics_collector(schedulers: dict):
+    """
+    Make a collector for the rate limiter counters of the given provider schedulers.
+    """
+    def collect_provider_metrics():
+        stats = {name: scheduler.stats() for name, scheduler in schedulers.items()}
+        return [
+            ("extraction_provider_attempts_total", "counter", "Provider call attempts made by the rate limiter, by outcome.",
+             [({"provider": name, "outcome": outcome}, provider_stats[outcome])
+              for name, provider_stats in stats.items() for outcome in ("calls", "retries", "throttled", "failures")]),
+            ("extraction_provider_concurrency_limit", "gauge", "Current adaptive concurrency limit per provider.",
+             [({"provider": name}, provider_stats["concurrency_limit"]) for name, provider_stats in stats.items()]),
+            ("extraction_provider_recent_latency_seconds", "gauge", "Latency of each provider's recent successful calls, used for routing.",
+             [({"provider": name, "quantile": str(pct / 100)}, PROVIDER_LATENCY.percentile(name, pct))
+              for name in stats for pct in (50, 90) if PROVIDER_LATENCY.count(name)]),
+        ]
+
+    return collect_provider_metrics